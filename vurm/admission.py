@@ -0,0 +1,123 @@
+"""
+Admission control for the requests served by the controller daemon.
+"""
+
+
+
+import collections
+
+from twisted.internet import defer
+
+from vurm import logging, error
+
+
+
+class RequestScheduler(object):
+    """
+    Limits the number of requests being processed at the same time.
+
+    At most ``concurrency`` requests run concurrently; further requests are
+    queued (up to ``maxQueued`` of them, if given, the others being rejected
+    with an ``error.RequestRejected`` exception) and started as soon as a
+    running request completes.
+
+    Queued requests are started by decreasing priority. Among requests with
+    the same priority, users are served in a round-robin fashion, so that a
+    single user submitting many requests can't starve the others; the
+    requests of a single user are served in the order they were submitted.
+    """
+
+    def __init__(self, concurrency=4, maxQueued=None):
+        self.concurrency = concurrency
+        self.maxQueued = maxQueued
+
+        self.running = 0
+        self.queued = 0
+        self.queues = {}
+
+        self.log = logging.Logger(__name__, system='vurmctld')
+
+
+    def submit(self, user, priority, func, *args, **kwargs):
+        """
+        Schedules the execution of ``func`` with the given arguments on behalf
+        of ``user`` and returns a deferred which fires with its result.
+        """
+
+        if self.running < self.concurrency and not self.queued:
+            return self.run(func, args, kwargs)
+
+        if self.maxQueued is not None and self.queued >= self.maxQueued:
+            return defer.fail(error.RequestRejected('Too many pending ' \
+                    'requests ({0}), try again later'.format(self.queued)))
+
+        d = defer.Deferred()
+
+        users = self.queues.setdefault(priority, collections.OrderedDict())
+        users.setdefault(user, collections.deque()).append(
+                (func, args, kwargs, d))
+        self.queued += 1
+
+        self.log.debug('Queued request from {0!r} with priority {1} ({2} ' \
+                'running, {3} queued)', user, priority, self.running,
+                self.queued)
+
+        return d
+
+
+    def run(self, func, args, kwargs):
+        self.running += 1
+
+        def finished(result):
+            self.running -= 1
+            self.startQueued()
+            return result
+
+        return defer.maybeDeferred(func, *args, **kwargs).addBoth(finished)
+
+
+    def popNext(self):
+        """
+        Removes the next request to start from the queues and returns it.
+        """
+
+        priority = max(self.queues)
+        users = self.queues[priority]
+
+        # Round robin: the served user goes to the end of the line
+        user, requests = users.popitem(last=False)
+        request = requests.popleft()
+
+        if requests:
+            users[user] = requests
+        elif not users:
+            del self.queues[priority]
+
+        self.queued -= 1
+        return request
+
+
+    def startQueued(self):
+        while self.queued and self.running < self.concurrency:
+            func, args, kwargs, d = self.popNext()
+            self.run(func, args, kwargs).chainDeferred(d)
+
+
+    def getStatus(self):
+        """
+        Returns a dictionary with the number of ``running`` and ``queued``
+        requests and the number of queued requests of each user.
+        """
+
+        users = collections.defaultdict(int)
+
+        for queue in self.queues.itervalues():
+            for user, requests in queue.iteritems():
+                users[user] += len(requests)
+
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'concurrency': self.concurrency,
+            'users': dict(users),
+        }
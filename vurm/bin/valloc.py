@@ -5,6 +5,7 @@ Creates a new virtual cluster and feeds it to SLURM.
 
 
 import argparse
+import getpass
 import sys
 
 from twisted.protocols import amp
@@ -15,6 +16,33 @@ from vurm import commands, settings
 
 
 
+class ProgressReporter(amp.AMP):
+    """
+    Client side protocol printing the state changes of the nodes of the
+    virtual cluster being created as they are notified by the controller.
+    """
+
+    def __init__(self, *args, **kwargs):
+        amp.AMP.__init__(self, *args, **kwargs)
+        self.counts = {}
+
+
+    @commands.NodeStateChanged.responder
+    def nodeStateChanged(self, clusterName, nodeName, state, hostname=None):
+        self.counts[state] = self.counts.get(state, 0) + 1
+
+        line = '[{0}] {1} {2} ({3} {2})'.format(clusterName, nodeName, state,
+                self.counts[state])
+
+        if hostname is not None:
+            line += ' at {0}'.format(hostname)
+
+        print line
+        sys.stdout.flush()
+        return {}
+
+
+
 def main():
     """
     Main program entry point.
@@ -26,6 +54,8 @@ def main():
     parser.add_argument('-c', '--config', type=filepath.FilePath, 
             # action='append', 
             help='Configuration file')
+    parser.add_argument('-p', '--priority', type=int,
+            help='Priority of the request, higher values are served first')
     parser.add_argument('minsize', type=int, help='Minimum acceptable virtual cluster size', nargs='?', default=0)
     parser.add_argument('size', type=int, help='Desired virtual cluster size')
     args = parser.parse_args()
@@ -34,27 +64,31 @@ def main():
     config = settings.loadConfig(args.config)
 
     factory = protocol.ClientFactory()
-    factory.protocol = amp.AMP
+    factory.protocol = ProgressReporter
 
     # Create a new endpoint
     endpoint = endpoints.clientFromString(reactor,
             config.get('vurm-client', 'endpoint'))
     d = endpoint.connect(factory)
 
-    def gotController(controller, numNodes, minNumNodes):
+    def gotController(controller, numNodes, minNumNodes, priority):
         """
         Called with the remote controller reference as first argument.
 
         Returns a deferred which fires with the result of the
         ``createVirtualCluster`` operation on the remote controller.
         """
-        kwargs = {'size': numNodes}
+        kwargs = {'size': numNodes, 'user': unicode(getpass.getuser()),
+                'progress': True}
 
         if minNumNodes > 0:
             kwargs['minSize'] = minNumNodes
 
+        if priority is not None:
+            kwargs['priority'] = priority
+
         return controller.callRemote(commands.CreateVirtualCluster, **kwargs)
-    d.addCallback(gotController, args.size, args.minsize)
+    d.addCallback(gotController, args.size, args.minsize, args.priority)
 
     def gotResult(result):
         """
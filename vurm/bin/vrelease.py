@@ -58,13 +58,26 @@ def main():
                     clusterName=clusterName)
     d.addCallback(gotController, args.name, args.all)
 
-    def gotResult(_):
+    def gotResult(result):
         """
         Called when the virtual cluster destruction operation succeeds.
 
-        Prints a confirmation message to the standard output.
+        Prints a confirmation message (or a report for each cluster if all
+        clusters were destroyed) to the standard output.
         """
-        print "The virtual cluster was correctly destroyed."
+        if 'clusters' not in result:
+            print "The virtual cluster was correctly destroyed."
+            return
+
+        for cluster in result['clusters']:
+            if cluster.get('error') is not None:
+                print '{0}: {1}'.format(cluster['clusterName'],
+                        cluster['error'])
+            else:
+                print '{0}: destroyed'.format(cluster['clusterName'])
+
+        print "{0} virtual clusters were destroyed.".format(
+                len(result['clusters']))
     d.addCallback(gotResult)
 
     def gotError(failure):
@@ -0,0 +1,83 @@
+"""
+Grows or shrinks an already existing virtual cluster.
+"""
+
+
+
+import argparse
+import sys
+
+from twisted.protocols import amp
+from twisted.internet import reactor, endpoints, protocol
+from twisted.python import filepath
+
+from vurm import commands, settings
+
+
+
+def main():
+    """
+    Main program entry point.
+    """
+
+    parser = argparse.ArgumentParser(description='Resizes a virtual cluster.')
+    parser.add_argument('-c', '--config', type=filepath.FilePath,
+            help='Configuration file')
+    parser.add_argument('name', metavar='cluster-name',
+            help='Name of the virtual cluster to resize')
+    parser.add_argument('size', type=int, help='New virtual cluster size')
+    args = parser.parse_args()
+
+    # Read configuration file
+    config = settings.loadConfig(args.config)
+
+    factory = protocol.ClientFactory()
+    factory.protocol = amp.AMP
+
+    # Create a new endpoint
+    endpoint = endpoints.clientFromString(reactor,
+            config.get('vurm-client', 'endpoint'))
+    d = endpoint.connect(factory)
+
+    def gotController(controller, clusterName, size):
+        """
+        Called with the remote controller reference as first argument.
+
+        Returns a deferred which fires with the result of the
+        ``resizeVirtualCluster`` operation on the remote controller.
+        """
+        return controller.callRemote(commands.ResizeVirtualCluster,
+                clusterName=clusterName, size=size)
+    d.addCallback(gotController, args.name, args.size)
+
+    def gotResult(result, clusterName):
+        """
+        Called when the virtual cluster resize operation succeeds with the
+        new size of the cluster.
+
+        Prints the result to the standard output.
+        """
+        print 'The virtual cluster {0!r} now has {1} nodes'.format(
+                clusterName, result['size'])
+    d.addCallback(gotResult, args.name)
+
+    def gotError(failure):
+        """
+        Called when the virtual cluster resize operation fails.
+
+        Prints the error to the standard output.
+        """
+        print failure.value
+        print failure
+    d.addErrback(gotError)
+
+    # Make sure to exit once done
+    d.addBoth(lambda _: reactor.stop())
+
+    # Run the reactor
+    reactor.run()
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
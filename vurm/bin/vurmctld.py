@@ -46,7 +46,7 @@ def main():
     ctld = controller.VurmController(config, [
         remotevirt.Provisioner(reactor, config),
         #multilocal.Provisioner(reactor, config),
-    ])
+    ], reactor)
 
     # Publish daemon
     factory = spread.InstanceProtocolFactory(controller.VurmControllerProtocol,
@@ -55,7 +55,11 @@ def main():
     endpoint = config.get('vurmctld', 'endpoint')
     endpoint = endpoints.serverFromString(reactor, endpoint)
 
-    endpoint.listen(factory)
+    # Re-adopt the clusters which survived a restart before serving requests
+    d = ctld.recover()
+    d.addErrback(lambda failure: log.error('Recovery from the state ' \
+            'journal failed: {0}', failure.getErrorMessage()))
+    d.addCallback(lambda _: endpoint.listen(factory))
 
     reactor.run()
 
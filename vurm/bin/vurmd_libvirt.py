@@ -46,6 +46,9 @@ def main():
 
     endpoint.listen(factory)
 
+    reactor.callWhenRunning(domainManager.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', domainManager.stop)
+
     reactor.run()
 
     # TODO: Return the correct exit code
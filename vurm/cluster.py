@@ -9,7 +9,7 @@ import random
 
 from twisted.internet import defer
 
-from vurm import logging
+from vurm import logging, slurm
 
 
 
@@ -49,11 +49,11 @@ class VirtualCluster(object):
 
 
     @staticmethod
-    def nodeNamesGenerator(clusterName):
+    def nodeNamesGenerator(clusterName, start=0):
         clusterName = clusterName[len(CLUSTER_NAME_PREFIX):]
         clusterName = '{0}{1}-{{0}}'.format(NODE_NAME_PREFIX, clusterName)
 
-        nodeCount = 0
+        nodeCount = start
         while True:
             yield clusterName.format(nodeCount)
             nodeCount += 1
@@ -82,12 +82,37 @@ class VirtualCluster(object):
         return CLUSTER_NAME_PREFIX + name
 
 
-    def __init__(self, nodes, name=None):
+    @staticmethod
+    def getNodeIndex(nodeName):
+        """
+        Returns the position of ``nodeName`` in the sequence of names
+        generated by ``nodeNamesGenerator``.
+        """
+
+        return int(nodeName.rsplit('-', 1)[1])
+
+
+    @classmethod
+    def reserveClusterName(cls, name):
+        """
+        Prevents ``generateClusterName`` from generating ``name``, which is
+        used by an existing cluster.
+        """
+
+        cls.__clusterNames.add(name[len(CLUSTER_NAME_PREFIX):])
+
+
+    def __init__(self, nodes, name=None, nodeNames=None):
         """
         Creates a new virtual cluster from the given node list. The items of
         the nodes list have to provide the vurm.resources.INode interface or
         already been adapted to it, the virtual cluster instance will NOT adapt
         them.
+
+        The ``nodeNames`` iterator is used to name the nodes added later on
+        to the cluster. It should be the one used to name the initial nodes,
+        so that the sequence continues; it defaults to a new
+        ``nodeNamesGenerator`` for the cluster name.
         """
 
         if name is None:
@@ -95,7 +120,12 @@ class VirtualCluster(object):
         else:
             self.name = name
 
+        if nodeNames is None:
+            nodeNames = VirtualCluster.nodeNamesGenerator(self.name)
+
         self.nodes = nodes
+        self.nodeNames = nodeNames
+        self.lock = defer.DeferredLock()
         self.log = logging.Logger(__name__, system=self.name)
 
         self.log.info('New virtual cluster created')
@@ -108,13 +138,24 @@ class VirtualCluster(object):
         a SLURM partition (and the relative nodes).
         """
 
-        nodenames = 'nd-{0}-[0-{1}]'.format(self.name[3:], len(self.nodes) - 1)
+        # Nodes which failed to come up leave holes in the numbering
+        nodenames = slurm.compressHostlist([n.nodeName for n in self.nodes])
+
+        # Nodes providing their attributes are described by as few lines as
+        # possible, the other ones by their own entry
+        nodes, lines = [], []
+
+        for node in self.nodes:
+            getAttributes = getattr(node, 'getConfigAttributes', None)
+
+            if getAttributes is None:
+                lines.append(node.getConfigEntry())
+            else:
+                nodes.append((node.nodeName, getAttributes()))
 
         entries = [
             '# [{0}]'.format(self.name),
-        ] + [
-            n.getConfigEntry() for n in self.nodes
-        ] + [
+        ] + slurm.formatNodeEntries(nodes) + lines + [
             'PartitionName={0} Nodes={1} Default=NO MaxTime=INFINITE ' \
                     'State=UP'.format(self.name, nodenames),
             '# [/{0}]'.format(self.name),
@@ -123,16 +164,48 @@ class VirtualCluster(object):
         return '\n'.join(entries) + '\n'
 
 
-    def spawnNodes(self):
+    def addNodes(self, nodes):
+        """
+        Adds the given nodes to the cluster. The nodes are neither spawned
+        nor registered to SLURM by this method.
+        """
+
+        self.log.info('Adding {0} nodes', len(nodes))
+        self.nodes = self.nodes + list(nodes)
+
+
+    def removeNodes(self, count):
+        """
+        Removes the ``count`` most recently added nodes from the cluster and
+        returns them. The nodes are not released by this method.
+        """
+
+        self.log.info('Removing {0} nodes', count)
+
+        removed = self.nodes[len(self.nodes) - count:]
+        self.nodes = self.nodes[:len(self.nodes) - count]
+        return removed
+
+
+    def spawnNodes(self, spawned=None):
         """
         Spawns all nodes managed by this virtual cluster. Returns a callback
         which fires with this instance as soon as all nodes have launched their
         respective SLURM daemon.
+
+        If given, ``spawned`` is called with each node as soon as its SLURM
+        daemon is launched.
         """
 
         self.log.info('Spawning slurm daemons on all nodes')
 
-        d = defer.DeferredList([n.spawn() for n in self.nodes])
+        dl = [n.spawn() for n in self.nodes]
+
+        if spawned is not None:
+            for d in dl:
+                d.addCallback(spawned)
+
+        d = defer.DeferredList(dl)
         d.addCallback(lambda _: self)
         return d
 
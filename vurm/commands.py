@@ -1,7 +1,10 @@
 from twisted.protocols import amp
 
+from vurm import error
 
-__all__ = ['CreateVirtualCluster', 'DestroyVirtualCluster', ]
+
+__all__ = ['CreateVirtualCluster', 'DestroyVirtualCluster', 'GetQueueStatus',
+        'NodeStateChanged', 'ResizeVirtualCluster', ]
 
 
 
@@ -9,10 +12,32 @@ class CreateVirtualCluster(amp.Command):
     arguments = [
         ('size', amp.Integer()),
         ('minSize', amp.Integer(optional=True)),
+        ('user', amp.Unicode(optional=True)),
+        ('priority', amp.Integer(optional=True)),
+        ('progress', amp.Boolean(optional=True)),
     ]
     response = [
         ('clusterName', amp.String()),
     ]
+    errors = {
+        error.RequestRejected: 'REQUEST_REJECTED',
+    }
+
+
+
+class NodeStateChanged(amp.Command):
+    """
+    Sent by the controller to the client which requested a virtual cluster
+    with the ``progress`` flag set each time one of its nodes changes state.
+    """
+
+    arguments = [
+        ('clusterName', amp.String()),
+        ('nodeName', amp.String()),
+        ('state', amp.String()),
+        ('hostname', amp.String(optional=True)),
+    ]
+    requiresAnswer = False
 
 
 
@@ -22,5 +47,42 @@ class DestroyVirtualCluster(amp.Command):
     ]
 
 
+class ResizeVirtualCluster(amp.Command):
+    arguments = [
+        ('clusterName', amp.String()),
+        ('size', amp.Integer()),
+    ]
+    response = [
+        ('size', amp.Integer()),
+    ]
+    errors = {
+        error.InvalidClusterName: 'INVALID_CLUSTER_NAME',
+        error.InvalidClusterSize: 'INVALID_CLUSTER_SIZE',
+        error.InsufficientResourcesException: 'INSUFFICIENT_RESOURCES',
+    }
+
+
+
 class DestroyAllVirtualClusters(amp.Command):
-    pass
+    response = [
+        ('clusters', amp.AmpList([
+            ('clusterName', amp.String()),
+            ('error', amp.Unicode(optional=True)),
+        ])),
+    ]
+
+
+
+class GetQueueStatus(amp.Command):
+    response = [
+        ('running', amp.Integer()),
+        ('queued', amp.Integer()),
+        ('concurrency', amp.Integer()),
+        ('users', amp.AmpList([
+            ('user', amp.Unicode()),
+            ('queued', amp.Integer()),
+        ])),
+        ('reconfigurations', amp.Integer(optional=True)),
+        ('reconfigureLatency', amp.Float(optional=True)),
+        ('reconfigureMaxLatency', amp.Float(optional=True)),
+    ]
@@ -4,27 +4,235 @@ VURM controller daemon implementation and support classes.
 
 
 
-import os
-
-from twisted.internet import defer, utils
+from twisted.internet import defer
 from twisted.protocols import amp
+from twisted.python import failure
+
+from vurm import logging, resources, error, cluster, commands, settings, slurm
+from vurm import admission, journal, worker
+
+
+
+NODE_ALLOCATED = 'allocated'
+"""
+The node was requested to a provisioner.
+"""
+
+
+NODE_BOOTED = 'booted'
+"""
+The node is up and reachable at its hostname (for virtual machines, the
+guest OS booted and reported its IP address).
+"""
+
+
+NODE_SPAWNED = 'spawned'
+"""
+The SLURM daemon of the node is running.
+"""
+
+
+NODE_STATES = [NODE_ALLOCATED, NODE_BOOTED, NODE_SPAWNED]
+"""
+The states through which each node goes, in order, during the creation of a
+virtual cluster.
+"""
+
+
+
+def splitRequest(size, capacities):
+    """
+    Splits a request for ``size`` nodes proportionally to the given list of
+    capacities and returns the list of node counts to request to each
+    provider.
+
+    A capacity of ``None`` means that the capacity is unknown and is treated
+    as if the provider could satisfy the whole request by itself. No provider
+    is assigned more nodes than its capacity; if the total capacity is not
+    sufficient, the returned counts sum up to less than ``size``.
+    """
+
+    weights = [size if c is None else c for c in capacities]
+    total = sum(weights)
+
+    if not total:
+        return [0] * len(weights)
 
-from vurm import logging, resources, error, cluster, commands
+    target = min(size, total)
+    shares = [target * w // total for w in weights]
+
+    # Give the nodes left over by the rounding to the providers with the
+    # largest fractional parts
+    byRemainder = sorted(range(len(weights)), reverse=True,
+            key=lambda i: (target * weights[i]) % total)
+
+    for i in byRemainder[:target - sum(shares)]:
+        shares[i] += 1
+
+    return shares
+
+
+
+class NodesGatherer(object):
+    """
+    Waits for the given node deferreds to fire and collects the nodes which
+    came up successfully.
+
+    The ``deferred`` attribute fires with the list of ready nodes once all
+    nodes either came up or failed, once ``timeout`` seconds (if given)
+    elapsed, or as soon as the failed nodes make it impossible to get
+    ``minSize`` ready nodes. If ``grace`` is given, it also fires ``grace``
+    seconds after ``minSize`` nodes are ready, so that a few slow or hung
+    nodes can't hold back the others. The nodes coming up after that point
+    are released in the background.
+    """
+
+    def __init__(self, reactor, nodes, minSize, timeout=None, grace=None):
+        self.reactor = reactor
+        self.minSize = minSize
+        self.grace = grace
+        self.pending = len(nodes)
+        self.ready = []
+        self.deferred = defer.Deferred()
+        self.timeoutCall = None
+        self.graceCall = None
+
+        self.log = logging.Logger(__name__, system='vurmctld')
+
+        if timeout is not None:
+            self.timeoutCall = reactor.callLater(timeout, self.expired)
+
+        for node in nodes:
+            node.addCallbacks(self.nodeReady, self.nodeFailed)
+
+        self.check()
+
+
+    def nodeReady(self, node):
+        self.pending -= 1
+
+        if self.deferred.called:
+            self.log.info('Releasing node {0} which came up after the ' \
+                    'deadline', node.nodeName)
+            return node.release()
+
+        self.ready.append(node)
+        self.check()
+
+
+    def nodeFailed(self, reason):
+        self.pending -= 1
+        self.log.error('Node creation failed: {0}', reason.getErrorMessage())
+
+        self.check()
+
+
+    def check(self):
+        if self.deferred.called:
+            return
+
+        if not self.pending:
+            self.finish()
+        elif len(self.ready) + self.pending < self.minSize:
+            self.finish()
+        elif len(self.ready) >= self.minSize and self.grace is not None \
+                and self.graceCall is None:
+            self.graceCall = self.reactor.callLater(self.grace,
+                    self.graceExpired)
+
+
+    def graceExpired(self):
+        self.graceCall = None
+
+        self.log.warning('Grace period expired with {0} ready nodes and {1} ' \
+                'nodes still pending', len(self.ready), self.pending)
+
+        self.finish()
+
+
+    def expired(self):
+        self.timeoutCall = None
+
+        self.log.warning('Deadline expired with {0} ready nodes and {1} ' \
+                'nodes still pending', len(self.ready), self.pending)
+
+        self.finish()
+
+
+    def finish(self):
+        if self.timeoutCall is not None:
+            self.timeoutCall.cancel()
+            self.timeoutCall = None
+
+        if self.graceCall is not None:
+            self.graceCall.cancel()
+            self.graceCall = None
+
+        self.deferred.callback(self.ready)
 
 
 
 class VurmControllerProtocol(amp.AMP):
 
     @commands.CreateVirtualCluster.responder
-    def createVirtualCluster(self, size, minSize=None):
-        d = self.instance.createVirtualCluster(size, minSize)
+    def createVirtualCluster(self, size, minSize=None, user=None,
+            priority=None, progress=False):
+        if progress:
+            observer = self.nodeStateChanged
+        else:
+            observer = None
+
+        d = self.instance.requestVirtualCluster(size, minSize, user,
+                priority, observer)
         return d.addCallback(lambda cluster: {'clusterName': cluster.name})
 
 
+    def nodeStateChanged(self, clusterName, nodeName, state, hostname=None):
+        kwargs = {}
+
+        if hostname is not None:
+            kwargs['hostname'] = hostname
+
+        d = self.callRemote(commands.NodeStateChanged, clusterName=clusterName,
+                nodeName=nodeName, state=state, **kwargs)
+
+        if d is not None:
+            # The client went away, the creation goes on anyway
+            d.addErrback(lambda _: None)
+
+
+    @commands.GetQueueStatus.responder
+    def getQueueStatus(self):
+        status = self.instance.scheduler.getStatus()
+        status['users'] = [{'user': u, 'queued': c}
+                for u, c in sorted(status['users'].iteritems())]
+
+        if self.instance.reconfigureWorker is not None:
+            stats = self.instance.reconfigureWorker.getStats()
+            status['reconfigurations'] = stats['completed']
+            status['reconfigureLatency'] = stats['average']
+            status['reconfigureMaxLatency'] = stats['max']
+
+        return status
+
+
     @commands.DestroyAllVirtualClusters.responder
     def destroyAllVirtualClusters(self):
+        def gotReport(report):
+            clusters = []
+
+            for clusterName, message in sorted(report.iteritems()):
+                cluster = {'clusterName': clusterName}
+
+                if message is not None:
+                    cluster['error'] = unicode(message)
+
+                clusters.append(cluster)
+
+            return {'clusters': clusters}
+
         d = self.instance.destroyAllVirtualClusters()
-        return d.addCallback(lambda _: {})
+        return d.addCallback(gotReport)
 
 
     @commands.DestroyVirtualCluster.responder
@@ -33,6 +241,12 @@ class VurmControllerProtocol(amp.AMP):
         return d.addCallback(lambda _: {})
 
 
+    @commands.ResizeVirtualCluster.responder
+    def resizeVirtualCluster(self, clusterName, size):
+        d = self.instance.resizeVirtualCluster(clusterName, size)
+        return d.addCallback(lambda cluster: {'size': len(cluster.nodes)})
+
+
 
 class VurmController(object):
     """
@@ -43,11 +257,13 @@ class VurmController(object):
           interface into two different classes.
     """
 
-    def __init__(self, configuration, provisioners):
+    def __init__(self, configuration, provisioners, reactor=None):
         """
         Creates a new controller with the given configuration provider and the
         given list of provisioners.
 
+        The ``reactor`` parameter defaults to the global Twisted reactor.
+
         The configuration parameter has to be a compatible with the
         ``ConfigParser.RawConfigParser`` interface.
 
@@ -64,10 +280,210 @@ class VurmController(object):
 
         self.clusters = {}
 
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.reactor = reactor
+
+        backend = slurm.CONFIG_BACKENDS[settings.getOption(configuration,
+                'vurmctld', 'configbackend', 'file')](configuration,
+                        slurm.AtomicFileWriter(reactor))
+
+        if settings.getOption(configuration, 'vurmctld', 'reconfigureworker',
+                False, bool):
+            self.reconfigureWorker = worker.ShellWorker(reactor,
+                    timeout=settings.getOption(configuration, 'vurmctld',
+                            'reconfiguretimeout', 120, float))
+        else:
+            self.reconfigureWorker = None
+
+        reconfigurator = slurm.RECONFIGURE_BACKENDS[settings.getOption(
+                configuration, 'vurmctld', 'reconfigurebackend', 'command')](
+                        configuration, self.reconfigureWorker)
+
+        self.slurmConfig = slurm.ConfigurationScheduler(reactor, configuration,
+                settings.getOption(configuration, 'vurmctld',
+                        'reconfigurewindow', 0, float), backend,
+                reconfigurator)
+
+        self.scheduler = admission.RequestScheduler(
+                settings.getOption(configuration, 'vurmctld', 'maxconcurrent',
+                        4, int),
+                settings.getOption(configuration, 'vurmctld', 'maxqueued',
+                        None, int))
+
+        journalPath = settings.getOption(configuration, 'vurmctld',
+                'statejournal', None)
+
+        if journalPath is not None:
+            self.journal = journal.StateJournal(journalPath,
+                    settings.getOption(configuration, 'vurmctld',
+                            'journalcompact', 100, int), reactor)
+        else:
+            self.journal = None
+
         self.log = logging.Logger(__name__, system='vurmctld')
 
 
+    def getNodeState(self, node):
+        getState = getattr(node, 'getState', None)
+
+        if getState is not None:
+            return getState()
+
+        return {'nodeName': node.nodeName, 'hostname': node.hostname}
+
+
+    def journalFailed(self, reason):
+        self.log.error('Failed to write the state journal: {0}',
+                reason.getErrorMessage())
+
+
+    def recordCluster(self, virtualCluster):
+        """
+        Records the current state of ``virtualCluster`` in the state journal,
+        if the ``statejournal`` option is set. Returns a deferred firing once
+        the state has been written; write errors are logged.
+        """
+
+        if self.journal is None:
+            return defer.succeed(None)
+
+        d = self.journal.recordCluster(virtualCluster.name,
+                virtualCluster.getConfigEntry(),
+                [self.getNodeState(n) for n in virtualCluster.nodes])
+        return d.addErrback(self.journalFailed)
+
+
+    def forgetCluster(self, clusterName):
+        """
+        Records the destruction of the cluster ``clusterName`` in the state
+        journal. Has to be called only once the entry of the cluster has been
+        removed from the SLURM configuration, so that ``recover`` can still
+        clean it up if the controller stops before.
+        """
+
+        if self.journal is None:
+            return defer.succeed(None)
+
+        d = self.journal.forgetCluster(clusterName)
+        return d.addErrback(self.journalFailed)
+
+
     @defer.inlineCallbacks
+    def recover(self):
+        """
+        Rebuilds the cluster table after a restart by replaying the state
+        journal defined by the ``statejournal`` option (nothing is done if
+        it is not set).
+
+        The recorded nodes are handed to the ``restoreNodes`` method of each
+        provisioner implementing it, which reconciles them with the actual
+        state of the hosts. Each cluster is re-adopted with the nodes which
+        are still running and its SLURM configuration entry is updated if
+        some nodes were lost; clusters without running nodes are removed.
+
+        Returns a deferred firing once the recovery completes.
+        """
+
+        if self.journal is None:
+            return
+
+        records = self.journal.replay()
+
+        self.log.info('Recovering {0} virtual clusters from the state ' \
+                'journal', len(records))
+
+        states = [s for r in records.itervalues() for s in r['nodes']]
+        alive = {}
+
+        for provisioner in self.provisioners:
+            restoreNodes = getattr(provisioner, 'restoreNodes', None)
+
+            if restoreNodes is None:
+                continue
+
+            try:
+                nodes = yield restoreNodes(states)
+            except Exception:
+                self.log.error('Failed to restore the nodes of {0}: {1}',
+                        provisioner, failure.Failure().getErrorMessage())
+                continue
+
+            for node in nodes:
+                node = resources.INode(node)
+                alive[node.nodeName] = node
+
+        updates = []
+
+        for clusterName, record in sorted(records.iteritems()):
+            clusterName = str(clusterName)
+            entry = str(record['entry'])
+            nodeNames = [str(s['nodeName']) for s in record['nodes']]
+            nodes = [alive[n] for n in nodeNames if n in alive]
+
+            if not nodes:
+                self.log.warning('No node of {0!r} is running anymore, ' \
+                        'removing it', clusterName)
+                d = self.updateSlurmConfig(remove=entry)
+                d.addCallback(lambda _, name=clusterName:
+                        self.forgetCluster(name))
+                updates.append(d)
+                continue
+
+            start = max(cluster.VirtualCluster.getNodeIndex(n)
+                    for n in nodeNames) + 1
+
+            cluster.VirtualCluster.reserveClusterName(clusterName)
+            virtualCluster = cluster.VirtualCluster(nodes, name=clusterName,
+                    nodeNames=cluster.VirtualCluster.nodeNamesGenerator(
+                            clusterName, start))
+            self.clusters[clusterName] = virtualCluster
+
+            self.log.info('Recovered {0!r} with {1} of its {2} nodes',
+                    clusterName, len(nodes), len(nodeNames))
+
+            if virtualCluster.getConfigEntry() != entry:
+                updates.append(self.updateSlurmConfig(
+                        add=virtualCluster.getConfigEntry(), remove=entry))
+
+            updates.append(self.recordCluster(virtualCluster))
+
+        results = yield defer.DeferredList(updates, consumeErrors=True)
+
+        for success, result in results:
+            if not success:
+                self.log.error('Failed to update the SLURM configuration ' \
+                        'of a recovered cluster: {0}',
+                        result.getErrorMessage())
+
+        yield self.journal.compact().addErrback(self.journalFailed)
+
+
+    def requestVirtualCluster(self, size, minSize=None, user=None,
+            priority=None, observer=None):
+        """
+        Submits a virtual cluster creation request on behalf of ``user`` to the
+        request scheduler. At most ``maxconcurrent`` (defaults to 4) clusters
+        are created at the same time; further requests are queued by
+        ``priority`` (defaults to 0, higher values are served first) and
+        served fairly among users. Anonymous requests (``user`` is ``None``)
+        are all queued under the empty user name.
+
+        Returns a deferred firing with the created virtual cluster, or
+        failing with ``error.RequestRejected`` if more than ``maxqueued``
+        requests are already waiting.
+
+        The ``observer`` argument is passed to ``createVirtualCluster``.
+        """
+
+        if user is None:
+            user = u''
+
+        return self.scheduler.submit(user, priority or 0,
+                self.createVirtualCluster, size, minSize, observer)
+
+
     def updateSlurmConfig(self, add='', remove='', notify=True):
         """
         Updates the SLURM configuration by adding or removing the given values.
@@ -77,7 +493,24 @@ class VurmController(object):
 
         If the ``notify`` parameter is ``True`` (the default), then the SLURM
         daemon is reconfigured by invoking the shell command defined by the
-        ``reconfigure`` option of the configuration provider.
+        ``reconfigure`` option of the configuration provider or, if the
+        ``reconfigurebackend`` option is set to ``scontrol``, by applying the
+        edits with ``scontrol`` (see ``slurm.ScontrolReconfigurator``). If
+        the ``reconfigureworker`` option is set, these commands are run by a
+        single long-lived shell (see ``worker.ShellWorker``) instead of
+        spawning a new one for each reconfiguration; reconfigurations taking
+        longer than ``reconfiguretimeout`` seconds (defaults to 120) fail and
+        the shell is respawned.
+
+        The edits requested within the time window defined by the
+        ``reconfigurewindow`` option (in seconds, defaults to 0) are coalesced
+        into a single write and a single reconfiguration.
+
+        The ``configbackend`` option selects how the edits are stored: either
+        directly in the ``slurmconfig`` file (``file``, the default) or as one
+        fragment file per entry (``fragments``), see ``slurm.FragmentsBackend``.
+        Files are always replaced atomically and written off the reactor
+        thread.
 
         Returns a deferred which callsback as soon as the data has been written
         or the SLURM controller was reconfigured (if notification is
@@ -87,36 +520,162 @@ class VurmController(object):
         ``error.ReconfigurationError`` exception is raised.
         """
 
-        if not add and not remove:
-            raise TypeError('Provide a value to add or one to remove')
+        return defer.maybeDeferred(self.slurmConfig.schedule, add, remove,
+                notify)
+
+
+    @defer.inlineCallbacks
+    def getProvisionerShares(self, size):
+        """
+        Queries the capacity of all provisioners concurrently and splits a
+        request for ``size`` nodes among them proportionally to their free
+        capacity (see the ``splitRequest`` function).
+
+        Provisioners failing to report their capacity are not assigned any
+        node. Returns a deferred firing with a list of ``(provisioner,
+        count)`` tuples.
+        """
+
+        results = yield defer.DeferredList([
+            defer.maybeDeferred(p.getCapacity) for p in self.provisioners
+        ], consumeErrors=True)
+
+        capacities = []
+
+        for provisioner, (success, result) in zip(self.provisioners,
+                results):
+            if success:
+                capacities.append(result)
+            else:
+                self.log.warning('Failed to get the capacity of {0}: {1}',
+                        provisioner, result.getErrorMessage())
+                capacities.append(0)
+
+        shares = splitRequest(size, capacities)
+
+        defer.returnValue(zip(self.provisioners, shares))
+
+
+    @defer.inlineCallbacks
+    def allocateNodes(self, size, nodeNames):
+        """
+        Requests ``size`` nodes named after the values of the ``nodeNames``
+        iterator to the provisioners.
+
+        If the ``placement`` option is set to ``proportional``, the request is
+        first split among all provisioners proportionally to their free
+        capacity. The remaining nodes (or all nodes if the ``placement`` option
+        is set to ``sequential``, the default) are then taken from the first
+        provisioner in the list passed at construction time, then from the
+        next one and so on.
+
+        Returns a deferred firing with the list of node deferreds, which can
+        contain less than ``size`` items if the provisioners could not satisfy
+        the request.
+        """
+
+        nodes = []
+
+        placement = settings.getOption(self.config, 'vurmctld', 'placement',
+                'sequential')
 
-        # Marked as not covered because of bug #128:
-        # https://bitbucket.org/ned/coveragepy/issue/128/
-        with open(self.config.get('vurmctld', 'slurmconfig'), 'r+') as fh:
-            newConf = fh.read()
-            newConf = newConf.replace(remove, '')
-            newConf += add
+        if placement == 'proportional':
+            shares = yield self.getProvisionerShares(size)
+        else:
+            shares = []
 
-            fh.seek(0)
-            fh.truncate()
+        shares += [(provisioner, None) for provisioner in self.provisioners]
 
-            fh.write(newConf)
+        for provisioner, count in shares:
+            if count is None:
+                count = size - len(nodes)
 
-        if notify:
-            # Reload slurm config file
-            cmd = self.config.get('vurmctld', 'reconfigure')
+            if not count:
+                continue
 
-            res = yield utils.getProcessValue('sh', ['-c', cmd],
-                    env=os.environ)
+            received = provisioner.getNodes(count, nodeNames)
 
-            if res:
-                raise error.ReconfigurationError('Local slurm instance could' \
-                        ' not be reconfigured (return code: {0})'.format(res))
+            for node in received:
+                nodes.append(node.addCallback(resources.INode))
 
+            self.log.debug('Got {0} nodes from {1}', len(received),
+                    provisioner)
 
+            if len(nodes) == size:
+                break
+
+        defer.returnValue(nodes)
+
+
+    @defer.inlineCallbacks
     def destroyAllVirtualClusters(self):
-        dl = [self.destroyVirtualCluster(c) for c in self.clusters.keys()]
-        return defer.DeferredList(dl).addCallback(lambda _: None)
+        """
+        Destroys all virtual clusters at once.
+
+        The nodes of all clusters are released in parallel, at most
+        ``destroyconcurrency`` (defaults to 64) at a time, and the entries of
+        all clusters are then removed from the SLURM configuration with a
+        single edit and a single reconfiguration.
+
+        Returns a deferred firing with a dictionary mapping the name of each
+        destroyed cluster to ``None`` or to the message of the error which
+        occurred while destroying it. The clusters are removed in either
+        case.
+        """
+
+        clusters = sorted(self.clusters.iteritems())
+        self.clusters = {}
+
+        self.log.info('Destroying all {0} virtual clusters', len(clusters))
+
+        # Wait for any resize in progress to complete
+        for _, virtualCluster in clusters:
+            yield virtualCluster.lock.acquire()
+            virtualCluster.lock.release()
+
+        semaphore = defer.DeferredSemaphore(settings.getOption(self.config,
+                'vurmctld', 'destroyconcurrency', 64, int))
+
+        def releaseNodes(virtualCluster):
+            return defer.DeferredList([semaphore.run(n.release)
+                    for n in virtualCluster.nodes], consumeErrors=True)
+
+        results = yield defer.DeferredList([releaseNodes(c)
+                for _, c in clusters])
+
+        report = {}
+
+        for (clusterName, _), (_, nodeResults) in zip(clusters, results):
+            failures = [r for success, r in nodeResults if not success]
+
+            if failures:
+                report[clusterName] = '{0} nodes could not be released: ' \
+                        '{1}'.format(len(failures),
+                                failures[0].getErrorMessage())
+                self.log.error('Failed to release {0!r}: {1}', clusterName,
+                        report[clusterName])
+            else:
+                report[clusterName] = None
+
+        # The edits requested in the same reactor iteration are applied at
+        # once by the configuration scheduler
+        results = yield defer.DeferredList([
+            self.updateSlurmConfig(remove=c.getConfigEntry())
+            for _, c in clusters
+        ], consumeErrors=True)
+
+        forgotten = []
+
+        for (clusterName, _), (success, result) in zip(clusters, results):
+            if success:
+                forgotten.append(self.forgetCluster(clusterName))
+            elif report[clusterName] is None:
+                report[clusterName] = result.getErrorMessage()
+
+        # Forgotten together, so that the journal commits them as a group
+        yield defer.gatherResults(forgotten)
+
+        defer.returnValue(report)
 
 
     @defer.inlineCallbacks
@@ -144,6 +703,10 @@ class VurmController(object):
         else:
             del self.clusters[clusterName]
 
+        # Wait for any resize in progress to complete
+        yield virtualCluster.lock.acquire()
+        virtualCluster.lock.release()
+
         yield virtualCluster.release()
 
         self.log.debug('Updating SLURM configuration file and restarting ' \
@@ -162,20 +725,164 @@ class VurmController(object):
 
             raise
         else:
+            yield self.forgetCluster(clusterName)
+
             self.log.info('Virtual cluster correctly shut down, returning ' \
                     'to caller')
 
 
+    def resizeVirtualCluster(self, clusterName, size):
+        """
+        Grows or shrinks the virtual cluster named by ``clusterName`` to
+        ``size`` nodes, without touching the nodes which are kept.
+
+        New nodes are named by continuing the sequence of the cluster and are
+        allocated as described by the ``allocateNodes`` method; the cluster
+        grows by as many of them as come up in time (see ``gatherNodes``).
+        When shrinking, the most recently added nodes are released once SLURM
+        was reconfigured. Only the entry of this cluster is replaced in the
+        SLURM configuration.
+
+        Concurrent resizes of the same cluster are applied one after the
+        other. Returns a deferred firing with the resized cluster.
+
+        Raises ``error.InvalidClusterName`` if no cluster with such name is
+        found, ``error.InvalidClusterSize`` if ``size`` is lower than one,
+        ``error.InsufficientResourcesException`` if no node could be added
+        and ``error.ReconfigurationError`` if the SLURM controller daemon
+        could not be reconfigured; in this last case the cluster is restored
+        to its previous size.
+        """
+
+        self.log.info('Got a resize request to {0} nodes for {1!r}', size,
+                clusterName)
+
+        try:
+            virtualCluster = self.clusters[clusterName]
+        except KeyError:
+            msg = 'No such cluster: {0!r}'.format(clusterName)
+
+            self.log.error(msg)
+            return defer.fail(error.InvalidClusterName(msg))
+
+        if size < 1:
+            return defer.fail(error.InvalidClusterSize('A virtual cluster ' \
+                    'needs at least one node, destroy it instead'))
+
+        return virtualCluster.lock.run(self.applyResize, virtualCluster, size)
+
+
+    @defer.inlineCallbacks
+    def applyResize(self, virtualCluster, size):
+        delta = size - len(virtualCluster.nodes)
+
+        try:
+            if delta > 0:
+                yield self.growVirtualCluster(virtualCluster, delta)
+            elif delta < 0:
+                yield self.shrinkVirtualCluster(virtualCluster, -delta)
+        finally:
+            if delta and virtualCluster.name in self.clusters:
+                self.recordCluster(virtualCluster)
+
+        defer.returnValue(virtualCluster)
+
+
+    @defer.inlineCallbacks
+    def replaceConfigEntry(self, virtualCluster, oldEntry, rollback):
+        """
+        Replaces ``oldEntry`` with the current configuration entry of
+        ``virtualCluster`` in the SLURM configuration.
+
+        If the SLURM controller daemon can't be reconfigured, ``rollback`` is
+        called to restore the previous nodes of the cluster, the old entry is
+        written back and the ``error.ReconfigurationError`` is raised.
+        """
+
+        newEntry = virtualCluster.getConfigEntry()
+
+        try:
+            yield self.updateSlurmConfig(add=newEntry, remove=oldEntry)
+        except error.ReconfigurationError:
+            reconfigurationFailure = failure.Failure()
+
+            self.log.error('Failed to reconfigure the slurm controller ' \
+                    'daemon, restoring virtual cluster')
+
+            yield rollback()
+            yield self.updateSlurmConfig(add=oldEntry, remove=newEntry,
+                    notify=False)
+
+            reconfigurationFailure.raiseException()
+
+
+    def gatherNodes(self, nodes, minSize):
+        """
+        Waits for the given node deferreds and returns a deferred firing with
+        the list of the nodes which came up in time (see ``NodesGatherer``).
+
+        The wait ends at the latest ``boottimeout`` seconds (defaults to 600)
+        after the nodes were requested, or ``bootgrace`` seconds (defaults to
+        30) after ``minSize`` nodes are up. Finite defaults ensure that a hung
+        node can't stall the request forever; setting an option to ``none``
+        disables the respective deadline.
+        """
+
+        def getDeadline(option, default):
+            value = settings.getOption(self.config, 'vurmctld', option,
+                    default)
+            return None if str(value).lower() == 'none' else float(value)
+
+        return NodesGatherer(self.reactor, nodes, minSize,
+                getDeadline('boottimeout', 600),
+                getDeadline('bootgrace', 30)).deferred
+
+
+    @defer.inlineCallbacks
+    def growVirtualCluster(self, virtualCluster, count):
+        nodes = yield self.allocateNodes(count, virtualCluster.nodeNames)
+
+        nodes = yield self.gatherNodes(nodes, 1)
+
+        if not nodes:
+            msg = 'Not enough resources to grow {0!r}'.format(
+                    virtualCluster.name)
+
+            self.log.error(msg)
+            raise error.InsufficientResourcesException(msg)
+
+        oldEntry = virtualCluster.getConfigEntry()
+        virtualCluster.addNodes(nodes)
+
+        def rollback():
+            virtualCluster.removeNodes(len(nodes))
+            return defer.DeferredList([n.release() for n in nodes])
+
+        yield self.replaceConfigEntry(virtualCluster, oldEntry, rollback)
+        yield defer.DeferredList([n.spawn() for n in nodes])
+
+
     @defer.inlineCallbacks
-    def createVirtualCluster(self, size, minSize=None):
+    def shrinkVirtualCluster(self, virtualCluster, count):
+        oldEntry = virtualCluster.getConfigEntry()
+        nodes = virtualCluster.removeNodes(count)
+
+        def rollback():
+            virtualCluster.addNodes(nodes)
+
+        yield self.replaceConfigEntry(virtualCluster, oldEntry, rollback)
+        yield defer.DeferredList([n.release() for n in nodes])
+
+
+    @defer.inlineCallbacks
+    def createVirtualCluster(self, size, minSize=None, observer=None):
         """
         Creates a new virtual cluster with ``size`` nodes. If there are not
         enough resources, the cluster is still created if at least ``minSize``
         nodes can be allocated (``minSize`` defaults to ``size``).
 
-        The nodes are taken from the first provisioner in the list passed at
-        construction time. If it can't fulfill the request completely, the
-        remaining nodes are taken from the next provisioner and so on.
+        The nodes are requested to the provisioners as described by the
+        ``allocateNodes`` method.
 
         Returns the name of the newly created virtual cluster. This name can
         be used as the value of the ``--partition`` argument when executing the
@@ -185,8 +892,17 @@ class VurmController(object):
         requested nodes to all provisioners, the total number of nodes does
         not meet the ``minSize`` requirement.
 
+        Nodes failing to come up are left out of the cluster, as are the
+        nodes which are not up in time (see ``gatherNodes``); the nodes coming
+        up later are released. The same exception is raised if fewer than
+        ``minSize`` nodes came up.
+
         Raises ``error.ReconfigurationError`` if the cluster configuration
         could not be applied correctly to the running SLURM controller.
+
+        If given, ``observer`` is called with the cluster name, the node name,
+        the new state and the hostname (if known) each time a node changes
+        state, see ``NODE_STATES``.
         """
 
         if minSize is None:
@@ -197,40 +913,56 @@ class VurmController(object):
 
         clusterName = cluster.VirtualCluster.generateClusterName()
         nodeNames = cluster.VirtualCluster.nodeNamesGenerator(clusterName)
-        nodes = []
 
-        # Marked as not covered because of bug #122:
-        # https://bitbucket.org/ned/coveragepy/issue/122/
-        for provisioner in self.provisioners:
-            count = size - len(nodes)
-
-            for node in provisioner.getNodes(count, nodeNames):
-                nodes.append(node.addCallback(resources.INode))
+        def notify(state):
+            def notifyNode(node):
+                observer(clusterName, node.nodeName, state, node.hostname)
+                return node
+            return notifyNode
 
-            got = len(nodes) - size + count
-            self.log.debug('Got {0} nodes from {1}', got, provisioner)
+        def allocating(nodeNames):
+            for nodeName in nodeNames:
+                observer(clusterName, nodeName, NODE_ALLOCATED, None)
+                yield nodeName
 
-            if len(nodes) == size:
-                break
+        if observer is not None:
+            nodes = yield self.allocateNodes(size, allocating(nodeNames))
         else:
-            if len(nodes) < minSize:
-                msg = 'Not enough resources to satisfy request ' \
-                        '({0}/{1})'.format(len(nodes), minSize)
+            nodes = yield self.allocateNodes(size, nodeNames)
+
+        if observer is not None:
+            for node in nodes:
+                node.addCallback(notify(NODE_BOOTED))
+
+        if len(nodes) < minSize:
+            msg = 'Not enough resources to satisfy request ' \
+                    '({0}/{1})'.format(len(nodes), minSize)
+
+            self.log.error(msg)
+
+            for node in nodes:
+                node.addCallback(lambda n: n.release())
+
+            raise error.InsufficientResourcesException(msg)
+
+        self.log.debug('Waiting for the nodes to come up')
 
-                self.log.error(msg)
+        # Failed and late nodes are left out of the cluster
+        nodes = yield self.gatherNodes(nodes, minSize)
 
-                for node in nodes:
-                    node.addCallback(lambda n: n.release())
+        if len(nodes) < minSize:
+            msg = 'Not enough nodes came up to satisfy request ' \
+                    '({0}/{1})'.format(len(nodes), minSize)
 
-                raise error.InsufficientResourcesException(msg)
+            self.log.error(msg)
 
-        self.log.debug('Waiting for all nodes to come up')
+            yield defer.DeferredList([n.release() for n in nodes])
 
-        # Wait for all nodes to be ready
-        nodes = yield defer.gatherResults(nodes)
+            raise error.InsufficientResourcesException(msg)
 
         # Create virtual cluster
-        virtualCluster = cluster.VirtualCluster(nodes, name=clusterName)
+        virtualCluster = cluster.VirtualCluster(nodes, name=clusterName,
+                nodeNames=nodeNames)
         self.clusters[clusterName] = virtualCluster
 
         self.log.debug('Updating SLURM configuration file and restarting ' \
@@ -243,6 +975,7 @@ class VurmController(object):
             # The slurm controller daemon could not be contacted, it is
             # probably not running. Let the client deal with that, but free up
             # the resources requested to the different provisioners before.
+            reconfigurationFailure = failure.Failure()
 
             self.log.error('Failed to reconfigure the slurm controller ' \
                     'daemon, releasing virtual cluster')
@@ -256,10 +989,15 @@ class VurmController(object):
 
             self.log.debug('Virtual cluster shutdown complete, raising to ' \
                     'caller')
-            raise
+            reconfigurationFailure.raiseException()
+
+        yield self.recordCluster(virtualCluster)
 
         # Spawn slurm daemons
-        yield virtualCluster.spawnNodes()
+        if observer is not None:
+            yield virtualCluster.spawnNodes(notify(NODE_SPAWNED))
+        else:
+            yield virtualCluster.spawnNodes()
 
         self.log.info('Virtual cluster creation complete, returning to caller')
 
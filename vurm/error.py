@@ -59,3 +59,55 @@ class ConnectError(RemoteVurmException):
     """
     Raised when a connection attempt fails.
     """
+
+
+
+class OperationTimeout(RemoteVurmException):
+    """
+    Raised when a blocking operation does not complete in the allotted time.
+    """
+
+
+
+class UnknownConfiguration(RemoteVurmException):
+    """
+    Raised when a SLURM configuration is referenced by a digest which does not
+    match any known configuration.
+    """
+
+
+
+class DomainCreationFailed(RemoteVurmException):
+    """
+    Raised when a virtual domain could not be created on a remote host.
+    """
+
+
+
+class DomainDestructionFailed(RemoteVurmException):
+    """
+    Raised when a virtual domain could not be destroyed on a remote host.
+    """
+
+
+
+class UnknownImage(RemoteVurmException):
+    """
+    Raised when a disk image is referenced by a digest which does not match
+    any available image.
+    """
+
+
+
+class RequestRejected(RemoteVurmException):
+    """
+    Raised when a request is rejected because the controller is overloaded.
+    """
+
+
+
+class InvalidClusterSize(RemoteVurmException):
+    """
+    Raised when a virtual cluster is requested to be resized to less than one
+    node.
+    """
@@ -0,0 +1,243 @@
+"""
+Persistent journal of the virtual clusters managed by the controller daemon,
+used to re-adopt the running clusters after a restart.
+"""
+
+
+
+import json
+import os
+
+from twisted.internet import defer, threads
+from twisted.python import failure, filepath
+
+from vurm import logging
+
+
+
+class StateJournal(object):
+    """
+    Append-only log of the state changes of the virtual clusters, stored as
+    one JSON object per line in the file at ``path``.
+
+    Each ``cluster`` event contains the whole state of a cluster (its SLURM
+    configuration entry and the state of each of its nodes) and supersedes
+    the previous ones for the same cluster; a ``destroyed`` event removes a
+    cluster. Once ``compactAfter`` events were appended, the file is
+    atomically replaced by a snapshot containing a single event for each
+    live cluster.
+
+    All the disk I/O is done in the thread pool of the given ``reactor``
+    (defaults to the global reactor), off the reactor thread. Writes are
+    applied in the order they were requested; the events appended while a
+    write is in progress are committed together, sharing the same ``fsync``
+    call.
+    """
+
+    def __init__(self, path, compactAfter=100, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.path = filepath.FilePath(path)
+        self.compactAfter = compactAfter
+        self.reactor = reactor
+
+        self.clusters = {}
+        self.appended = 0
+        self.fh = None
+
+        self.pending = []
+        self.writing = False
+
+        self.log = logging.Logger(__name__, system='journal')
+
+
+    def replay(self):
+        """
+        Reads the journal and returns a dictionary mapping the name of each
+        live cluster to its last recorded state. Lines which can't be parsed
+        (e.g. a write interrupted by a crash) are skipped.
+        """
+
+        self.clusters = {}
+
+        if not self.path.exists():
+            return {}
+
+        with self.path.open() as fh:
+            for line in fh:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    self.log.warning('Skipping corrupted journal entry: ' \
+                            '{0!r}', line)
+                    continue
+
+                if event['event'] == 'cluster':
+                    self.clusters[event['name']] = event
+                elif event['event'] == 'destroyed':
+                    self.clusters.pop(event['name'], None)
+
+        return dict(self.clusters)
+
+
+    def schedule(self, operation, data=None):
+        """
+        Queues a write operation to be run in the thread pool and returns a
+        deferred firing once it has been committed to disk.
+        """
+
+        d = defer.Deferred()
+        self.pending.append((operation, data, d))
+
+        if not self.writing:
+            self.startCommit()
+
+        return d
+
+
+    def startCommit(self):
+        batch, self.pending = self.pending, []
+        self.writing = True
+
+        def committed(result):
+            self.writing = False
+
+            if self.pending:
+                self.startCommit()
+
+            for _, _, d in batch:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(None)
+
+        threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(),
+                self.commit, [(o, data) for o, data, _ in batch]).addBoth(
+                        committed)
+
+
+    def commit(self, operations):
+        """
+        Runs the given list of ``(operation, data)`` tuples. This method
+        blocks and is intended to be run in a separate thread.
+        """
+
+        dirty = False
+
+        for operation, data in operations:
+            if operation == 'append':
+                if self.fh is None:
+                    if not self.path.parent().exists():
+                        self.path.parent().makedirs()
+                    self.fh = open(self.path.path, 'a')
+
+                self.fh.write(data)
+                dirty = True
+            else:
+                if dirty:
+                    self.sync()
+                    dirty = False
+
+                if self.fh is not None:
+                    self.fh.close()
+                    self.fh = None
+
+                if operation == 'snapshot':
+                    self.writeSnapshot(data)
+
+        if dirty:
+            self.sync()
+
+
+    def sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+
+    def writeSnapshot(self, content):
+        temp = self.path.sibling('.{0}.tmp'.format(self.path.basename()))
+
+        with temp.open('w') as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        temp.moveTo(self.path)
+
+
+    def append(self, event):
+        d = self.schedule('append', json.dumps(event) + '\n')
+
+        self.appended += 1
+
+        if self.appended >= self.compactAfter:
+            compacted = self.compact()
+
+            # Fire once the compaction triggered by this event is done too
+            def appended(result):
+                if isinstance(result, failure.Failure):
+                    compacted.addErrback(lambda _: None)
+                    return result
+                return compacted
+
+            d.addBoth(appended)
+
+        return d
+
+
+    def recordCluster(self, name, entry, nodes):
+        """
+        Records the current state of the cluster ``name``, given its SLURM
+        configuration ``entry`` and the list of the states of its ``nodes``.
+        Returns a deferred firing once the event has been committed to disk.
+        """
+
+        event = {
+            'event': 'cluster',
+            'name': name,
+            'entry': entry,
+            'nodes': nodes,
+        }
+
+        self.clusters[name] = event
+        return self.append(event)
+
+
+    def forgetCluster(self, name):
+        """
+        Records the destruction of the cluster ``name``. Returns a deferred
+        firing once the event has been committed to disk.
+        """
+
+        if self.clusters.pop(name, None) is None:
+            return defer.succeed(None)
+
+        return self.append({'event': 'destroyed', 'name': name})
+
+
+    def compact(self):
+        """
+        Replaces the journal by a snapshot of the live clusters. Returns a
+        deferred firing once the snapshot has been committed to disk.
+        """
+
+        self.log.debug('Compacting journal with {0} live clusters',
+                len(self.clusters))
+
+        # The snapshot is taken now, the events appended after this point
+        # will follow it in the file
+        content = ''.join(json.dumps(self.clusters[name]) + '\n'
+                for name in sorted(self.clusters))
+        self.appended = 0
+
+        return self.schedule('snapshot', content)
+
+
+    def close(self):
+        """
+        Closes the journal file once all pending writes were committed.
+        Returns a deferred firing once it is closed.
+        """
+
+        return self.schedule('close')
@@ -102,6 +102,15 @@ class LocalNode(object):
         return self.started
 
 
+    def getConfigAttributes(self):
+        """
+        Returns the attributes of the configuration entry of this node. As
+        each node listens on its own port, nodes are never grouped together.
+        """
+
+        return [('NodeHostname', self.hostname), ('Port', self.port)]
+
+
     def getConfigEntry(self):
         """
         Returns the configuration entry to be added to the SLURM configuration
@@ -224,6 +233,15 @@ class Provisioner(object):
         return Provisioner.__currentPort
 
 
+    def getCapacity(self):
+        """
+        Returns a deferred firing with ``None``, as there are no resource
+        limits on this provider.
+        """
+
+        return defer.succeed(None)
+
+
     def getNodes(self, count, names, **kwargs):
         """
         Returns ``count`` deferreds with their callback already called with a
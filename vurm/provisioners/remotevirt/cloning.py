@@ -0,0 +1,305 @@
+"""
+Backends to create the disk image of a new domain from the base image.
+
+The backend used by the ``vurmd-libvirt`` daemon is selected by the
+``clonebackend`` option; see ``CLONE_BACKENDS`` for the supported values.
+"""
+
+
+
+import errno
+import fcntl
+import os
+import shutil
+import struct
+
+from lxml import etree
+
+from twisted.internet import defer, utils, threads
+from twisted.python import filepath
+
+from vurm import logging, settings
+from vurm.provisioners.remotevirt import libvirt
+
+
+
+FICLONE = 0x40049409
+"""
+The ``ioctl`` request number to share the extents of a file with another one
+on file systems supporting it (btrfs, XFS with reflink support, ...).
+"""
+
+
+
+class CloneError(Exception):
+    def __init__(self, message, output=''):
+        Exception.__init__(self, message)
+        self.output = output
+
+
+
+def getVirtualSize(path):
+    """
+    Returns the size in bytes of the disk contained in the image at ``path``,
+    reading it from the header if the image is in the qcow2 format. This
+    function blocks and is intended to be run in a separate thread.
+    """
+
+    with open(path, 'rb') as fh:
+        header = fh.read(32)
+
+    if len(header) == 32 and header[:4] == 'QFI\xfb':
+        return struct.unpack('>Q', header[24:32])[0]
+
+    return os.path.getsize(path)
+
+
+
+def reflink(source, destination, fallback=True):
+    """
+    Copies the file at ``source`` to ``destination`` by sharing its extents,
+    without copying any data. If the file system does not support it and
+    ``fallback`` is ``True``, the data is copied instead.
+
+    Returns ``True`` if the copy was made by sharing the extents. This
+    function blocks and is intended to be run in a separate thread.
+    """
+
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return True
+            except IOError as e:
+                if not fallback or e.errno not in (errno.EOPNOTSUPP,
+                        errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+                    raise
+
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            return False
+
+
+
+class CommandCloner(object):
+    """
+    Clones images by running the shell command defined by the ``clonebin``
+    option (usually ``qemu-img create``) once for each image.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.config = manager.config
+        self.log = logging.Logger(__name__, system='cloning')
+
+
+    def getCommand(self, source, destination):
+        return self.config.get('vurmd-libvirt', 'clonebin').format(
+                source=source.path, destination=destination.path)
+
+
+    @defer.inlineCallbacks
+    def clone(self, source, destination):
+        """
+        Creates a new image at ``destination`` based on the image at
+        ``source``. Returns a deferred firing with the path of the created
+        image, or failing with a ``CloneError``.
+        """
+
+        cmd = self.getCommand(source, destination)
+        stdout, stderr, exitCode = yield utils.getProcessOutputAndValue('sh',
+                ['-c', cmd], env=os.environ)
+
+        if exitCode:
+            raise CloneError('Clone command exited with status code ' \
+                    '{0}'.format(exitCode), stdout + stderr)
+
+        defer.returnValue(destination)
+
+
+    def remove(self, image):
+        """
+        Removes the image at ``image`` created by ``clone``. Returns a deferred
+        firing with ``True`` if the image was removed, or ``False`` if it did
+        not exist.
+        """
+
+        if not image.exists():
+            return defer.succeed(False)
+
+        image.remove()
+        return defer.succeed(True)
+
+
+
+class BatchCommandCloner(CommandCloner):
+    """
+    Clones images with the ``clonebin`` command as ``CommandCloner`` does, but
+    runs all the commands requested in the same reactor iteration in a single
+    shell process, instead of spawning a new shell for each of them.
+
+    The output of the single commands is discarded.
+    """
+
+    def __init__(self, manager):
+        CommandCloner.__init__(self, manager)
+        self.pending = []
+        self.delayedCall = None
+
+
+    def clone(self, source, destination):
+        d = defer.Deferred()
+        self.pending.append((self.getCommand(source, destination),
+                destination, d))
+
+        if self.delayedCall is None:
+            self.delayedCall = self.manager.reactor.callLater(0, self.flush)
+
+        return d
+
+
+    @defer.inlineCallbacks
+    def flush(self):
+        self.delayedCall = None
+        batch, self.pending = self.pending, []
+
+        self.log.debug('Cloning {0} images in a single batch', len(batch))
+
+        # Report the exit status of each command on its own line
+        script = ''.join('( {0} ) </dev/null >/dev/null 2>&1; ' \
+                'echo $?\n'.format(cmd) for cmd, _, _ in batch)
+
+        stdout, stderr, _ = yield utils.getProcessOutputAndValue('sh',
+                ['-c', script], env=os.environ)
+
+        statuses = stdout.split()
+
+        for i, (_, destination, d) in enumerate(batch):
+            if i >= len(statuses):
+                d.errback(CloneError('Batch clone aborted', stderr))
+            elif statuses[i] != '0':
+                d.errback(CloneError('Clone command exited with status ' \
+                        'code {0}'.format(statuses[i])))
+            else:
+                d.callback(destination)
+
+
+
+class ReflinkCloner(CommandCloner):
+    """
+    Clones images in process by sharing the extents of the base image with
+    the new one, which is immediate on file systems supporting it (btrfs,
+    XFS). Unless the ``reflinkfallback`` option is set to ``false``, the data
+    is copied instead on other file systems.
+    """
+
+    @defer.inlineCallbacks
+    def clone(self, source, destination):
+        fallback = settings.getOption(self.config, 'vurmd-libvirt',
+                'reflinkfallback', True, bool)
+
+        try:
+            shared = yield threads.deferToThread(reflink, source.path,
+                    destination.path, fallback)
+        except (IOError, OSError) as e:
+            if destination.exists():
+                destination.remove()
+            raise CloneError('Image could not be copied: {0}'.format(e))
+
+        if not shared:
+            self.log.debug('File system does not support reflinks, {0} ' \
+                    'was copied', source.path)
+
+        defer.returnValue(destination)
+
+
+
+class StoragePoolCloner(CommandCloner):
+    """
+    Clones images by creating a new qcow2 volume backed by the base image in
+    the libvirt storage pool defined by the ``clonepool`` option. The format
+    of the base image is set by the ``backingformat`` option (defaults to
+    ``qcow2``).
+
+    The new volume is named after the basename of the requested destination,
+    but its actual location is decided by the storage pool.
+    """
+
+    def getVolumeDescription(self, source, destination, capacity):
+        volume = etree.Element('volume')
+        etree.SubElement(volume, 'name').text = destination.basename()
+        etree.SubElement(volume, 'capacity').text = str(capacity)
+
+        target = etree.SubElement(volume, 'target')
+        etree.SubElement(target, 'format', type='qcow2')
+
+        backingStore = etree.SubElement(volume, 'backingStore')
+        etree.SubElement(backingStore, 'path').text = source.path
+        etree.SubElement(backingStore, 'format', type=settings.getOption(
+                self.config, 'vurmd-libvirt', 'backingformat', 'qcow2'))
+
+        return etree.tostring(volume)
+
+
+    @defer.inlineCallbacks
+    def clone(self, source, destination):
+        poolName = self.config.get('vurmd-libvirt', 'clonepool')
+
+        try:
+            capacity = yield threads.deferToThread(getVirtualSize,
+                    source.path)
+        except (IOError, OSError) as e:
+            raise CloneError('Base image could not be read: {0}'.format(e))
+
+        description = self.getVolumeDescription(source, destination, capacity)
+
+        def createVolume():
+            with self.manager.getHypervisor() as conn:
+                pool = conn.storagePoolLookupByName(poolName)
+                return pool.createXML(description, 0).path()
+
+        try:
+            path = yield self.manager.executor.run(createVolume)
+        except libvirt.LibvirtError as e:
+            raise CloneError('Volume could not be created in storage pool ' \
+                    '{0}: {1}'.format(poolName, e.get_error_message()))
+
+        defer.returnValue(filepath.FilePath(path))
+
+
+    @defer.inlineCallbacks
+    def remove(self, image):
+        """
+        Deletes the volume at ``image`` through libvirt, so that it is removed
+        from the storage pool as well. Images unknown to libvirt are removed
+        from the file system instead.
+        """
+
+        def deleteVolume():
+            with self.manager.getHypervisor() as conn:
+                try:
+                    volume = conn.storageVolLookupByPath(image.path)
+                except libvirt.LibvirtError:
+                    return False
+                volume.delete(0)
+                return True
+
+        deleted = yield self.manager.executor.run(deleteVolume)
+
+        if deleted:
+            defer.returnValue(True)
+
+        removed = yield CommandCloner.remove(self, image)
+        defer.returnValue(removed)
+
+
+
+CLONE_BACKENDS = {
+    'command': CommandCloner,
+    'batch': BatchCommandCloner,
+    'reflink': ReflinkCloner,
+    'pool': StoragePoolCloner,
+}
+"""
+Maps the values accepted by the ``clonebackend`` option of the
+``vurmd-libvirt`` section to the respective cloner class.
+"""
@@ -2,8 +2,13 @@ from twisted.protocols import amp
 
 from lxml import etree
 
+from vurm import error
 
-__all__ = ['CreateDomain', 'DestroyDomain', 'SpawnSlurmDaemon', ]
+
+__all__ = ['CreateDomain', 'DestroyDomain', 'CreateDomains',
+        'DestroyDomains', 'ListDomains', 'DomainCreated', 'SpawnSlurmDaemon',
+        'PushSlurmConfig', 'GetCapacity', 'HasImage', 'ReadImageChunk',
+        'FetchImage', ]
 
 
 
@@ -35,8 +40,128 @@ class DestroyDomain(amp.Command):
 
 
 
+class CreateDomains(amp.Command):
+    arguments = [
+        ('description', XMLDocument()),
+        ('nodeNames', amp.AmpList([
+            ('nodeName', amp.String()),
+        ])),
+    ]
+    response = [
+        ('domains', amp.AmpList([
+            ('nodeName', amp.String()),
+            ('hostname', amp.String(optional=True)),
+            ('error', amp.Unicode(optional=True)),
+        ])),
+    ]
+
+
+
+class DestroyDomains(amp.Command):
+    arguments = [
+        ('nodeNames', amp.AmpList([
+            ('nodeName', amp.String()),
+        ])),
+    ]
+    response = [
+        ('domains', amp.AmpList([
+            ('nodeName', amp.String()),
+            ('error', amp.Unicode(optional=True)),
+        ])),
+    ]
+
+
+
+class ListDomains(amp.Command):
+    response = [
+        ('domains', amp.AmpList([
+            ('nodeName', amp.String()),
+            ('hostname', amp.String()),
+        ])),
+    ]
+
+
+
+class DomainCreated(amp.Command):
+    arguments = [
+        ('nodeName', amp.String()),
+        ('hostname', amp.String()),
+    ]
+    requiresAnswer = False
+
+
+
 class SpawnSlurmDaemon(amp.Command):
     arguments = [
         ('nodeName', amp.String()),
+        ('slurmConfig', amp.String(optional=True)),
+        ('configDigest', amp.String(optional=True)),
+    ]
+    errors = {
+        error.UnknownConfiguration: 'UNKNOWN_CONFIGURATION',
+    }
+
+
+
+class PushSlurmConfig(amp.Command):
+    arguments = [
+        ('digest', amp.String()),
         ('slurmConfig', amp.String()),
     ]
+    errors = {
+        error.UnknownConfiguration: 'UNKNOWN_CONFIGURATION',
+    }
+
+
+
+class GetCapacity(amp.Command):
+    response = [
+        ('domains', amp.Integer()),
+        ('cpus', amp.Integer()),
+        ('memory', amp.Integer()),
+        ('freeMemory', amp.Integer()),
+        ('maxDomains', amp.Integer(optional=True)),
+        ('libvirtPending', amp.Integer(optional=True)),
+        ('libvirtRunning', amp.Integer(optional=True)),
+        ('libvirtLatency', amp.Float(optional=True)),
+        ('libvirtMaxLatency', amp.Float(optional=True)),
+    ]
+
+
+
+class HasImage(amp.Command):
+    arguments = [
+        ('digest', amp.String()),
+    ]
+    response = [
+        ('size', amp.Integer(optional=True)),
+    ]
+
+
+
+class ReadImageChunk(amp.Command):
+    arguments = [
+        ('digest', amp.String()),
+        ('offset', amp.Integer()),
+        ('length', amp.Integer()),
+    ]
+    response = [
+        ('data', amp.String()),
+    ]
+    errors = {
+        error.UnknownImage: 'UNKNOWN_IMAGE',
+    }
+
+
+
+class FetchImage(amp.Command):
+    arguments = [
+        ('digest', amp.String()),
+        ('size', amp.Integer()),
+        ('sources', amp.AmpList([
+            ('endpoint', amp.String()),
+        ])),
+    ]
+    errors = {
+        error.UnknownImage: 'UNKNOWN_IMAGE',
+    }
@@ -0,0 +1,384 @@
+"""
+Content addressed distribution and caching of the base disk images of the
+domains.
+
+Images are identified by the SHA-1 digest of their content. Each
+``vurmd-libvirt`` daemon keeps the images it received in an ``ImageCache``;
+the provisioner rolls new images out to the hosts with an
+``ImageDistributor``, letting each host fetch the image in chunks from all
+the hosts which already have it.
+"""
+
+
+
+import collections
+import hashlib
+import os
+import re
+import threading
+
+from twisted.internet import defer, threads
+from twisted.python import filepath, failure
+
+from vurm import logging, error
+from vurm.provisioners.remotevirt import commands
+
+
+
+CHUNK_SIZE = 60000
+"""
+The size of the image chunks transferred between hosts. It has to fit in a
+single AMP value (at most 65535 bytes).
+"""
+
+
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+
+def isDigest(name):
+    """
+    Returns ``True`` if ``name`` is formatted as a SHA-1 hex digest.
+    """
+
+    return DIGEST_RE.match(name) is not None
+
+
+
+def hashFile(path):
+    """
+    Returns the SHA-1 hex digest of the content of the file at ``path``. This
+    function blocks and is intended to be run in a separate thread.
+    """
+
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), ''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+
+def readChunk(path, offset, length):
+    """
+    Returns ``length`` bytes of the file at ``path``, starting at ``offset``.
+    This function blocks and is intended to be run in a separate thread.
+    """
+
+    with open(path, 'rb') as fh:
+        fh.seek(offset)
+        return fh.read(length)
+
+
+
+def writeChunk(fh, lock, offset, data):
+    """
+    Writes ``data`` at ``offset`` in the file ``fh``, shared by the threads
+    holding ``lock``. This function blocks and is intended to be run in a
+    separate thread.
+    """
+
+    with lock:
+        fh.seek(offset)
+        fh.write(data)
+
+
+
+def syncFile(fh):
+    """
+    Flushes the file ``fh`` to disk. This function blocks and is intended to
+    be run in a separate thread.
+    """
+
+    fh.flush()
+    os.fsync(fh.fileno())
+
+
+
+class ImageCache(object):
+    """
+    Stores images in ``directory``, each one in a file named after its
+    digest.
+
+    If ``maxSize`` (in bytes) is given, the least recently used images are
+    removed as soon as the total size of the cache exceeds it. Images in use
+    by a domain can be pinned to prevent their removal.
+    """
+
+    def __init__(self, directory, maxSize=None):
+        self.directory = filepath.FilePath(directory)
+        self.maxSize = maxSize
+
+        self.images = collections.OrderedDict()
+        self.pins = collections.defaultdict(int)
+
+        if not self.directory.exists():
+            self.directory.makedirs()
+
+        # Least recently modified first
+        children = sorted(self.directory.children(),
+                key=lambda c: c.getModificationTime())
+
+        for child in children:
+            if isDigest(child.basename()):
+                self.images[child.basename()] = child.getsize()
+
+
+    def has(self, digest):
+        return digest in self.images
+
+
+    def getSize(self, digest):
+        return self.images[digest]
+
+
+    def touch(self, digest):
+        self.images[digest] = self.images.pop(digest)
+
+
+    def getPath(self, digest):
+        """
+        Returns the path of the image with the given digest and marks it as
+        the most recently used one.
+        """
+
+        if digest not in self.images:
+            raise error.UnknownImage('No image with digest {0}'.format(
+                    digest))
+
+        self.touch(digest)
+        return self.directory.child(digest)
+
+
+    def getTemporaryPath(self, digest):
+        return self.directory.child('.{0}.part'.format(digest))
+
+
+    def pin(self, digest):
+        self.touch(digest)
+        self.pins[digest] += 1
+
+
+    def unpin(self, digest):
+        self.pins[digest] -= 1
+
+        if self.pins[digest] <= 0:
+            del self.pins[digest]
+            self.evict()
+
+
+    def add(self, digest, path):
+        """
+        Moves the file at ``path`` (which has to be on the same file system)
+        into the cache as the image with the given digest.
+        """
+
+        path.moveTo(self.directory.child(digest))
+        self.images[digest] = self.directory.child(digest).getsize()
+        self.evict(keep=digest)
+
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used unpinned images, apart from the one
+        with the ``keep`` digest, until the cache does not exceed its maximum
+        size.
+        """
+
+        if self.maxSize is None:
+            return
+
+        total = sum(self.images.itervalues())
+
+        for digest in list(self.images):
+            if total <= self.maxSize:
+                break
+
+            if self.pins.get(digest) or digest == keep:
+                continue
+
+            self.directory.child(digest).remove()
+            total -= self.images.pop(digest)
+
+
+    def readChunk(self, digest, offset, length):
+        """
+        Returns a deferred firing with at most ``length`` bytes of the image
+        with the given digest, starting at ``offset``, read in a separate
+        thread.
+        """
+
+        return threads.deferToThread(readChunk, self.getPath(digest).path,
+                offset, min(length, CHUNK_SIZE))
+
+
+
+class ImageFetcher(object):
+    """
+    Fetches images into an ``ImageCache`` from other hosts, keeping up to
+    ``window`` chunk requests in flight, spread in a round-robin fashion over
+    all the given sources.
+    """
+
+    def __init__(self, cache, window=8):
+        self.cache = cache
+        self.window = window
+        self.fetching = {}
+
+        self.log = logging.Logger(__name__, system='images')
+
+
+    def fetch(self, digest, size, sources):
+        """
+        Fetches the image with the given digest and size from ``sources``, a
+        list of AMP connections to hosts which have it. Concurrent requests for
+        the same image share the same transfer.
+        """
+
+        if self.cache.has(digest):
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+
+        if digest in self.fetching:
+            self.fetching[digest].append(d)
+            return d
+
+        waiters = self.fetching[digest] = [d]
+
+        def done(result):
+            del self.fetching[digest]
+
+            for waiter in waiters:
+                if isinstance(result, failure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(None)
+
+        self.transfer(digest, size, sources).addBoth(done)
+
+        return d
+
+
+    @defer.inlineCallbacks
+    def transfer(self, digest, size, sources):
+        self.log.info('Fetching image {0} ({1} bytes) from {2} sources',
+                digest, size, len(sources))
+
+        offsets = iter(xrange(0, size, CHUNK_SIZE))
+        temp = self.cache.getTemporaryPath(digest)
+        lock = threading.Lock()
+
+        # Disk writes happen in separate threads to keep the reactor free to
+        # serve the other requests during the transfer
+        @defer.inlineCallbacks
+        def worker(fh, source):
+            for offset in offsets:
+                response = yield source.callRemote(commands.ReadImageChunk,
+                        digest=digest, offset=offset, length=CHUNK_SIZE)
+                yield threads.deferToThread(writeChunk, fh, lock, offset,
+                        response['data'])
+
+        try:
+            with temp.open('w') as fh:
+                results = yield defer.DeferredList([
+                    worker(fh, sources[i % len(sources)])
+                    for i in range(self.window)
+                ], consumeErrors=True)
+
+                for success, result in results:
+                    if not success:
+                        result.raiseException()
+
+                yield threads.deferToThread(syncFile, fh)
+
+            actual = yield threads.deferToThread(hashFile, temp.path)
+
+            if actual != digest:
+                raise error.UnknownImage('Fetched image has digest {0} ' \
+                        'instead of {1}'.format(actual, digest))
+        except:
+            if temp.exists():
+                temp.remove()
+            raise
+
+        self.cache.add(digest, temp)
+
+
+
+class ImageDistributor(object):
+    """
+    Rolls images out to the hosts of a ``spread.ReconnectingConnectionsPool``.
+
+    The hosts which do not have an image yet receive it in waves: in each
+    wave, as many hosts as already have the image fetch it, each of them from
+    all the hosts of the previous waves. The number of copies thus doubles at
+    each wave, instead of all the hosts fetching from a single source.
+    """
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.log = logging.Logger(__name__, system='images')
+
+
+    @defer.inlineCallbacks
+    def query(self, endpoint, digest):
+        remote = yield self.connections.getConnection(endpoint)
+        response = yield remote.callRemote(commands.HasImage, digest=digest)
+        defer.returnValue(response.get('size'))
+
+
+    @defer.inlineCallbacks
+    def fetch(self, endpoint, digest, size, sources):
+        remote = yield self.connections.getConnection(endpoint)
+        yield remote.callRemote(commands.FetchImage, digest=digest, size=size,
+                sources=[{'endpoint': e} for e in sources])
+
+
+    @defer.inlineCallbacks
+    def distribute(self, digest, targets):
+        """
+        Makes sure that all the hosts in ``targets`` have the image with the
+        given digest. Returns a deferred firing with the list of the targets
+        which have the image.
+
+        Raises an ``error.UnknownImage`` exception if no host has the image.
+        """
+
+        endpoints = sorted(self.connections.endpoints)
+        results = yield defer.DeferredList([self.query(e, digest)
+                for e in endpoints], consumeErrors=True)
+
+        size, sources = None, []
+
+        for endpoint, (success, result) in zip(endpoints, results):
+            if success and result is not None:
+                size = result
+                sources.append(endpoint)
+
+        missing = [t for t in sorted(set(targets)) if t not in sources]
+
+        if missing and not sources:
+            raise error.UnknownImage('No host has image {0}'.format(digest))
+
+        while missing:
+            wave, missing = missing[:len(sources)], missing[len(sources):]
+
+            self.log.info('Distributing image {0} to {1} hosts from {2} ' \
+                    'sources', digest, len(wave), len(sources))
+
+            results = yield defer.DeferredList([self.fetch(target, digest,
+                    size, sources) for target in wave], consumeErrors=True)
+
+            for target, (success, result) in zip(wave, results):
+                if success:
+                    sources.append(target)
+                else:
+                    self.log.error('Image {0} could not be distributed to ' \
+                            '{1}: {2}', digest, target,
+                            result.getErrorMessage())
+
+        defer.returnValue([t for t in targets if t in sources])
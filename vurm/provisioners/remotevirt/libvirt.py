@@ -4,6 +4,8 @@ Abstractions to make working with libvirt feel more pythonic.
 
 from __future__ import absolute_import
 
+import threading
+
 import libvirt
 
 from lxml import etree
@@ -16,7 +18,7 @@ from twisted.python import filepath
 # pylint: disable-msg=E1101
 
 
-__all__ = ['open', 'DomainDescription', 'LibvirtError']
+__all__ = ['open', 'ConnectionPool', 'DomainDescription', 'LibvirtError']
 
 
 LibvirtError = libvirt.libvirtError
@@ -37,6 +39,118 @@ open = LibvirtConnectionContextManager
 
 
 
+class PooledConnectionContextManager(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection = pool.acquire()
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        broken = exc_type is not None and issubclass(exc_type, LibvirtError)
+        self.pool.release(self.connection, broken)
+
+
+
+class ConnectionPool(object):
+    """
+    A bounded, thread safe pool of long-lived connections to the hypervisor
+    identified by ``connectionURI``.
+
+    Connections are health-checked before being handed out; connections
+    which raised a ``LibvirtError`` while borrowed are closed instead of being
+    returned to the pool, so that the next request reconnects.
+    """
+
+    def __init__(self, connectionURI, size=4):
+        self.connectionURI = connectionURI
+        self.idle = []
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(size)
+
+
+    def isAlive(self, connection):
+        try:
+            if hasattr(connection, 'isAlive'):
+                return connection.isAlive()
+
+            connection.getLibVersion()
+            return True
+        except LibvirtError:
+            return False
+
+
+    def closeQuietly(self, connection):
+        try:
+            connection.close()
+        except LibvirtError:
+            pass
+
+
+    def acquire(self):
+        """
+        Borrows a connection from the pool, opening a new one if no idle
+        connection is available. Blocks if ``size`` connections are already
+        borrowed.
+        """
+
+        self.semaphore.acquire()
+
+        try:
+            while True:
+                with self.lock:
+                    connection = self.idle.pop() if self.idle else None
+
+                if connection is None:
+                    return libvirt.open(self.connectionURI)
+
+                if self.isAlive(connection):
+                    return connection
+
+                self.closeQuietly(connection)
+        except:
+            self.semaphore.release()
+            raise
+
+
+    def release(self, connection, broken=False):
+        """
+        Gives a borrowed connection back to the pool, or closes it if it is
+        ``broken``.
+        """
+
+        if broken:
+            self.closeQuietly(connection)
+        else:
+            with self.lock:
+                self.idle.append(connection)
+
+        self.semaphore.release()
+
+
+    def connection(self):
+        """
+        Returns a context manager borrowing a connection from the pool for the
+        duration of the ``with`` block.
+        """
+
+        return PooledConnectionContextManager(self)
+
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for connection in idle:
+            self.closeQuietly(connection)
+
+
+
 class DomainDescription(object):
 
     def __init__(self, xml):
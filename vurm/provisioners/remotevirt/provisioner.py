@@ -1,13 +1,16 @@
 
+import os
+
 from lxml import etree
 
 from twisted.internet import defer
 from twisted.protocols import amp
+from twisted.python import failure
 
 from zope.interface import implements
 
-from vurm import resources, logging, spread
-from vurm.provisioners.remotevirt import commands
+from vurm import resources, logging, spread, slurm, settings, error
+from vurm.provisioners.remotevirt import commands, images
 
 
 
@@ -16,38 +19,395 @@ class VirtualNode(object):
     implements(resources.INode)
 
 
-    def __init__(self, provisioner, connectionProvider, nodeName, hostname):
+    def __init__(self, provisioner, connectionProvider, nodeName, hostname,
+            endpoint=None):
         self.connectionProvider = connectionProvider
         self.provisioner = provisioner
         self.nodeName = nodeName
         self.hostname = hostname
+        self.endpoint = endpoint
+
+
+    def getState(self):
+        return {
+            'nodeName': self.nodeName,
+            'hostname': self.hostname,
+            'endpoint': self.endpoint,
+        }
 
 
     @defer.inlineCallbacks
     def spawn(self):
-        configPath = self.provisioner.config.get('vurmctld', 'slurmconfig')
-        with open(configPath) as fh:
-            config = fh.read()
+        digest, config = self.provisioner.getSlurmConfig()
+
+        yield self.provisioner.pushSlurmConfig(self.connectionProvider,
+                digest, config)
 
         remote = yield self.connectionProvider.getConnection()
-        yield remote.callRemote(commands.SpawnSlurmDaemon,
-                nodeName=self.nodeName, slurmConfig=config)
+
+        try:
+            yield remote.callRemote(commands.SpawnSlurmDaemon,
+                    nodeName=self.nodeName, configDigest=digest)
+        except error.UnknownConfiguration:
+            # The host lost its cache (e.g. it was restarted), push again
+            yield self.provisioner.pushSlurmConfig(self.connectionProvider,
+                    digest, config, force=True)
+            yield remote.callRemote(commands.SpawnSlurmDaemon,
+                    nodeName=self.nodeName, configDigest=digest)
+
         defer.returnValue(self)
 
 
     @defer.inlineCallbacks
     def release(self):
-        remote = yield self.connectionProvider.getConnection()
-        yield remote.callRemote(commands.DestroyDomain, nodeName=self.nodeName)
+        yield self.provisioner.destroyDomain(self.connectionProvider,
+                self.nodeName)
         defer.returnValue(self)
 
 
+    def getConfigAttributes(self):
+        return [('NodeHostname', self.hostname)]
+
+
     def getConfigEntry(self):
         return 'NodeName={0} NodeHostname={1}'.format(self.nodeName,
                 self.hostname)
 
 
 
+class DomainManagerClient(amp.AMP):
+    """
+    Client side of the connection to a ``vurmd-libvirt`` daemon, notified of
+    each domain of a ``CreateDomains`` batch as soon as it is up.
+    """
+
+    def __init__(self, *args, **kwargs):
+        amp.AMP.__init__(self, *args, **kwargs)
+        self.observers = {}
+
+
+    def observeDomain(self, nodeName, observer):
+        """
+        Registers ``observer`` to be called with the hostname of the domain
+        of ``nodeName`` once created.
+        """
+
+        self.observers[nodeName] = observer
+
+
+    @commands.DomainCreated.responder
+    def domainCreated(self, nodeName, hostname):
+        observer = self.observers.pop(nodeName, None)
+
+        if observer is not None:
+            observer(hostname)
+
+        return {}
+
+
+
+MEMORY_UNITS = {
+    'b': 1.0 / 1024, 'bytes': 1.0 / 1024,
+    'k': 1, 'kib': 1, 'kb': 1000.0 / 1024,
+    'm': 1024, 'mib': 1024, 'mb': 1000.0 ** 2 / 1024,
+    'g': 1024 ** 2, 'gib': 1024 ** 2, 'gb': 1000.0 ** 3 / 1024,
+}
+"""
+Factors to convert the units supported by libvirt for the ``memory`` element
+of a domain description to KiB.
+"""
+
+
+
+def getDomainResources(description):
+    """
+    Returns a ``(memory, vcpus)`` tuple with the memory (in KiB, or ``None``
+    if not specified) and the number of virtual CPUs requested by the given
+    domain description.
+    """
+
+    memory = description.find('memory')
+
+    if memory is not None:
+        unit = MEMORY_UNITS[memory.get('unit', 'KiB').lower()]
+        memory = int(int(memory.text) * unit)
+
+    vcpus = description.find('vcpu')
+    vcpus = 1 if vcpus is None else int(vcpus.text)
+
+    return memory, vcpus
+
+
+
+class DomainTemplate(object):
+    """
+    Caches the parsed domain description read from the file at ``path``,
+    parsing it again only when the file is modified.
+
+    The cached tree is shared between all the callers and must not be
+    modified; the per-node copies are made by the ``vurmd-libvirt`` daemon
+    when it receives the description along with the list of node names.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stat = None
+        self.description = None
+        self.resources = None
+
+
+    def get(self):
+        """
+        Returns the parsed domain description.
+        """
+
+        st = os.stat(self.path)
+        stat = (st.st_mtime, st.st_size)
+
+        if stat != self.stat:
+            with open(self.path) as fh:
+                self.description = etree.parse(fh)
+
+            self.resources = getDomainResources(self.description)
+            self.stat = stat
+
+        return self.description
+
+
+    def getImageDigest(self):
+        """
+        Returns the digest of the root disk image if the image is content
+        addressed (i.e. its file is named after its SHA-1 digest), ``None``
+        otherwise.
+        """
+
+        source = self.get().find('devices/disk[@device="disk"]/source[@file]')
+
+        if source is not None:
+            name = os.path.basename(source.get('file'))
+
+            if images.isDigest(name):
+                return name
+
+
+    def getResources(self):
+        """
+        Returns the ``(memory, vcpus)`` tuple requested by the domain
+        description.
+        """
+
+        self.get()
+        return self.resources
+
+
+
+class PlacementEngine(object):
+    """
+    Chooses the physical host on which each new domain is created, based on
+    the capacity reported by the ``vurmd-libvirt`` daemon running on it.
+
+    Capacity reports are cached for ``ttl`` seconds. Domains whose creation is
+    in progress are accounted for until the next report includes them.
+
+    The supported strategies are ``spread`` (choose the host with the most free
+    slots), ``pack`` (choose the host with the fewest free slots, keeping
+    bigger hosts available for bigger requests) and ``roundrobin`` (rotate
+    across the hosts, ignoring their capacity).
+    """
+
+    def __init__(self, reactor, connections, strategy='spread', ttl=10,
+            cpuRatio=1.0):
+        if strategy not in ('spread', 'pack', 'roundrobin'):
+            raise ValueError('Unknown placement strategy: {0!r}'.format(
+                    strategy))
+
+        self.reactor = reactor
+        self.connections = connections
+        self.strategy = strategy
+        self.ttl = ttl
+        self.cpuRatio = cpuRatio
+
+        self.log = logging.Logger(__name__, system='placement')
+
+        self.reports = {}
+        self.reserved = dict((e, 0) for e in connections.endpoints)
+        self.timestamp = None
+        self.waiting = None
+
+
+    def isFresh(self):
+        return self.timestamp is not None and \
+                self.reactor.seconds() - self.timestamp < self.ttl
+
+
+    def invalidate(self):
+        self.timestamp = None
+
+
+    def refresh(self):
+        """
+        Queries the capacity of all hosts concurrently. Returns a deferred
+        which fires once all reports were received; concurrent calls share
+        the same queries.
+        """
+
+        d = defer.Deferred()
+
+        if self.waiting is not None:
+            self.waiting.append(d)
+            return d
+
+        self.waiting = [d]
+
+        def query(endpoint):
+            d = self.connections.getConnection(endpoint)
+            d.addCallback(lambda conn: conn.callRemote(commands.GetCapacity))
+            return d
+
+        endpoints = sorted(self.connections.endpoints)
+
+        def gotReports(results):
+            self.reports = {}
+
+            for endpoint, (success, result) in zip(endpoints, results):
+                if success:
+                    self.reports[endpoint] = result
+
+                    if result.get('libvirtPending') is not None:
+                        self.log.debug('{0}: {1} libvirt calls queued, {2} ' \
+                                'running, {3:.3f}s average latency', endpoint,
+                                result['libvirtPending'],
+                                result['libvirtRunning'],
+                                result['libvirtLatency'])
+                else:
+                    self.log.warning('Could not get the capacity of {0}: {1}',
+                            endpoint, result.getErrorMessage())
+                    self.reports[endpoint] = None
+
+            self.timestamp = self.reactor.seconds()
+
+            waiting, self.waiting = self.waiting, None
+
+            for d in waiting:
+                d.callback(None)
+
+        dl = defer.DeferredList([query(e) for e in endpoints],
+                consumeErrors=True)
+        dl.addCallback(gotReports)
+
+        return d
+
+
+    def getSlots(self, endpoint, memory, vcpus):
+        """
+        Returns the number of domains with the given resources which can still
+        be created on the given host, or ``None`` if its capacity is unknown.
+        """
+
+        report = self.reports.get(endpoint)
+
+        if report is None:
+            return None
+
+        domains = report['domains'] + self.reserved[endpoint]
+
+        limits = [int(report['cpus'] * self.cpuRatio) // vcpus - domains]
+
+        if memory:
+            limits.append(report['freeMemory'] // memory -
+                    self.reserved[endpoint])
+
+        if report.get('maxDomains') is not None:
+            limits.append(report['maxDomains'] - domains)
+
+        return max(0, min(limits))
+
+
+    def getCachedCapacity(self, memory=None, vcpus=1):
+        """
+        Returns the total number of domains with the given resources which can
+        still be created according to the cached reports, or ``None`` if the
+        reports are stale or the capacity of at least one host is unknown.
+        """
+
+        if self.strategy == 'roundrobin' or not self.isFresh():
+            return None
+
+        slots = [self.getSlots(e, memory, vcpus) for e in self.reserved]
+
+        if None in slots:
+            return None
+
+        return sum(slots)
+
+
+    @defer.inlineCallbacks
+    def getCapacity(self, memory=None, vcpus=1):
+        """
+        Same as ``getCachedCapacity`` but refreshes the reports if needed.
+        """
+
+        if not self.isFresh():
+            yield self.refresh()
+
+        defer.returnValue(self.getCachedCapacity(memory, vcpus))
+
+
+    def choose(self, memory, vcpus):
+        endpoints = sorted(self.reserved)
+
+        if self.strategy == 'roundrobin':
+            # Keep rotating across calls, reservations are released as soon
+            # as each domain is created
+            return next(self.connections.endpointsRoundRobin)
+
+        slots = [(self.getSlots(e, memory, vcpus), e) for e in endpoints]
+        available = [(free, e) for free, e in slots if free]
+
+        if available:
+            if self.strategy == 'spread':
+                return max(available, key=lambda s: s[0])[1]
+            else:
+                return min(available, key=lambda s: s[0])[1]
+
+        # Fall back to the hosts whose capacity is unknown, if any
+        unknown = [e for free, e in slots if free is None]
+
+        if unknown:
+            return min(unknown, key=lambda e: self.reserved[e])
+
+
+    @defer.inlineCallbacks
+    def reserve(self, memory=None, vcpus=1):
+        """
+        Chooses a host for a new domain with the given resources and returns a
+        deferred firing with its endpoint. The ``release`` method has to be
+        called with the same endpoint once the domain was created (or its
+        creation failed).
+
+        Raises ``error.InsufficientResourcesException`` if no host has enough
+        free resources left.
+        """
+
+        if self.strategy != 'roundrobin' and not self.isFresh():
+            yield self.refresh()
+
+        endpoint = self.choose(memory, vcpus)
+
+        if endpoint is None:
+            raise error.InsufficientResourcesException('No hypervisor has ' \
+                    'enough free resources left')
+
+        self.reserved[endpoint] += 1
+        defer.returnValue(endpoint)
+
+
+    def release(self, endpoint):
+        self.reserved[endpoint] -= 1
+        self.invalidate()
+
+
+
 class Provisioner(object):
 
     implements(resources.IResourceProvisioner)
@@ -56,40 +416,342 @@ class Provisioner(object):
     def __init__(self, reactor, config):
         self.log = logging.Logger(__name__)
 
-        self.nodes = spread.ReconnectingConnectionsPool(reactor, amp.AMP,
-                config.get('libvirt', 'nodes').splitlines())
+        self.nodes = spread.ReconnectingConnectionsPool(reactor,
+                DomainManagerClient, config.get('libvirt', 'nodes').splitlines())
         self.nodes.start()
 
+        self.placement = PlacementEngine(reactor, self.nodes,
+                settings.getOption(config, 'libvirt', 'placement', 'spread'),
+                settings.getOption(config, 'libvirt', 'capacityttl', 10,
+                        float),
+                settings.getOption(config, 'libvirt', 'cpuratio', 1.0, float))
+
         self.reactor = reactor
         self.config = config
 
+        self.template = DomainTemplate(config.get('libvirt', 'domainXML'))
+        self.imageDistributor = images.ImageDistributor(self.nodes)
+
+        self.slurmConfig = None
+        self.pushedConfigs = {}
+        self.pushing = {}
+
+        self.releases = {}
+        self.releaseCall = None
+
+
+    def getSlurmConfig(self):
+        """
+        Returns a ``(digest, content)`` tuple for the current SLURM
+        configuration. The configuration files are only read again when they
+        change.
+        """
+
+        if self.slurmConfig is None:
+            self.slurmConfig = slurm.ConfigReader(self.config.get('vurmctld',
+                    'slurmconfig'))
+
+        return self.slurmConfig.read()
+
+
+    def pushSlurmConfig(self, connectionProvider, digest, config,
+            force=False):
+        """
+        Sends the SLURM configuration identified by ``digest`` to the host
+        behind ``connectionProvider``, unless it was already sent there.
+        Concurrent calls for the same host and digest share the same request.
+        """
+
+        if not force and self.pushedConfigs.get(connectionProvider) == digest:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        key = (connectionProvider, digest)
+
+        if key in self.pushing:
+            self.pushing[key].append(d)
+            return d
+
+        waiters = self.pushing[key] = [d]
+
+        def push(remote):
+            return remote.callRemote(commands.PushSlurmConfig, digest=digest,
+                    slurmConfig=config)
+
+        def pushed(result):
+            del self.pushing[key]
+
+            if not isinstance(result, failure.Failure):
+                self.pushedConfigs[connectionProvider] = digest
+                result = None
+
+            for waiter in waiters:
+                if isinstance(result, failure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+
+        connectionProvider.getConnection().addCallback(push).addBoth(pushed)
+
+        return d
+
+
+    def getDomainDescription(self):
+        """
+        Returns the (shared, read-only) domain description template.
+        """
+
+        return self.template.get()
+
+
+    def getCapacity(self):
+        return self.placement.getCapacity(*self.template.getResources())
+
+
+    @defer.inlineCallbacks
+    def createDomains(self, endpoint, description, batch):
+        """
+        Creates a domain on the host at ``endpoint`` for each ``(nodeName,
+        deferred)`` tuple in ``batch`` with a single ``CreateDomains`` call.
+        Each deferred fires with its ``VirtualNode`` as soon as the host
+        reports the domain as created.
+        """
+
+        waiting = dict(batch)
+
+        def created(hostname, nodeName):
+            d = waiting.pop(nodeName)
+            d.callback(VirtualNode(self, node.factory, nodeName, hostname,
+                    endpoint))
+
+        try:
+            node = yield self.nodes.getConnection(endpoint)
+
+            for nodeName in waiting:
+                node.observeDomain(nodeName, lambda hostname, n=nodeName:
+                        created(hostname, n))
+
+            response = yield node.callRemote(commands.CreateDomains,
+                    description=description,
+                    nodeNames=[{'nodeName': n} for n, _ in batch])
+        except Exception:
+            reason = failure.Failure()
+
+            for nodeName, d in waiting.items():
+                del waiting[nodeName]
+                d.errback(reason)
+        else:
+            for domain in response['domains']:
+                nodeName = domain['nodeName']
+                node.observers.pop(nodeName, None)
+
+                if nodeName not in waiting:
+                    continue
+
+                if domain.get('hostname') is not None:
+                    created(domain['hostname'], nodeName)
+                else:
+                    waiting.pop(nodeName).errback(error.DomainCreationFailed(
+                            domain.get('error') or 'Unknown error'))
+        finally:
+            for _ in batch:
+                self.placement.release(endpoint)
+
+
+    def destroyDomain(self, connectionProvider, nodeName):
+        """
+        Destroys the domain of ``nodeName`` on the host behind
+        ``connectionProvider``. Requests issued in the same reactor iteration
+        are sent as a single ``DestroyDomains`` call per host.
+        """
+
+        d = defer.Deferred()
+        self.releases.setdefault(connectionProvider, []).append((nodeName, d))
+
+        if self.releaseCall is None:
+            self.releaseCall = self.reactor.callLater(0, self.flushReleases)
+
+        return d
+
+
+    def flushReleases(self):
+        self.releaseCall = None
+        releases, self.releases = self.releases, {}
+
+        for connectionProvider, batch in releases.iteritems():
+            d = connectionProvider.getConnection()
+            d.addCallback(lambda remote, batch=batch: remote.callRemote(
+                    commands.DestroyDomains,
+                    nodeNames=[{'nodeName': n} for n, _ in batch]))
+            d.addBoth(self.releasesFlushed, batch)
+
+
+    def releasesFlushed(self, result, batch):
+        self.placement.invalidate()
+
+        if isinstance(result, failure.Failure):
+            for _, d in batch:
+                d.errback(result)
+            return
+
+        errors = dict((domain['nodeName'], domain.get('error'))
+                for domain in result['domains'])
+
+        for nodeName, d in batch:
+            if errors.get(nodeName) is not None:
+                d.errback(error.DomainDestructionFailed(errors[nodeName]))
+            else:
+                d.callback(None)
+
+
+    def listDomains(self, endpoint, timeout):
+        """
+        Returns a deferred firing with the list of the domains running on the
+        host at ``endpoint``, or failing with an ``error.OperationTimeout``
+        if the host does not answer within ``timeout`` seconds.
+        """
+
+        d = defer.Deferred()
+
+        def expired():
+            d.errback(error.OperationTimeout('Host {0} did not list its ' \
+                    'domains within {1} seconds'.format(endpoint, timeout)))
+
+        timeoutCall = self.reactor.callLater(timeout, expired)
+
+        def done(result):
+            if timeoutCall.active():
+                timeoutCall.cancel()
+                d.callback(result)
+
+        listing = self.nodes.getConnection(endpoint)
+        listing.addCallback(lambda remote: remote.callRemote(
+                commands.ListDomains))
+        listing.addCallback(lambda response: response['domains'])
+        listing.addBoth(done)
+
+        return d
+
+
+    @defer.inlineCallbacks
+    def restoreNodes(self, states):
+        """
+        Re-adopts the nodes described by the given list of states (as
+        returned by ``VirtualNode.getState``) after a controller restart and
+        returns the list of the nodes whose domain is still running.
+
+        The domains running on the hosts which do not belong to any of the
+        given nodes are destroyed. The nodes on hosts which can't be reached
+        within the ``recoverytimeout`` option (in seconds, defaults to 30)
+        are assumed to be still running.
+        """
+
+        timeout = settings.getOption(self.config, 'libvirt',
+                'recoverytimeout', 30, float)
+
+        known = {}
+
+        for state in states:
+            endpoint = state.get('endpoint')
+
+            if endpoint in self.nodes.endpoints:
+                known.setdefault(endpoint, {})[str(state['nodeName'])] = \
+                        str(state['hostname'])
+
+        endpoints = sorted(self.nodes.endpoints)
+        results = yield defer.DeferredList([self.listDomains(e, timeout)
+                for e in endpoints], consumeErrors=True)
+
+        restored, orphans = [], []
+
+        for endpoint, (success, result) in zip(endpoints, results):
+            nodes = known.get(endpoint, {})
+            factory = self.nodes.factories[endpoint]
+
+            if success:
+                running = dict((d['nodeName'], d['hostname']) for d in result)
+            else:
+                self.log.warning('Could not list the domains of {0}, ' \
+                        'assuming its nodes are running: {1}', endpoint,
+                        result.getErrorMessage())
+                running = nodes
+
+            for nodeName, hostname in sorted(running.iteritems()):
+                if nodeName in nodes:
+                    restored.append(VirtualNode(self, factory, nodeName,
+                            hostname, endpoint))
+                else:
+                    self.log.info('Destroying orphaned domain {0} on {1}',
+                            nodeName, endpoint)
+                    orphans.append(self.destroyDomain(factory, nodeName))
+
+            for nodeName in sorted(set(nodes) - set(running)):
+                self.log.warning('Node {0} is not running on {1} anymore',
+                        nodeName, endpoint)
+
+        results = yield defer.DeferredList(orphans, consumeErrors=True)
+
+        for success, result in results:
+            if not success:
+                self.log.error('Could not destroy orphaned domain: {0}',
+                        result.getErrorMessage())
+
+        defer.returnValue(restored)
+
 
     def getNodes(self, count, names, **kwargs):
         nodes = []
 
-        with open(self.config.get('libvirt', 'domainXML')) as fh:
-            description = etree.parse(fh)
+        description = self.getDomainDescription()
+        resources = self.template.getResources()
 
-        # TODO: Transfer disk images to nodes
+        # Only return as many nodes as the hosts can accomodate, if known
+        capacity = self.placement.getCachedCapacity(*resources)
 
-        # TODO: Refactor this to first choose all nodes and then requesting the
-        #       VMs, this allows to select the best strategy to transfer the
-        #       disk images.
+        if capacity is not None and capacity < count:
+            self.log.info('Hosts only have capacity for {0} of the {1} ' \
+                    'requested nodes', capacity, count)
+            count = capacity
 
-        @defer.inlineCallbacks
-        def gotPhysicalNode(node, nodeName, description):
-            domainData = yield node.callRemote(commands.CreateDomain,
-                    description=description)
-            domain = VirtualNode(self, node.factory, nodeName, **domainData)
-            defer.returnValue(domain)
+        # Group the nodes by the host they were placed on, in order to create
+        # them with a single request per host
+        batches = {}
+        reservations = []
+
+        def queue(endpoint, nodeName, d):
+            batches.setdefault(endpoint, []).append((nodeName, d))
 
         for _ in range(count):
             nodeName = next(names)
-            description.find('name').text = nodeName
-
-            d = self.nodes.getNextConnection()
-            d.addCallback(gotPhysicalNode, nodeName, description)
 
+            d = defer.Deferred()
             nodes.append(d)
 
+            reservation = self.placement.reserve(*resources)
+            reservation.addCallbacks(queue, d.errback,
+                    callbackArgs=(nodeName, d))
+            reservations.append(reservation)
+
+        def distribute(_):
+            digest = self.template.getImageDigest()
+
+            if digest is None or not batches:
+                return
+
+            # Make sure that the hosts have the base image
+            return self.imageDistributor.distribute(digest, batches.keys())
+
+        def create(_):
+            for endpoint, batch in batches.iteritems():
+                self.createDomains(endpoint, description, batch)
+
+        def fail(reason):
+            for endpoint, batch in batches.iteritems():
+                for _, d in batch:
+                    self.placement.release(endpoint)
+                    d.errback(reason)
+
+        d = defer.DeferredList(reservations).addCallback(distribute)
+        d.addCallbacks(create, fail)
+
         return nodes
@@ -1,16 +1,24 @@
 
 
-import os
+import collections
+import hashlib
+import threading
+import uuid
 
-from twisted.internet import defer, threads, utils, protocol, endpoints
-from twisted.python import filepath
+from copy import deepcopy
+
+from lxml import etree
+
+from twisted.internet import defer, threads, protocol, endpoints
+from twisted.python import failure, filepath, threadpool
 from twisted.protocols import basic, amp
 from twisted.conch.ssh import keys
 
 from cStringIO import StringIO
 
-from vurm import logging, error
-from vurm.provisioners.remotevirt import ssh, commands, libvirt
+from vurm import logging, error, settings
+from vurm.provisioners.remotevirt import ssh, commands, libvirt, cloning
+from vurm.provisioners.remotevirt import images
 
 
 
@@ -18,10 +26,11 @@ class IPReceiverFactory(protocol.ServerFactory):
 
     noisy = False
 
-    def __init__(self, reactor, key, deferred):
+    def __init__(self, reactor, key, deferred, timeout=1):
         self.deferred = deferred
         self.reactor = reactor
         self.key = key
+        self.timeout = timeout
 
 
     def buildProtocol(self, addr):
@@ -32,24 +41,342 @@ class IPReceiverFactory(protocol.ServerFactory):
 
 
 class IPReceiver(basic.LineReceiver):
+    """
+    Receives the IP address of a newly booted guest over its serial-to-TCP
+    channel and sends back the public key to authorize for SSH connections.
+
+    The handshake goes as follows:
+
+     1. The guest sends its IP address;
+     2. The guest sends a ``READY`` line as soon as it is ready to read the
+        key from the serial interface;
+     3. The key is sent to the guest;
+     4. The guest sends an ``ACK`` line once the key was written.
+
+    Guests which don't send the ``READY`` or the ``ACK`` lines are given
+    ``factory.timeout`` seconds to get ready for the next step instead.
+
+    If the guest closes the connection before the end of the handshake, the
+    address is still reported if the key was already sent; otherwise the
+    deferred errbacks with an ``error.DomainCreationFailed`` exception.
+    """
+
+    READY = 'READY'
+
+    ACK = 'ACK'
+
 
     def __init__(self, key, deferred):
         self.deferred = deferred
         self.key = key
+        self.address = None
+        self.keySent = False
+        self.timeout = None
+
+
+    def setTimeout(self, func):
+        self.cancelTimeout()
+        self.timeout = self.factory.reactor.callLater(self.factory.timeout,
+                func)
+
+
+    def cancelTimeout(self):
+        if self.timeout is not None and self.timeout.active():
+            self.timeout.cancel()
+
+        self.timeout = None
 
 
     def sendKey(self):
+        self.cancelTimeout()
+        self.keySent = True
         self.sendLine(self.key.public().toString('OPENSSH'))
+        self.setTimeout(self.finish)
+
+
+    def finish(self):
+        self.cancelTimeout()
+
         # Callback only when the key was effectively written to the guest
         self.transport.loseConnection()
         self.factory.port.stopListening()
-        self.factory.reactor.callLater(1, self.deferred.callback, self.address)
+        self.deferred.callback(self.address)
+
+
+    def lineReceived(self, line):
+        if self.address is None:
+            self.address = line
+            self.setTimeout(self.sendKey)
+        elif line == self.READY and not self.keySent:
+            self.sendKey()
+        elif line == self.ACK and self.keySent and not self.deferred.called:
+            self.finish()
+
+
+    def connectionLost(self, reason):
+        self.cancelTimeout()
+
+        if self.deferred.called:
+            return
+
+        self.factory.port.stopListening()
+
+        if self.address is not None and self.keySent:
+            self.deferred.callback(self.address)
+        else:
+            self.deferred.errback(error.DomainCreationFailed('The guest ' \
+                    'closed the connection before receiving the key'))
+
+
+
+class WarmPool(object):
+    """
+    Keeps a given number of pre-booted, idle domains for each domain template
+    requested to a ``DomainManager``, so that creation requests can be
+    satisfied without waiting for the guest OS to boot.
+
+    Two descriptions belong to the same template if they only differ by the
+    domain name. A template is registered either explicitly through the
+    ``prime`` method or by the first creation request using it; the pool is
+    then refilled in the background each time a domain is taken from it.
+    """
+
+    def __init__(self, manager, size):
+        self.manager = manager
+        self.size = size
+        self.log = logging.Logger(__name__, system='WarmPool')
+
+        self.templates = {}
+        self.idle = {}
+        self.booting = {}
+
+
+    def getKey(self, config):
+        document = deepcopy(config.document)
+        document.find('name').text = ''
+        return etree.tostring(document)
+
+
+    def prime(self, config):
+        """
+        Registers the template of the given ``libvirt.DomainDescription`` and
+        starts filling the respective pool.
+        """
+
+        key = self.getKey(config)
+
+        if key not in self.templates:
+            self.templates[key] = deepcopy(config.document)
+            self.idle[key] = []
+            self.booting[key] = 0
+
+        self.refill(key)
+        return key
+
+
+    def refill(self, key):
+        missing = self.size - len(self.idle[key]) - self.booting[key]
+
+        for _ in range(missing):
+            self.boot(key)
+
+
+    def boot(self, key):
+        config = libvirt.DomainDescription(deepcopy(self.templates[key]))
+        domainName = 'vurm-warm-{0}'.format(uuid.uuid4().hex[:12])
+        config.document.find('name').text = domainName
+
+        self.booting[key] += 1
+
+        def booted(hostname):
+            self.booting[key] -= 1
+
+            if hostname is None:
+                self.log.error('Could not boot pre-booted domain {0}',
+                        domainName)
+            else:
+                self.idle[key].append((domainName, hostname))
+
+        def failed(reason):
+            self.booting[key] -= 1
+            self.log.error('Could not boot pre-booted domain {0}: {1}',
+                    domainName, reason.getErrorMessage())
+
+        self.log.debug('Booting pre-booted domain {0}', domainName)
+        self.manager.bootDomain(config).addCallbacks(booted, failed)
+
+
+    def assign(self, config):
+        """
+        Takes an idle domain matching the template of the given
+        ``libvirt.DomainDescription`` out of the pool and returns a
+        ``(domainName, hostname)`` tuple, or ``None`` if there is none.
+
+        The pool for the template is refilled in either case.
+        """
+
+        key = self.prime(config)
+
+        if not self.idle[key]:
+            return None
+
+        domain = self.idle[key].pop(0)
+        self.refill(key)
+        return domain
+
+
+    def drain(self):
+        """
+        Destroys all idle domains, returns a deferred firing once done.
+        """
 
+        domains = []
 
-    def lineReceived(self, address):
-        self.address = address
-        # Give to the remote end some time to open the serial interface
-        self.factory.reactor.callLater(1, self.sendKey)
+        for key, idle in self.idle.iteritems():
+            domains += [domainName for domainName, _ in idle]
+            self.idle[key] = []
+
+        return defer.DeferredList([self.manager.destroyDomain(d)
+                for d in domains])
+
+
+
+class LibvirtExecutor(object):
+    """
+    Runs blocking libvirt calls in a dedicated thread pool of bounded size, so
+    that a burst of operations neither starves the other users of the reactor
+    thread pool nor floods the libvirt daemon with parallel requests.
+
+    The number of queued and running calls is exposed through the ``pending``
+    and ``running`` attributes; the number of completed calls and their
+    latency (including the time spent waiting in the queue) are tracked as
+    well, see ``getStats``.
+    """
+
+    def __init__(self, reactor, size=4, timeout=None):
+        """
+        Creates a new executor running at most ``size`` calls in parallel.
+
+        If ``timeout`` is given, the deferreds returned by ``run`` errback with
+        an ``error.OperationTimeout`` exception if the call did not complete
+        in ``timeout`` seconds after being submitted. The call itself can't be
+        interrupted and keeps its thread busy until it returns.
+        """
+
+        self.reactor = reactor
+        self.timeout = timeout
+        self.threadpool = threadpool.ThreadPool(1, size, 'libvirt')
+        self.shutdownTrigger = None
+
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+
+        self.completed = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+        self.log = logging.Logger(__name__, system='LibvirtExecutor')
+
+
+    def start(self):
+        """
+        Starts the thread pool, unless already running. The thread pool is
+        stopped when the reactor shuts down.
+        """
+
+        if self.shutdownTrigger is None:
+            self.threadpool.start()
+            self.shutdownTrigger = self.reactor.addSystemEventTrigger(
+                    'during', 'shutdown', self.stop)
+
+
+    def stop(self):
+        """
+        Stops the thread pool, waiting for the running calls to complete.
+        """
+
+        if self.shutdownTrigger is not None:
+            self.reactor.removeSystemEventTrigger(self.shutdownTrigger)
+            self.shutdownTrigger = None
+            self.threadpool.stop()
+
+
+    def run(self, func, *args, **kwargs):
+        """
+        Runs ``func`` in the thread pool of this executor and returns a
+        deferred which fires with its result.
+        """
+
+        self.start()
+
+        def call():
+            with self.lock:
+                self.pending -= 1
+                self.running += 1
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        d = defer.Deferred()
+
+        def timedOut():
+            d.errback(error.OperationTimeout('Libvirt call {0} did not ' \
+                    'complete in {1} seconds'.format(func.__name__,
+                    self.timeout)))
+
+        if self.timeout is not None:
+            delayedCall = self.reactor.callLater(self.timeout, timedOut)
+        else:
+            delayedCall = None
+
+        submitted = self.reactor.seconds()
+
+        def completed(result):
+            latency = self.reactor.seconds() - submitted
+            self.completed += 1
+            self.totalLatency += latency
+            self.maxLatency = max(self.maxLatency, latency)
+
+            self.log.debug('Libvirt call {0} completed in {1:.3f}s ({2} ' \
+                    'queued, {3} running)', func.__name__, latency,
+                    self.pending, self.running)
+
+            if delayedCall is None:
+                d.callback(result)
+            elif delayedCall.active():
+                delayedCall.cancel()
+                d.callback(result)
+
+        with self.lock:
+            self.pending += 1
+
+        threads.deferToThreadPool(self.reactor, self.threadpool,
+                call).addBoth(completed)
+
+        return d
+
+
+    def getStats(self):
+        """
+        Returns a dictionary with the number of ``pending``, ``running`` and
+        ``completed`` calls and the ``average`` and ``max`` latency in seconds.
+        """
+
+        with self.lock:
+            pending, running = self.pending, self.running
+
+        return {
+            'pending': pending,
+            'running': running,
+            'completed': self.completed,
+            'average': self.totalLatency / self.completed
+                    if self.completed else 0.0,
+            'max': self.maxLatency,
+        }
 
 
 
@@ -67,12 +394,64 @@ class DomainManagerProtocol(amp.AMP):
         return d.addCallback(lambda _: {})
 
 
+    @commands.CreateDomains.responder
+    def createDomains(self, description, nodeNames):
+        def created(nodeName, hostname):
+            self.callRemote(commands.DomainCreated, nodeName=nodeName,
+                    hostname=hostname)
+
+        d = self.instance.createDomains(description,
+                [n['nodeName'] for n in nodeNames], created)
+        return d.addCallback(lambda domains: {'domains': domains})
+
+
+    @commands.DestroyDomains.responder
+    def destroyDomains(self, nodeNames):
+        d = self.instance.destroyDomains([n['nodeName'] for n in nodeNames])
+        return d.addCallback(lambda domains: {'domains': domains})
+
+
+    @commands.ListDomains.responder
+    def listDomains(self):
+        return {'domains': self.instance.listDomains()}
+
+
+    @commands.GetCapacity.responder
+    def getCapacity(self):
+        return self.instance.getCapacity()
+
+
+    @commands.HasImage.responder
+    def hasImage(self, digest):
+        return self.instance.hasImage(digest)
+
+
+    @commands.ReadImageChunk.responder
+    def readImageChunk(self, digest, offset, length):
+        d = self.instance.getImageCache().readChunk(digest, offset, length)
+        return d.addCallback(lambda data: {'data': data})
+
+
+    @commands.FetchImage.responder
+    def fetchImage(self, digest, size, sources):
+        d = self.instance.fetchImage(digest, size,
+                [s['endpoint'] for s in sources])
+        return d.addCallback(lambda _: {})
+
+
     @commands.SpawnSlurmDaemon.responder
-    def spawnDaemon(self, nodeName, slurmConfig):
-        d = self.instance.spawnDaemon(nodeName, slurmConfig)
+    def spawnDaemon(self, nodeName, slurmConfig=None, configDigest=None):
+        d = defer.maybeDeferred(self.instance.spawnDaemon, nodeName,
+                slurmConfig, configDigest)
         return d.addCallback(lambda _: {})
 
 
+    @commands.PushSlurmConfig.responder
+    def pushConfig(self, digest, slurmConfig):
+        self.instance.pushConfig(digest, slurmConfig)
+        return {}
+
+
 
 class DomainManager(object):
     """
@@ -85,13 +464,82 @@ class DomainManager(object):
         self.reactor = reactor
         self.config = config
         self.addresses = {}
+        self.domains = {}
+        self.images = {}
+        self.baseImages = {}
+        self.imageCache = None
+        self.imageFetcher = None
+        self.hypervisors = {}
+        self.sessions = None
+        self.configs = collections.OrderedDict()
+
+        self.executor = LibvirtExecutor(reactor,
+                settings.getOption(config, 'vurmd-libvirt', 'libvirtthreads',
+                        4, int),
+                settings.getOption(config, 'vurmd-libvirt', 'libvirttimeout',
+                        None, float))
+
+        self.cloner = cloning.CLONE_BACKENDS[settings.getOption(config,
+                'vurmd-libvirt', 'clonebackend', 'command')](self)
+
+        size = settings.getOption(config, 'vurmd-libvirt', 'warmpool', 0, int)
+
+        if size:
+            self.warmPool = WarmPool(self, size)
+        else:
+            self.warmPool = None
+
+
+    def start(self):
+        """
+        Fills the warm pool with domains based on the description contained
+        in the file defined by the ``warmtemplate`` option, if any.
+        """
+
+        template = settings.getOption(self.config, 'vurmd-libvirt',
+                'warmtemplate')
+
+        if self.warmPool and template:
+            with open(template) as fh:
+                self.warmPool.prime(libvirt.DomainDescription(fh.read()))
+
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """
+        Destroys all idle domains of the warm pool, stops the libvirt executor
+        and closes the connections to the hypervisor and to the guests.
+        """
+
+        if self.warmPool:
+            yield self.warmPool.drain()
+
+        if self.sessions is not None:
+            yield self.sessions.closeAll()
+
+        self.executor.stop()
+
+        for pool in self.hypervisors.itervalues():
+            pool.close()
 
 
     def getHypervisor(self):
+        """
+        Returns a context manager borrowing a connection to the configured
+        hypervisor from a pool of at most ``connections`` (defaults to the
+        number of libvirt threads) long-lived connections.
+        """
+
         hypervisor = self.config.get('vurmd-libvirt', 'hypervisor')
 
+        if hypervisor not in self.hypervisors:
+            size = settings.getOption(self.config, 'vurmd-libvirt',
+                    'connections', self.executor.threadpool.max, int)
+            self.hypervisors.setdefault(hypervisor,
+                    libvirt.ConnectionPool(hypervisor, size))
+
         try:
-            return libvirt.open(hypervisor)
+            return self.hypervisors[hypervisor].connection()
         except libvirt.LibvirtError as e:
             if e.get_error_code() == 38:
                 msg = e.get_error_message()
@@ -101,6 +549,119 @@ class DomainManager(object):
                 raise
 
 
+    def getImageCache(self):
+        """
+        Returns the cache of the content addressed base images, stored in the
+        directory defined by the ``imagecache`` option (defaults to the
+        ``imagedir`` option) and limited to ``imagecachesize`` MiB, if set.
+        """
+
+        if self.imageCache is None:
+            directory = settings.getOption(self.config, 'vurmd-libvirt',
+                    'imagecache') or self.config.get('vurmd-libvirt',
+                    'imagedir')
+            maxSize = settings.getOption(self.config, 'vurmd-libvirt',
+                    'imagecachesize', None, int)
+
+            self.imageCache = images.ImageCache(directory,
+                    maxSize * 1024 * 1024 if maxSize else None)
+            self.imageFetcher = images.ImageFetcher(self.imageCache,
+                    settings.getOption(self.config, 'vurmd-libvirt',
+                            'imagewindow', 8, int))
+
+        return self.imageCache
+
+
+    def hasImage(self, digest):
+        """
+        Returns a dictionary containing the ``size`` of the image with the
+        given digest if it is in the local cache, an empty one otherwise.
+        """
+
+        cache = self.getImageCache()
+
+        if cache.has(digest):
+            return {'size': cache.getSize(digest)}
+
+        return {}
+
+
+    @defer.inlineCallbacks
+    def fetchImage(self, digest, size, sources):
+        """
+        Fetches the image with the given digest and size into the local cache
+        from the ``vurmd-libvirt`` daemons listening on the ``sources``
+        endpoints.
+        """
+
+        cache = self.getImageCache()
+
+        if cache.has(digest):
+            return
+
+        factory = protocol.ClientFactory()
+        factory.protocol = amp.AMP
+
+        results = yield defer.DeferredList([
+            endpoints.clientFromString(self.reactor, e).connect(factory)
+            for e in sources
+        ], consumeErrors=True)
+
+        connections = [c for success, c in results if success]
+
+        if not connections:
+            raise error.UnknownImage('None of the sources of image {0} ' \
+                    'could be reached'.format(digest))
+
+        try:
+            yield self.imageFetcher.fetch(digest, size, connections)
+        finally:
+            for connection in connections:
+                connection.transport.loseConnection()
+
+
+    def getCapacity(self):
+        """
+        Returns a deferred firing with a dictionary describing the resources
+        of the hypervisor: the number of running domains, the number of CPUs,
+        the total and free memory (in KiB), the load of the libvirt executor
+        (number of queued and running calls and their average and maximum
+        latency in seconds) and, if the ``maxdomains`` option is set, the
+        maximum number of domains this host shall run.
+        """
+
+        def getCapacityInThread():
+            with self.getHypervisor() as conn:
+                info = conn.getInfo()
+
+                return {
+                    'domains': conn.numOfDomains(),
+                    'cpus': info[2],
+                    'memory': info[1] * 1024,
+                    'freeMemory': conn.getFreeMemory() // 1024,
+                }
+
+        def addLimits(capacity):
+            maxDomains = settings.getOption(self.config, 'vurmd-libvirt',
+                    'maxdomains', None, int)
+
+            if maxDomains is not None:
+                capacity['maxDomains'] = maxDomains
+
+            stats = self.executor.getStats()
+            capacity.update({
+                'libvirtPending': stats['pending'],
+                'libvirtRunning': stats['running'],
+                'libvirtLatency': stats['average'],
+                'libvirtMaxLatency': stats['max'],
+            })
+
+            return capacity
+
+        d = self.executor.run(getCapacityInThread)
+        return d.addCallback(addLimits)
+
+
     @defer.inlineCallbacks
     def exchangeAddressAndKey(self):
         d = defer.Deferred()
@@ -108,74 +669,229 @@ class DomainManager(object):
 
         endpoint = endpoints.TCP4ServerEndpoint(self.reactor, 0,
                 interface='127.0.0.1')
-        factory = IPReceiverFactory(self.reactor, key, d)
+        timeout = settings.getOption(self.config, 'vurmd-libvirt',
+                'handshaketimeout', 1, float)
+        factory = IPReceiverFactory(self.reactor, key, d, timeout)
         port = yield endpoint.listen(factory)
         factory.port = port
         defer.returnValue((d, port.getHost().port))
 
 
     @defer.inlineCallbacks
-    def createDomain(self, description):
-        self.log.info('New virtual domain creation request received')
-
-        config = libvirt.DomainDescription(description)
-        nodeName = config.getName()
+    def bootDomain(self, config):
+        """
+        Clones the root image of the domain described by the given
+        ``libvirt.DomainDescription``, boots it and waits for the guest to
+        send back its IP address.
+
+        Returns a deferred firing with the IP address of the guest, or with
+        ``None`` if the disk image could not be cloned.
+        """
+
+        domainName = config.getName()
+
+        # Make a Copy-On-Write (COW) image from the original one. Images named
+        # after a digest are taken from the cache and kept there as long as
+        # the domain runs.
+        original = config.getRootImagePath().basename()
+
+        if images.isDigest(original):
+            cache = self.getImageCache()
+            original, digest = cache.getPath(original), original
+            cache.pin(digest)
+            self.baseImages[domainName] = digest
+        else:
+            original = filepath.FilePath(self.config.get('vurmd-libvirt',
+                    'imagedir')).child(original)
 
-        # Make a Copy-On-Write (COW) image from the original one
-        original = config.getRootImagePath()
-        original = filepath.FilePath(self.config.get('vurmd-libvirt',
-                'imagedir')).child(original.basename())
         copy = filepath.FilePath(self.config.get('vurmd-libvirt', 'clonedir'))
-        copy = copy.child('{0}.qcow2'.format(nodeName))
+        copy = copy.child('{0}.qcow2'.format(domainName))
 
         self.log.info('Creating new copy-on-write image based on {0} at {1}',
                 original.path, copy.path)
 
-        cmd = self.config.get('vurmd-libvirt', 'clonebin').format(
-                source=original.path, destination=copy.path)
-        stdout, stderr, exitCode = yield utils.getProcessOutputAndValue('sh',
-                ['-c', cmd], env=os.environ)
-
-        if exitCode:
-            self.log.error('Image creation failed, qemu-img exited with ' \
-                    'status code {0} (output follows):', exitCode)
-            self.log.debug('stdout: {0!r}', stdout)
-            self.log.debug('stderr: {0!r}', stderr)
+        try:
+            copy = yield self.cloner.clone(original, copy)
+        except cloning.CloneError as e:
+            self.log.error('Image creation failed: {0} (output follows):', e)
+            self.log.debug('output: {0!r}', e.output)
+            self.releaseBaseImage(domainName)
             defer.returnValue(None)
+        except:
+            self.releaseBaseImage(domainName)
+            raise
 
+        self.images[domainName] = copy
         config.setRootImagePath(copy)
 
-        # Enable IP callback over serial-to-tcp connection
-        addressDeferred, port = yield self.exchangeAddressAndKey()
-        config.addSerialToTCPDevice('127.0.0.1', port, mode='connect')
+        try:
+            # Enable IP callback over serial-to-tcp connection
+            addressDeferred, port = yield self.exchangeAddressAndKey()
+            config.addSerialToTCPDevice('127.0.0.1', port, mode='connect')
+
+            def createInThread(config):
+                with self.getHypervisor() as conn:
+                    conn.createLinux(str(config), 0)
+            yield self.executor.run(createInThread, config)
 
-        def createInThread(config):
-            with self.getHypervisor() as conn:
-                conn.createLinux(str(config), 0)
-        yield threads.deferToThread(createInThread, config)
+            self.log.info('Domain created, waiting for guest OS to come up')
+
+            hostname = yield addressDeferred
+        except:
+            reason = failure.Failure()
+            self.log.error('Domain {0!r} could not be booted: {1}',
+                    domainName, reason.getErrorMessage())
+
+            # Don't leak the domain, its image and the pin on its base image
+            try:
+                yield self.destroyDomain(domainName)
+            except Exception as e:
+                self.log.error('Domain {0!r} could not be cleaned up: {1}',
+                        domainName, e)
+                self.releaseBaseImage(domainName)
+
+            reason.raiseException()
+
+        self.log.info('Got IP address {0} for domain {1}', hostname,
+                domainName)
+
+        defer.returnValue(hostname)
+
+
+    @defer.inlineCallbacks
+    def createDomain(self, description):
+        self.log.info('New virtual domain creation request received')
+
+        config = libvirt.DomainDescription(description)
+        nodeName = config.getName()
+
+        if self.warmPool:
+            domain = self.warmPool.assign(config)
+        else:
+            domain = None
 
-        self.log.info('Domain created, waiting for guest OS to come up')
+        if domain:
+            domainName, hostname = domain
 
-        hostname = yield addressDeferred
+            self.log.info('Assigned pre-booted domain {0} ({1}) to {2}',
+                    domainName, hostname, nodeName)
 
-        self.log.info('Got IP address {0} for domain {1}', hostname, nodeName)
+            self.domains[nodeName] = domainName
+        else:
+            hostname = yield self.bootDomain(config)
 
-        self.addresses[nodeName] = hostname
+        if hostname is not None:
+            self.addresses[nodeName] = hostname
 
         defer.returnValue(hostname)
 
 
+    def createDomains(self, description, nodeNames, created=None):
+        """
+        Creates a domain for each of the given node names, all based on the
+        same ``description`` template, in parallel.
+
+        If given, ``created`` is called with the node name and the hostname of
+        each domain as soon as it is up. Returns a deferred firing with a list
+        of dictionaries containing the ``nodeName`` and either the
+        ``hostname`` or an ``error`` message for each domain.
+        """
+
+        def domainCreated(hostname, nodeName):
+            if hostname is None:
+                return {'nodeName': nodeName,
+                        'error': u'The disk image could not be cloned'}
+
+            if created:
+                created(nodeName, hostname)
+
+            return {'nodeName': nodeName, 'hostname': hostname}
+
+        def domainFailed(reason, nodeName):
+            self.log.error('Creation of domain {0!r} failed: {1}', nodeName,
+                    reason.getErrorMessage())
+            return {'nodeName': nodeName,
+                    'error': unicode(reason.getErrorMessage())}
+
+        dl = []
+
+        for nodeName in nodeNames:
+            nodeDescription = deepcopy(description)
+            nodeDescription.find('name').text = nodeName
+
+            d = defer.maybeDeferred(self.createDomain, nodeDescription)
+            d.addCallbacks(domainCreated, domainFailed,
+                    callbackArgs=(nodeName,), errbackArgs=(nodeName,))
+            dl.append(d)
+
+        return defer.gatherResults(dl)
+
+
+    def listDomains(self):
+        """
+        Returns a list of dictionaries containing the ``nodeName`` and the
+        ``hostname`` of each running domain assigned to a node.
+        """
+
+        return [{'nodeName': nodeName, 'hostname': hostname}
+                for nodeName, hostname in sorted(self.addresses.iteritems())]
+
+
+    def destroyDomains(self, nodeNames):
+        """
+        Destroys the domains of all the given node names in parallel.
+
+        Returns a deferred firing with a list of dictionaries containing the
+        ``nodeName`` and, if its domain could not be destroyed, an ``error``
+        message for each node.
+        """
+
+        def domainFailed(reason, nodeName):
+            self.log.error('Destruction of domain {0!r} failed: {1}',
+                    nodeName, reason.getErrorMessage())
+            return {'nodeName': nodeName,
+                    'error': unicode(reason.getErrorMessage())}
+
+        dl = []
+
+        for nodeName in nodeNames:
+            d = defer.maybeDeferred(self.destroyDomain, nodeName)
+            d.addCallbacks(lambda _, nodeName: {'nodeName': nodeName},
+                    domainFailed, callbackArgs=(nodeName,),
+                    errbackArgs=(nodeName,))
+            dl.append(d)
+
+        return defer.gatherResults(dl)
+
+
+    def releaseBaseImage(self, domainName):
+        """
+        Allows the cached base image of the given domain to be evicted.
+        """
+
+        digest = self.baseImages.pop(domainName, None)
+
+        if digest is not None:
+            self.imageCache.unpin(digest)
+
+
     @defer.inlineCallbacks
     def destroyDomain(self, nodeName):
         self.log.info('Virtual domain distruction request for {0!r} received',
                 nodeName)
 
         if nodeName in self.addresses:
-            del self.addresses[nodeName]
+            hostname = self.addresses.pop(nodeName)
+
+            if self.sessions is not None:
+                yield self.sessions.close(hostname)
         else:
             self.log.debug('Domain {0!r} not found in internal registry, ' \
                     'moving on', nodeName)
 
+        # Domains taken from the warm pool keep their original name
+        domainName = self.domains.pop(nodeName, nodeName)
+
         # Destroy running domain
         def destroyDomain(nodeName):
             with self.getHypervisor() as conn:
@@ -186,43 +902,102 @@ class DomainManager(object):
                 else:
                     domain.destroy()
                     return True
-        destroyed = yield threads.deferToThread(destroyDomain, nodeName)
+        destroyed = yield self.executor.run(destroyDomain, domainName)
 
         if destroyed:
             self.log.debug('Domain {0!r} correctly destroyed', nodeName)
         else:
             self.log.debug('Domain {0!r} not running, moving on', nodeName)
 
-        # Remove disk image from filesystem
-        image = filepath.FilePath(self.config.get('vurmd-libvirt', 'clonedir'))
-        image = image.child('{0}.qcow2'.format(nodeName))
+        self.releaseBaseImage(domainName)
+
+        # Remove disk image through the backend which created it
+        image = self.images.pop(domainName, None)
+
+        if image is None:
+            image = filepath.FilePath(self.config.get('vurmd-libvirt',
+                    'clonedir')).child('{0}.qcow2'.format(domainName))
+
+        removed = yield self.cloner.remove(image)
 
-        if image.exists():
-            image.remove()
-            self.log.debug('Disk image for domain {0!r} removed from local ' \
-                    'filesystem', nodeName)
+        if removed:
+            self.log.debug('Disk image for domain {0!r} removed', nodeName)
         else:
             self.log.debug('Disk image for domain {0!r} not found, moving on',
                     nodeName)
 
 
-    @defer.inlineCallbacks
-    def spawnDaemon(self, nodeName, config):
-        self.log.info('Spawning domain')
+    def getSession(self, hostname):
+        """
+        Returns a deferred firing with an authenticated SSH connection to the
+        guest at ``hostname``. Connections are kept open until the domain is
+        destroyed and reused by all the operations on the same guest.
+        """
+
+        if self.sessions is None:
+            username = self.config.get('vurmd-libvirt', 'username')
+            keyPath = self.config.get('vurmd-libvirt', 'key')
+            key = keys.Key.fromFile(keyPath)
+            port = int(self.config.get('vurmd-libvirt', 'sshport'))
+
+            self.log.debug('Connecting to guests via SSH as {0} using key ' \
+                    'from {1}', username, keyPath)
+
+            self.sessions = ssh.SessionCache(self.reactor, username, key,
+                    port)
+
+        return self.sessions.getSession(hostname)
 
-        hostname = self.addresses[nodeName]
-        username = self.config.get('vurmd-libvirt', 'username')
-        keyPath = self.config.get('vurmd-libvirt', 'key')
-        key = keys.Key.fromFile(keyPath)
 
-        self.log.debug('Connection via SSH to {0}@{1} using key from {2}',
-                username, hostname, keyPath)
+    def pushConfig(self, digest, config):
+        """
+        Stores a SLURM configuration in the local cache, so that it can be
+        referenced by its SHA-1 ``digest`` when spawning daemons. At most
+        ``configcache`` (defaults to 4) configurations are kept.
+        """
 
-        creator = protocol.ClientCreator(self.reactor, ssh.ClientTransport,
-                username, key)
+        if hashlib.sha1(config).hexdigest() != digest:
+            raise error.UnknownConfiguration('The configuration does not ' \
+                    'match the digest {0}'.format(digest))
 
-        service = yield creator.connectTCP(hostname,
-                int(self.config.get('vurmd-libvirt', 'sshport')))
+        self.configs.pop(digest, None)
+        self.configs[digest] = config
+
+        size = settings.getOption(self.config, 'vurmd-libvirt',
+                'configcache', 4, int)
+
+        while len(self.configs) > size:
+            self.configs.popitem(last=False)
+
+
+    def getConfig(self, digest):
+        """
+        Returns the cached SLURM configuration with the given digest, or
+        raises an ``error.UnknownConfiguration`` exception.
+        """
+
+        try:
+            return self.configs[digest]
+        except KeyError:
+            raise error.UnknownConfiguration('No configuration with digest ' \
+                    '{0} was pushed to this host'.format(digest))
+
+
+    @defer.inlineCallbacks
+    def spawnDaemon(self, nodeName, config=None, digest=None):
+        """
+        Uploads the given SLURM configuration (or the cached one identified by
+        ``digest``) to the guest hosting ``nodeName`` and starts the SLURM
+        daemon on it.
+        """
+
+        if config is None:
+            config = self.getConfig(digest)
+
+        self.log.info('Spawning domain')
+
+        hostname = self.addresses[nodeName]
+        service = yield self.getSession(hostname)
 
         remoteSlurmConf = self.config.get('vurmd-libvirt', 'slurmconfig')
         remoteSlurmConf = filepath.FilePath(remoteSlurmConf)
@@ -231,10 +1006,12 @@ class DomainManager(object):
                 'mkdir -p {0}'.format(
                         remoteSlurmConf.parent().path))
 
-        yield service.transferFile(StringIO(config), remoteSlurmConf)
+        yield service.transferFile(StringIO(config), remoteSlurmConf,
+                settings.getOption(self.config, 'vurmd-libvirt',
+                        'sftpchunksize', None, int),
+                settings.getOption(self.config, 'vurmd-libvirt',
+                        'sftpwindow', None, int))
 
         yield service.executeCommand(
                 self.config.get('vurmd-libvirt', 'slurmd').format(
                         nodeName=nodeName))
-
-        yield service.disconnect()
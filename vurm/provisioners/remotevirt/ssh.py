@@ -3,7 +3,8 @@ import struct
 
 from twisted.conch.ssh import transport, connection, userauth, channel, common
 from twisted.conch.ssh import filetransfer
-from twisted.internet import defer, error
+from twisted.internet import defer, error, protocol
+from twisted.python import failure
 
 
 
@@ -22,6 +23,7 @@ class ClientTransport(transport.SSHClientTransport):
         self.serviceRequests = []
         self.service = ClientConnection()
         self.disconnectionDeferred = None
+        self.disconnectionObservers = []
         self.connectionAlreadyLost = False
 
 
@@ -29,12 +31,30 @@ class ClientTransport(transport.SSHClientTransport):
         self.connectionAlreadyLost = True
         transport.SSHClientTransport.connectionLost(self, reason)
 
+        observers, self.disconnectionObservers = \
+                self.disconnectionObservers, []
+        for d in observers:
+            d.callback(None)
+
         if self.disconnectionDeferred:
             if reason.check(error.ConnectionDone):
                 self.disconnectionDeferred.callback(None)
             else:
                 self.disconnectionDeferred.errback(reason)
 
+    def notifyOnDisconnect(self):
+        """
+        Returns a deferred which fires with ``None`` as soon as the connection
+        is lost, for whatever reason.
+        """
+
+        if self.connectionAlreadyLost:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.disconnectionObservers.append(d)
+        return d
+
+
     def disconnect(self):
         if self.connectionAlreadyLost:
             return defer.succeed(None)
@@ -43,10 +63,18 @@ class ClientTransport(transport.SSHClientTransport):
         return self.disconnectionDeferred
 
 
-    def transferFile(self, fh, remotePath):
+    def transferFile(self, fh, remotePath, chunkSize=None, window=None,
+            progress=None):
+        """
+        Uploads the content of the file-like object ``fh`` to ``remotePath``
+        over SFTP. See ``SFTPClient`` for the meaning of the optional
+        arguments.
+        """
+
         d = defer.Deferred()
-        self.service.openChannelWhenReady(FileTransferChannel(fh, remotePath,
-                d, conn=self.service))
+        client = SFTPClient(fh, remotePath, d, chunkSize, window, progress)
+        self.service.openChannelWhenReady(FileTransferChannel(client,
+                conn=self.service))
         return d
 
 
@@ -69,6 +97,104 @@ class ClientTransport(transport.SSHClientTransport):
 
 
 
+class SessionCache(object):
+    """
+    Keeps one authenticated SSH connection open for each remote host, so that
+    commands and file transfers can be multiplexed as separate channels over
+    it without going through the key exchange and the authentication again.
+
+    Connections lost in the meantime are transparently reopened on the next
+    request.
+    """
+
+    def __init__(self, reactor, username, key, port=22):
+        self.reactor = reactor
+        self.username = username
+        self.key = key
+        self.port = port
+
+        self.sessions = {}
+        self.connecting = {}
+
+
+    def getSession(self, hostname):
+        """
+        Returns a deferred firing with the ``ClientTransport`` connected to
+        ``hostname``, opening a new connection if none is available.
+        Concurrent requests for the same host share the same connection
+        attempt.
+        """
+
+        session = self.sessions.get(hostname)
+
+        if session is not None and not session.connectionAlreadyLost:
+            return defer.succeed(session)
+
+        d = defer.Deferred()
+
+        if hostname in self.connecting:
+            self.connecting[hostname].append(d)
+            return d
+
+        waiters = self.connecting[hostname] = [d]
+
+        def connected(session):
+            self.sessions[hostname] = session
+            session.notifyOnDisconnect().addCallback(self.evict, hostname,
+                    session)
+            return session
+
+        def done(result):
+            del self.connecting[hostname]
+
+            for waiter in waiters:
+                if isinstance(result, failure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+
+        creator = protocol.ClientCreator(self.reactor, ClientTransport,
+                self.username, self.key)
+        creator.connectTCP(hostname, self.port).addCallback(
+                connected).addBoth(done)
+
+        return d
+
+
+    def evict(self, _, hostname, session):
+        """
+        Forgets about ``session`` once its connection was lost.
+        """
+
+        if self.sessions.get(hostname) is session:
+            del self.sessions[hostname]
+
+
+    def close(self, hostname):
+        """
+        Closes the connection to ``hostname``, if any. Returns a deferred
+        firing once disconnected.
+        """
+
+        session = self.sessions.pop(hostname, None)
+
+        if session is None:
+            return defer.succeed(None)
+
+        return session.disconnect()
+
+
+    def closeAll(self):
+        """
+        Closes all the cached connections. Returns a deferred firing once all
+        of them are disconnected.
+        """
+
+        return defer.DeferredList([self.close(hostname)
+                for hostname in self.sessions.keys()])
+
+
+
 class PublickeyAuth(userauth.SSHUserAuthClient):
 
     def __init__(self, user, key, connection):
@@ -151,33 +277,48 @@ class FileTransferChannel(channel.SSHChannel):
 
     name = 'session'
 
-    def __init__(self, fh, remotePath, deferred, *args, **kwargs):
+    def __init__(self, client, *args, **kwargs):
         channel.SSHChannel.__init__(self, *args, **kwargs)
-        self.deferred = deferred
-        self.fh = fh
-        self.remotePath = remotePath
+        self.client = client
 
 
     @defer.inlineCallbacks
     def channelOpen(self, data):
         yield self.conn.sendRequest(self, 'subsystem', common.NS('sftp'),
                 wantReply=1)
-        self.client = SFTPClient(self.fh, self.remotePath, self.deferred)
         self.client.makeConnection(self)
         self.dataReceived = self.client.dataReceived
 
 
 
 class SFTPClient(filetransfer.FileTransferClient):
+    """
+    Uploads a file over SFTP, keeping up to ``window`` write requests of
+    ``chunkSize`` bytes each in flight at any given time, so that the transfer
+    rate is bound by the bandwidth of the link instead of its latency.
+
+    If given, ``progress`` is called with the total number of acknowledged
+    bytes after each written chunk.
+    """
+
+    chunkSize = 32768
 
-    chunkSize = 1024
+    window = 16
 
 
-    def __init__(self, fh, remotePath, deferred):
+    def __init__(self, fh, remotePath, deferred, chunkSize=None, window=None,
+            progress=None):
         filetransfer.FileTransferClient.__init__(self)
         self.fh = fh
         self.remotePath = remotePath
         self.deferred = deferred
+        self.progress = progress
+
+        if chunkSize:
+            self.chunkSize = chunkSize
+
+        if window:
+            self.window = window
 
 
     def packet_STATUS(self, data):  # pragma: no cover
@@ -208,18 +349,78 @@ class SFTPClient(filetransfer.FileTransferClient):
     def connectionMade(self):
         flags = filetransfer.FXF_WRITE | filetransfer.FXF_CREAT
         flags |= filetransfer.FXF_TRUNC
-        remoteFile = yield self.openFile(self.remotePath.path, flags, {})
 
-        offset = 0
-        while True:
+        try:
+            remoteFile = yield self.openFile(self.remotePath.path, flags, {})
+
+            try:
+                yield self.upload(remoteFile)
+            finally:
+                yield defer.maybeDeferred(remoteFile.close)
+        except Exception:
+            reason = failure.Failure()
+            self.transport.loseConnection()
+            self.deferred.errback(reason)
+        else:
+            self.transport.loseConnection()
+            self.deferred.callback(None)
+
+
+    def upload(self, remoteFile):
+        """
+        Writes the whole content of the local file to ``remoteFile``. Returns
+        a deferred firing with the number of written bytes once all the write
+        requests have been acknowledged, or failing with the first error.
+        """
+
+        self.uploaded = defer.Deferred()
+        self.offset = 0
+        self.written = 0
+        self.outstanding = 0
+        self.eof = False
+
+        self.sendChunks(remoteFile)
+
+        return self.uploaded
+
+
+    def sendChunks(self, remoteFile):
+        """
+        Sends write requests until the window is full or the end of the local
+        file is reached.
+        """
+
+        while not self.eof and self.outstanding < self.window:
             chunk = self.fh.read(self.chunkSize)
 
             if not chunk:
+                self.eof = True
                 break
-            else:
-                yield remoteFile.writeChunk(offset, chunk)
-                offset += self.chunkSize
 
-        yield defer.maybeDeferred(remoteFile.close)
-        self.transport.loseConnection()
-        self.deferred.callback(None)
+            d = remoteFile.writeChunk(self.offset, chunk)
+            d.addCallbacks(self.chunkWritten, self.chunkFailed,
+                    callbackArgs=(remoteFile, len(chunk)))
+
+            self.offset += len(chunk)
+            self.outstanding += 1
+
+        if self.eof and not self.outstanding and not self.uploaded.called:
+            self.uploaded.callback(self.written)
+
+
+    def chunkWritten(self, _, remoteFile, size):
+        self.outstanding -= 1
+        self.written += size
+
+        if self.progress:
+            self.progress(self.written)
+
+        if not self.uploaded.called:
+            self.sendChunks(remoteFile)
+
+
+    def chunkFailed(self, reason):
+        self.outstanding -= 1
+
+        if not self.uploaded.called:
+            self.uploaded.errback(reason)
@@ -1,4 +1,4 @@
-
+from lxml import etree
 
 
 class libvirtError(Exception):
@@ -15,14 +15,43 @@ class libvirtError(Exception):
 class Domain(object):
     destroyed = False
 
+    def __init__(self, name):
+        self.name = name
+
     def destroy(self):
         self.destroyed = True
+        Hypervisor.destroyedDomains.append(self.name)
+
+
+class Volume(object):
+    def __init__(self, path):
+        self.volumePath = path
+
+    def path(self):
+        return self.volumePath
+
+    def delete(self, flags):
+        Hypervisor.deletedVolumes.append(self.volumePath)
+
+
+class StoragePool(object):
+    def __init__(self, name):
+        self.name = name
+        self.descriptions = []
+
+    def createXML(self, description, flags):
+        self.descriptions.append(description)
+        name = etree.fromstring(description).find('name').text
+        return Volume('/pools/{0}/{1}'.format(self.name, name))
 
 
 class Hypervisor(object):
 
     lastDomain = None
+    lastPool = None
     descriptions = {}
+    deletedVolumes = []
+    destroyedDomains = []
 
     def __init__(self, uri):
         action = uri.split(':///', 1)[1]
@@ -41,15 +70,43 @@ class Hypervisor(object):
     def lookupByName(self, name):
         if name == 'inexistent':
             raise libvirtError(0)
-        elif name == 'existent':
-            Hypervisor.lastDomain = Domain()
-            return Hypervisor.lastDomain
+        Hypervisor.lastDomain = Domain(name)
+        return Hypervisor.lastDomain
+
+
+    def storagePoolLookupByName(self, name):
+        if name == 'inexistent':
+            raise libvirtError(0)
+        Hypervisor.lastPool = StoragePool(name)
+        return Hypervisor.lastPool
+
+
+    def storageVolLookupByPath(self, path):
+        if not path.startswith('/pools/'):
+            raise libvirtError(0)
+        return Volume(path)
+
+
+    def getInfo(self):
+        return ['x86_64', 4096, 8, 2000, 1, 1, 4, 2]
+
+
+    def getFreeMemory(self):
+        return 2048 * 1024 * 1024
+
+
+    def numOfDomains(self):
+        return 3
 
 
     def createLinux(self, desc, flag):
         Hypervisor.descriptions[self.key] = desc
 
 
+    def isAlive(self):
+        return not self.closed
+
+
     def close(self):
         self.closed = True
 
@@ -0,0 +1,148 @@
+import ConfigParser
+import struct
+
+from lxml import etree
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.python import filepath
+
+from vurm.provisioners.remotevirt import cloning, remote, libvirt
+
+
+
+class FakeManager(object):
+
+    def __init__(self, config):
+        self.reactor = reactor
+        self.config = config
+        self.executor = remote.LibvirtExecutor(reactor, 1)
+
+    def getHypervisor(self):
+        return libvirt.open(self.config.get('vurmd-libvirt', 'hypervisor'))
+
+
+
+class ClonerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cloneScript = filepath.FilePath(__file__).parent().child(
+                'cloner_exec.py').path
+
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section('vurmd-libvirt')
+        self.config.set('vurmd-libvirt', 'hypervisor', 'test:///mocked')
+
+        self.manager = FakeManager(self.config)
+        self.addCleanup(self.manager.executor.stop)
+
+        self.tmpDir = filepath.FilePath(self.mktemp())
+        self.tmpDir.makedirs()
+
+        self.source = self.tmpDir.child('base.qcow2')
+        self.source.setContent('base image content')
+
+
+    def getCloner(self, backend):
+        return cloning.CLONE_BACKENDS[backend](self.manager)
+
+
+    @defer.inlineCallbacks
+    def test_command(self):
+        callback = self.tmpDir.child('callback')
+        self.config.set('vurmd-libvirt', 'clonebin',
+                'python {0} callback {1} {{source}} {{destination}}'.format(
+                self.cloneScript, callback.path))
+
+        destination = self.tmpDir.child('clone.qcow2')
+        result = yield self.getCloner('command').clone(self.source,
+                destination)
+
+        self.assertEquals(result, destination)
+        self.assertEquals(callback.getContent().splitlines(),
+                [self.source.path, destination.path])
+
+        self.config.set('vurmd-libvirt', 'clonebin',
+                'python {0} fail'.format(self.cloneScript))
+
+        yield self.failUnlessFailure(self.getCloner('command').clone(
+                self.source, destination), cloning.CloneError)
+
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        # Fails for the destinations whose name contains "fail"
+        self.config.set('vurmd-libvirt', 'clonebin',
+                'echo {destination} | grep -qv fail && touch {destination}')
+
+        cloner = self.getCloner('batch')
+        names = ['a.qcow2', 'fail.qcow2', 'b.qcow2']
+
+        results = yield defer.DeferredList([cloner.clone(self.source,
+                self.tmpDir.child(name)) for name in names],
+                consumeErrors=True)
+
+        self.assertEquals([success for success, _ in results],
+                [True, False, True])
+        results[1][1].trap(cloning.CloneError)
+
+        self.assertTrue(self.tmpDir.child('a.qcow2').exists())
+        self.assertTrue(self.tmpDir.child('b.qcow2').exists())
+        self.assertEquals(cloner.pending, [])
+
+
+    @defer.inlineCallbacks
+    def test_reflink(self):
+        destination = self.tmpDir.child('clone.qcow2')
+        result = yield self.getCloner('reflink').clone(self.source,
+                destination)
+
+        self.assertEquals(result, destination)
+        self.assertEquals(destination.getContent(), self.source.getContent())
+
+        yield self.failUnlessFailure(self.getCloner('reflink').clone(
+                self.tmpDir.child('missing'), destination), cloning.CloneError)
+
+
+    @defer.inlineCallbacks
+    def test_pool(self):
+        self.config.set('vurmd-libvirt', 'clonepool', 'vurm')
+
+        # Use the virtual size from the qcow2 header
+        self.source.setContent('QFI\xfb' + '\0' * 20 +
+                struct.pack('>Q', 2 ** 30))
+
+        result = yield self.getCloner('pool').clone(self.source,
+                self.tmpDir.child('node.qcow2'))
+        self.assertEquals(result.path, '/pools/vurm/node.qcow2')
+
+        volume, = libvirt.libvirt.Hypervisor.lastPool.descriptions
+        volume = etree.fromstring(volume)
+
+        self.assertEquals(volume.find('capacity').text, str(2 ** 30))
+        self.assertEquals(volume.find('backingStore/path').text,
+                self.source.path)
+
+        # Volumes are deleted through libvirt, other images from the disk
+        cloner = self.getCloner('pool')
+        removed = yield cloner.remove(result)
+        self.assertTrue(removed)
+        self.assertEquals(libvirt.libvirt.Hypervisor.deletedVolumes[-1],
+                '/pools/vurm/node.qcow2')
+
+        other = self.tmpDir.child('other.qcow2')
+        other.touch()
+        removed = yield cloner.remove(other)
+        self.assertTrue(removed)
+        self.assertFalse(other.exists())
+
+        self.config.set('vurmd-libvirt', 'clonepool', 'inexistent')
+
+        yield self.failUnlessFailure(self.getCloner('pool').clone(
+                self.source, self.tmpDir.child('node.qcow2')),
+                cloning.CloneError)
+
+        # Unreadable base images are reported as clone errors as well
+        yield self.failUnlessFailure(self.getCloner('pool').clone(
+                self.tmpDir.child('missing.qcow2'),
+                self.tmpDir.child('node.qcow2')), cloning.CloneError)
@@ -0,0 +1,188 @@
+import hashlib
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.python import filepath
+
+from vurm.provisioners.remotevirt import images, commands
+from vurm import error
+
+
+
+def digestOf(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+
+class FakeSource(object):
+
+    def __init__(self, content):
+        self.content = content
+        self.requests = 0
+
+
+    def callRemote(self, command, digest, offset, length):
+        assert command is commands.ReadImageChunk
+        self.requests += 1
+        data = self.content[offset:offset + length]
+        return task.deferLater(reactor, 0, lambda: {'data': data})
+
+
+
+class FakeHost(object):
+
+    def __init__(self, size=None):
+        self.size = size
+        self.fetched = []
+
+
+    def callRemote(self, command, **kwargs):
+        if command is commands.HasImage:
+            return defer.succeed({'size': self.size})
+
+        self.fetched.append([s['endpoint'] for s in kwargs['sources']])
+        self.size = kwargs['size']
+        return defer.succeed({})
+
+
+
+class FakeConnectionsPool(object):
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.endpoints = dict.fromkeys(hosts)
+
+
+    def getConnection(self, endpoint):
+        return defer.succeed(self.hosts[endpoint])
+
+
+
+class ImageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = filepath.FilePath(self.mktemp())
+        self.tmpDir.makedirs()
+
+
+    def addImage(self, cache, content):
+        temp = self.tmpDir.child('temp')
+        temp.setContent(content)
+        cache.add(digestOf(content), temp)
+        return digestOf(content)
+
+
+    @defer.inlineCallbacks
+    def test_load(self):
+        self.tmpDir.child(digestOf('a')).setContent('a')
+        self.tmpDir.child('other.qcow2').setContent('other')
+
+        cache = images.ImageCache(self.tmpDir.path)
+
+        self.assertTrue(cache.has(digestOf('a')))
+        self.assertEquals(cache.images.keys(), [digestOf('a')])
+
+        chunk = yield cache.readChunk(digestOf('a'), 0, 10)
+        self.assertEquals(chunk, 'a')
+
+        self.assertRaises(error.UnknownImage, cache.getPath, digestOf('b'))
+
+
+    def test_eviction(self):
+        cache = images.ImageCache(self.tmpDir.path, 20)
+
+        a = self.addImage(cache, 'a' * 10)
+        b = self.addImage(cache, 'b' * 10)
+
+        # Pinned images and recently used ones are kept
+        cache.pin(a)
+        c = self.addImage(cache, 'c' * 10)
+
+        self.assertEquals(sorted(cache.images), sorted([a, c]))
+        self.assertFalse(self.tmpDir.child(b).exists())
+
+        cache.getPath(c)
+        d = self.addImage(cache, 'd' * 10)
+        self.assertEquals(sorted(cache.images), sorted([a, d]))
+
+        # Unpinned images are evicted once the cache is full
+        cache.unpin(a)
+        cache.maxSize = 10
+        cache.evict()
+        self.assertEquals(cache.images.keys(), [d])
+
+        # Images just added are kept even if the pinned ones fill the cache
+        cache.pin(d)
+        e = self.addImage(cache, 'e' * 10)
+        self.assertEquals(sorted(cache.images), sorted([d, e]))
+        self.assertTrue(self.tmpDir.child(e).exists())
+
+
+
+class ImageFetcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = images.ImageCache(self.mktemp())
+        self.fetcher = images.ImageFetcher(self.cache, 4)
+
+
+    @defer.inlineCallbacks
+    def test_fetch(self):
+        content = ''.join(chr(i % 256) for i in range(images.CHUNK_SIZE * 5))
+        digest = digestOf(content)
+        sources = [FakeSource(content), FakeSource(content)]
+
+        yield defer.gatherResults([
+            self.fetcher.fetch(digest, len(content), sources),
+            self.fetcher.fetch(digest, len(content), sources),
+        ])
+
+        self.assertEquals(self.cache.getPath(digest).getContent(), content)
+
+        # Each chunk was requested only once, from both sources
+        self.assertEquals(sum(s.requests for s in sources), 5)
+        self.assertTrue(all(s.requests for s in sources))
+
+        # Cached images are not fetched again
+        yield self.fetcher.fetch(digest, len(content), sources)
+        self.assertEquals(sum(s.requests for s in sources), 5)
+
+
+    @defer.inlineCallbacks
+    def test_digestMismatch(self):
+        digest = digestOf('expected')
+
+        yield self.failUnlessFailure(self.fetcher.fetch(digest, 8,
+                [FakeSource('received')]), error.UnknownImage)
+
+        self.assertFalse(self.cache.has(digest))
+        self.assertFalse(self.cache.getTemporaryPath(digest).exists())
+
+
+
+class ImageDistributorTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_waves(self):
+        hosts = dict(('host{0}'.format(i), FakeHost()) for i in range(8))
+        hosts['host0'].size = 100
+
+        distributor = images.ImageDistributor(FakeConnectionsPool(hosts))
+        targets = sorted(hosts)[1:]
+
+        result = yield distributor.distribute('digest', targets)
+        self.assertEquals(result, targets)
+
+        # The number of sources doubles at each wave
+        self.assertEquals([len(hosts[t].fetched[0]) for t in targets],
+                [1, 2, 2, 4, 4, 4, 4])
+        self.assertEquals(hosts['host1'].fetched, [['host0']])
+        self.assertEquals(hosts['host0'].fetched, [])
+
+
+    def test_noSource(self):
+        hosts = {'host0': FakeHost(), 'host1': FakeHost()}
+        distributor = images.ImageDistributor(FakeConnectionsPool(hosts))
+
+        return self.failUnlessFailure(distributor.distribute('digest',
+                ['host0']), error.UnknownImage)
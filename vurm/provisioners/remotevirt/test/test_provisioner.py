@@ -2,12 +2,14 @@
 
 import ConfigParser
 
+from lxml import etree
+
 from twisted.trial import unittest
 from twisted.python import filepath
 from twisted.internet import reactor, endpoints, defer
 
 from vurm.provisioners.remotevirt import provisioner, remote
-from vurm import spread
+from vurm import spread, error
 
 
 
@@ -29,24 +31,100 @@ SLURM_CONFIG = """SlurmConfig"""
 
 class FakeDomainManager(object):
 
-    def __init__(self):
+    def __init__(self, cpus=1000, freeMemory=2 ** 30, maxDomains=None):
         self.created = 0
         self.destroyed = 0
         self.spawned = 0
         self.configs = {}
+        self.pushed = {}
+        self.batches = []
+        self.failing = set()
+        self.rejectConfigs = False
+        self.imageSize = None
+        self.fetched = []
+        self.running = {}
+        self.capacity = {
+            'domains': 0,
+            'cpus': cpus,
+            'memory': freeMemory,
+            'freeMemory': freeMemory,
+        }
+
+        if maxDomains is not None:
+            self.capacity['maxDomains'] = maxDomains
+
+
+    def getCapacity(self):
+        capacity = self.capacity.copy()
+        capacity['domains'] = self.created - self.destroyed
+        return defer.succeed(capacity)
+
+
+    def createDomains(self, description, nodeNames, created=None):
+        self.batches.append(nodeNames)
+        domains = []
+
+        for nodeName in nodeNames:
+            if nodeName in self.failing:
+                domains.append({'nodeName': nodeName, 'error': u'Failed'})
+                continue
+
+            self.created += 1
+            self.running[nodeName] = 'localhost'
+
+            if created:
+                created(nodeName, 'localhost')
+
+            domains.append({'nodeName': nodeName, 'hostname': 'localhost'})
+
+        return defer.succeed(domains)
+
+
+    def destroyDomains(self, nodeNames):
+        self.batches.append(nodeNames)
+        domains = []
+
+        for nodeName in nodeNames:
+            if nodeName in self.failing:
+                domains.append({'nodeName': nodeName, 'error': u'Failed'})
+                continue
+
+            self.destroyed += 1
+            self.running.pop(nodeName, None)
+            domains.append({'nodeName': nodeName})
 
+        return defer.succeed(domains)
 
-    def createDomain(self, description):
-        self.created += 1
-        return defer.succeed('localhost')
 
+    def listDomains(self):
+        return [{'nodeName': n, 'hostname': h}
+                for n, h in sorted(self.running.iteritems())]
 
-    def destroyDomain(self, nodeName):
-        self.destroyed += 1
+
+    def hasImage(self, digest):
+        if self.imageSize is None:
+            return {}
+        return {'size': self.imageSize}
+
+
+    def fetchImage(self, digest, size, sources):
+        self.fetched.append((digest, sources))
+        self.imageSize = size
         return defer.succeed(None)
 
 
-    def spawnDaemon(self, nodeName, slurmConfig):
+    def pushConfig(self, digest, slurmConfig):
+        if self.rejectConfigs:
+            raise error.UnknownConfiguration(digest)
+        self.pushed[digest] = slurmConfig
+
+
+    def spawnDaemon(self, nodeName, slurmConfig=None, configDigest=None):
+        if slurmConfig is None:
+            if configDigest not in self.pushed:
+                raise error.UnknownConfiguration(configDigest)
+            slurmConfig = self.pushed[configDigest]
+
         self.spawned += 1
         self.configs[nodeName] = slurmConfig
         return defer.succeed(None)
@@ -122,6 +200,20 @@ class ProvisionerTestCase(unittest.TestCase):
         defer.returnValue((prov, manager))
 
 
+    @defer.inlineCallbacks
+    def createProvisionerWithManagers(self, *managers):
+        endpoints = []
+
+        for manager in managers:
+            endpoint = yield self.startListening(manager)
+            endpoints.append(endpoint)
+
+        self.config.set('libvirt', 'nodes', '\n'.join(endpoints))
+        prov = provisioner.Provisioner(reactor, self.config)
+        self.provisioners.append(prov)
+        defer.returnValue(prov)
+
+
     @defer.inlineCallbacks
     def test_getNodes(self):
         prov, manager = yield self.createProvisionerWithNodes(10)
@@ -146,6 +238,105 @@ class ProvisionerTestCase(unittest.TestCase):
         self.assertEquals(0, manager.destroyed)
 
 
+    @defer.inlineCallbacks
+    def test_batchedRequests(self):
+        manager = FakeDomainManager()
+        manager.failing.add('c')
+        prov = yield self.createProvisionerWithManagers(manager)
+
+        results = yield defer.DeferredList(prov.getNodes(4, iter('abcd')),
+                consumeErrors=True)
+
+        self.assertEquals(manager.batches, [['a', 'b', 'c', 'd']])
+        self.assertEquals([success for success, _ in results],
+                [True, True, False, True])
+        results[2][1].trap(error.DomainCreationFailed)
+
+        nodes = [node for success, node in results if success]
+        self.assertEquals([n.nodeName for n in nodes], ['a', 'b', 'd'])
+        self.assertEquals(set(n.hostname for n in nodes), set(['localhost']))
+
+        # Releases are coalesced as well
+        yield defer.gatherResults([node.release() for node in nodes])
+        self.assertEquals(manager.batches[1:], [['a', 'b', 'd']])
+        self.assertEquals(manager.destroyed, 3)
+
+
+    @defer.inlineCallbacks
+    def test_imageDistribution(self):
+        digest = '0123456789abcdef0123456789abcdef01234567'
+        self.tmpXML.setContent(DOMAIN_CONFIG.replace('debian-base.qcow2',
+                digest))
+
+        seed, other = FakeDomainManager(maxDomains=1), FakeDomainManager()
+        seed.imageSize = 100
+        prov = yield self.createProvisionerWithManagers(seed, other)
+
+        yield defer.gatherResults(prov.getNodes(2, iter('ab')))
+
+        self.assertEquals(seed.fetched, [])
+        self.assertEquals(len(other.fetched), 1)
+        self.assertEquals(other.fetched[0][0], digest)
+        self.assertEquals(seed.created + other.created, 2)
+
+
+    def test_domainTemplate(self):
+        template = provisioner.DomainTemplate(self.tmpXML.path)
+
+        description = template.get()
+        self.assertIdentical(template.get(), description)
+        self.assertEquals(template.getResources(), (None, 1))
+
+        self.tmpXML.setContent(DOMAIN_CONFIG.replace('<devices>',
+                '<vcpu>2</vcpu><devices>'))
+
+        self.assertNotIdentical(template.get(), description)
+        self.assertEquals(template.getResources(), (None, 2))
+
+
+    @defer.inlineCallbacks
+    def test_configDistribution(self):
+        manager = FakeDomainManager()
+        prov = yield self.createProvisionerWithManagers(manager)
+
+        nodes = yield defer.gatherResults(prov.getNodes(5, iter('abcde')))
+        yield defer.gatherResults([node.spawn() for node in nodes])
+
+        # Pushed once, referenced by digest afterwards
+        self.assertEquals(manager.pushed.values(), [SLURM_CONFIG])
+        self.assertEquals(set(manager.configs.values()), set([SLURM_CONFIG]))
+
+        # Changed configurations are pushed again
+        self.tmpConfig.setContent('NewConfig')
+        yield nodes[0].spawn()
+        self.assertEquals(len(manager.pushed), 2)
+        self.assertEquals(manager.configs['a'], 'NewConfig')
+
+        # Hosts which lost their cache get the configuration again
+        manager.pushed.clear()
+        yield nodes[1].spawn()
+        self.assertEquals(manager.pushed.values(), ['NewConfig'])
+        self.assertEquals(manager.configs['b'], 'NewConfig')
+
+
+    @defer.inlineCallbacks
+    def test_configPushFailure(self):
+        manager = FakeDomainManager()
+        prov = yield self.createProvisionerWithManagers(manager)
+        nodes = yield defer.gatherResults(prov.getNodes(2, iter('ab')))
+
+        # Rejected configurations are reported with their own error
+        manager.rejectConfigs = True
+        yield self.failUnlessFailure(nodes[0].spawn(),
+                error.UnknownConfiguration)
+        self.assertEquals(manager.spawned, 0)
+
+        # Nothing was recorded as pushed, the next spawn pushes again
+        manager.rejectConfigs = False
+        yield nodes[1].spawn()
+        self.assertEquals(manager.pushed.values(), [SLURM_CONFIG])
+
+
     @defer.inlineCallbacks
     def test_releaseNodes(self):
         prov, manager = yield self.createProvisionerWithNodes(10)
@@ -159,6 +350,148 @@ class ProvisionerTestCase(unittest.TestCase):
         self.assertEquals(10, manager.destroyed)
 
 
+    @defer.inlineCallbacks
+    def test_releaseFailure(self):
+        prov, manager = yield self.createProvisionerWithNodes(3)
+        nodes = yield defer.gatherResults(prov.getNodes(3, iter('abc')))
+
+        # Only the release of the failing node fails
+        manager.failing.add('b')
+        results = yield defer.DeferredList([n.release() for n in nodes],
+                consumeErrors=True)
+
+        self.assertEquals([success for success, _ in results],
+                [True, False, True])
+        results[1][1].trap(error.DomainDestructionFailed)
+        self.assertEquals(manager.running.keys(), ['b'])
+
+
+
+    @defer.inlineCallbacks
+    def test_restoreNodes(self):
+        first, second = FakeDomainManager(), FakeDomainManager()
+        prov = yield self.createProvisionerWithManagers(first, second)
+
+        nodes = yield defer.gatherResults(prov.getNodes(4, iter('abcd')))
+        states = [n.getState() for n in nodes]
+
+        # Simulate a controller restart during which a domain disappeared
+        # and an unknown one appeared
+        lost = nodes[0]
+        for manager in [first, second]:
+            manager.running.pop(lost.nodeName, None)
+        first.running['orphan'] = 'localhost'
+
+        restarted = provisioner.Provisioner(reactor, self.config)
+        self.provisioners.append(restarted)
+
+        restored = yield restarted.restoreNodes(states + [{
+            'nodeName': 'x', 'hostname': 'h', 'endpoint': 'tcp:elsewhere'}])
+
+        self.assertEquals(sorted(n.nodeName for n in restored),
+                sorted(n.nodeName for n in nodes[1:]))
+        self.assertEquals(sorted(n.getState() for n in restored),
+                sorted(states[1:]))
+        self.assertNotIn('orphan', first.running)
+
+        # Restored nodes can be released as usual
+        yield defer.DeferredList([n.release() for n in restored])
+        self.assertEquals(first.running, {})
+        self.assertEquals(second.running, {})
+
+
+    @defer.inlineCallbacks
+    def test_spreadPlacement(self):
+        small, big = FakeDomainManager(2), FakeDomainManager(6)
+        prov = yield self.createProvisionerWithManagers(small, big)
+
+        nodes = prov.getNodes(6, iter('abcdefghijklmnop'))
+        yield defer.gatherResults(nodes)
+
+        self.assertEquals(small.created, 1)
+        self.assertEquals(big.created, 5)
+
+
+    @defer.inlineCallbacks
+    def test_packPlacement(self):
+        self.config.set('libvirt', 'placement', 'pack')
+
+        small, big = FakeDomainManager(2), FakeDomainManager(6)
+        prov = yield self.createProvisionerWithManagers(small, big)
+
+        nodes = prov.getNodes(4, iter('abcdefghijklmnop'))
+        yield defer.gatherResults(nodes)
+
+        self.assertEquals(small.created, 2)
+        self.assertEquals(big.created, 2)
+
+
+    @defer.inlineCallbacks
+    def test_roundRobinPlacement(self):
+        self.config.set('libvirt', 'placement', 'roundrobin')
+
+        managers = [FakeDomainManager() for _ in range(3)]
+        prov = yield self.createProvisionerWithManagers(*managers)
+
+        # Each request reserves and releases its host before the next one,
+        # sequential requests still rotate across all the hosts
+        names = iter('abcdefghijklmnop')
+
+        for _ in range(6):
+            yield defer.gatherResults(prov.getNodes(1, names))
+
+        self.assertEquals([m.created for m in managers], [2, 2, 2])
+
+
+    @defer.inlineCallbacks
+    def test_memoryLimit(self):
+        with self.tmpXML.open('w') as fh:
+            fh.write(DOMAIN_CONFIG.replace('<devices>',
+                    '<memory unit="MiB">512</memory><devices>'))
+
+        small = FakeDomainManager(freeMemory=1024 * 1024)
+        big = FakeDomainManager(maxDomains=1)
+        prov = yield self.createProvisionerWithManagers(small, big)
+
+        capacity = yield prov.getCapacity()
+        self.assertEquals(capacity, 3)
+
+        nodes = prov.getNodes(5, iter('abcdefghijklmnop'))
+        self.assertEquals(len(nodes), 3)
+        yield defer.gatherResults(nodes)
+
+        self.assertEquals(small.created, 2)
+        self.assertEquals(big.created, 1)
+
+
+    @defer.inlineCallbacks
+    def test_insufficientCapacity(self):
+        manager = FakeDomainManager(1)
+        prov = yield self.createProvisionerWithManagers(manager)
+
+        nodes = prov.getNodes(2, iter('abcdefghijklmnop'))
+
+        yield nodes[0]
+        yield self.failUnlessFailure(nodes[1],
+                error.InsufficientResourcesException)
+
+
+    def test_domainResources(self):
+        description = etree.fromstring('<domain><memory unit="GiB">1' \
+                '</memory><vcpu>2</vcpu></domain>')
+        self.assertEquals(provisioner.getDomainResources(description),
+                (1024 * 1024, 2))
+
+        description = etree.fromstring('<domain><memory>1024</memory>' \
+                '</domain>')
+        self.assertEquals(provisioner.getDomainResources(description),
+                (1024, 1))
+
+        description = etree.fromstring('<domain/>')
+        self.assertEquals(provisioner.getDomainResources(description),
+                (None, 1))
+
+
 
 class LocalNodeTestCase(unittest.TestCase):
     pass
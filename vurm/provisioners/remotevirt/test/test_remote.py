@@ -1,17 +1,19 @@
 
 import ConfigParser
 import getpass
+import hashlib
+import threading
 
 from lxml import etree
 
 from twisted.trial import unittest
-from twisted.internet import reactor, protocol, defer
+from twisted.internet import reactor, protocol, defer, task
 from twisted.protocols import basic
 from twisted.python import filepath
 from twisted.conch.ssh import keys
 
 from vurm.provisioners.remotevirt import remote, libvirt
-from vurm import error
+from vurm import error, spread
 
 from .test_ssh import TestSSHServer, PRIVATE_KEY
 
@@ -48,6 +50,35 @@ class AddressTestProtocol(basic.LineReceiver):
 
 
 
+class AcknowledgingAddressTestProtocol(basic.LineReceiver):
+
+    def connectionMade(self):
+        self.sendLine(self.factory.hostname)
+        self.sendLine(remote.IPReceiver.READY)
+
+    def lineReceived(self, line):
+        self.factory.key = line
+        self.sendLine(remote.IPReceiver.ACK)
+
+
+
+class DisconnectingAddressTestProtocol(basic.LineReceiver):
+
+    def connectionMade(self):
+        self.sendLine(self.factory.hostname)
+
+        if self.factory.ready:
+            self.sendLine(remote.IPReceiver.READY)
+        else:
+            self.transport.loseConnection()
+
+    def lineReceived(self, line):
+        # Drop the connection without acknowledging the key
+        self.factory.key = line
+        self.transport.loseConnection()
+
+
+
 class DomainManagerTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -66,17 +97,58 @@ class DomainManagerTestCase(unittest.TestCase):
             fh.write(PRIVATE_KEY)
 
 
-    def test_getHypervisor(self):
+    def getManager(self):
         manager = remote.DomainManager(reactor, self.config)
+        self.addCleanup(manager.executor.stop)
+        return manager
+
+
+    def test_getHypervisor(self):
+        manager = self.getManager()
 
         with manager.getHypervisor() as hypervisor:
             self.assertEquals(hypervisor.uri, 'test:///mocked')
 
+        # The connection is kept open and reused
+        self.assertFalse(hypervisor.closed)
+
+        with manager.getHypervisor() as other:
+            self.assertIdentical(hypervisor, other)
+
+            with manager.getHypervisor() as concurrent:
+                self.assertNotIdentical(hypervisor, concurrent)
+
+        manager.stop()
+        self.assertTrue(hypervisor.closed)
+        self.assertTrue(concurrent.closed)
+
+
+    def test_getHypervisorReconnect(self):
+        manager = self.getManager()
+
+        # Broken connections are discarded
+        with manager.getHypervisor() as hypervisor:
+            pass
+        hypervisor.close()
+
+        with manager.getHypervisor() as other:
+            self.assertNotIdentical(hypervisor, other)
+
+        # Connections raising errors are closed
+        try:
+            with manager.getHypervisor() as hypervisor:
+                raise libvirt.LibvirtError(0)
+        except libvirt.LibvirtError:
+            pass
+
         self.assertTrue(hypervisor.closed)
 
+        with manager.getHypervisor() as other:
+            self.assertNotIdentical(hypervisor, other)
+
 
     def test_getHypervisorError(self):
-        manager = remote.DomainManager(reactor, self.config)
+        manager = self.getManager()
 
         self.config.set('vurmd-libvirt', 'hypervisor', 'test:///error/0')
         self.assertRaises(
@@ -90,9 +162,34 @@ class DomainManagerTestCase(unittest.TestCase):
             manager.getHypervisor
         )
 
+    @defer.inlineCallbacks
+    def test_getCapacity(self):
+        manager = self.getManager()
+
+        capacity = yield manager.getCapacity()
+        latency = capacity.pop('libvirtLatency')
+        maxLatency = capacity.pop('libvirtMaxLatency')
+        self.assertEquals(capacity, {
+            'domains': 3,
+            'cpus': 8,
+            'memory': 4096 * 1024,
+            'freeMemory': 2048 * 1024,
+            'libvirtPending': 0,
+            'libvirtRunning': 0,
+        })
+
+        # The load of the libvirt executor includes the capacity query itself
+        self.assertTrue(maxLatency >= latency > 0)
+
+        self.config.set('vurmd-libvirt', 'maxdomains', '5')
+
+        capacity = yield manager.getCapacity()
+        self.assertEquals(capacity['maxDomains'], 5)
+
+
     @defer.inlineCallbacks
     def test_exchangeAddressAndKey(self):
-        manager = remote.DomainManager(reactor, self.config)
+        manager = self.getManager()
 
         d, portNumber = yield manager.exchangeAddressAndKey()
 
@@ -106,9 +203,57 @@ class DomainManagerTestCase(unittest.TestCase):
         self.assertEquals(factory.key, PUBLIC_KEY)
 
 
+    @defer.inlineCallbacks
+    def test_acknowledgedHandshake(self):
+        # The fallback delays would make this test time out
+        self.config.set('vurmd-libvirt', 'handshaketimeout', '60')
+        manager = self.getManager()
+
+        d, portNumber = yield manager.exchangeAddressAndKey()
+
+        factory = protocol.ClientFactory()
+        factory.protocol = AcknowledgingAddressTestProtocol
+        factory.hostname = 'localhost'
+        reactor.connectTCP('localhost', portNumber, factory)
+
+        hostname = yield d
+        self.assertEquals(hostname, 'localhost')
+        self.assertEquals(factory.key, PUBLIC_KEY)
+    test_acknowledgedHandshake.timeout = 10
+
+
+    @defer.inlineCallbacks
+    def test_interruptedHandshake(self):
+        # The fallback delays would make this test time out
+        self.config.set('vurmd-libvirt', 'handshaketimeout', '60')
+        manager = self.getManager()
+
+        factory = protocol.ClientFactory()
+        factory.protocol = DisconnectingAddressTestProtocol
+        factory.hostname = 'localhost'
+
+        # Disconnected after the key was sent but before the acknowledgement
+        d, portNumber = yield manager.exchangeAddressAndKey()
+        factory.ready = True
+        reactor.connectTCP('localhost', portNumber, factory)
+
+        hostname = yield d
+        self.assertEquals(hostname, 'localhost')
+        self.assertEquals(factory.key, PUBLIC_KEY)
+
+        # Disconnected before the key could be sent
+        d, portNumber = yield manager.exchangeAddressAndKey()
+        factory.ready = False
+        reactor.connectTCP('localhost', portNumber, factory)
+
+        yield self.failUnlessFailure(d, error.DomainCreationFailed)
+    test_interruptedHandshake.timeout = 10
+
+
     @defer.inlineCallbacks
     def test_createDomain(self):
         # Setup fake cloning support
+        self.config.set('vurmd-libvirt', 'imagedir', '/base/image')
         self.config.set('vurmd-libvirt', 'clonedir', '/tmp/clonedir')
         self.config.set('vurmd-libvirt', 'hypervisor',
                 'test:///called/testCreateDomain')
@@ -119,7 +264,7 @@ class DomainManagerTestCase(unittest.TestCase):
         self.config.set('vurmd-libvirt', 'clonebin', cmd)
 
         # Create manager
-        manager = remote.DomainManager(reactor, self.config)
+        manager = self.getManager()
         origDesc = libvirt.DomainDescription(DOMAIN_CONFIG)
 
         def fakeAddressKeyExchanger():
@@ -144,12 +289,132 @@ class DomainManagerTestCase(unittest.TestCase):
         self.assertEquals(int(port), 1234)
 
 
+    @defer.inlineCallbacks
+    def test_createDomains(self):
+        manager = self.getManager()
+        names, created = [], []
+
+        def createDomain(description):
+            name = description.find('name').text
+            names.append(name)
+
+            if name == 'failing':
+                raise libvirt.LibvirtError(0)
+            elif name == 'noclone':
+                return defer.succeed(None)
+
+            return task.deferLater(reactor, 0, lambda: name + '.local')
+
+        manager.createDomain = createDomain
+
+        template = etree.fromstring(DOMAIN_CONFIG)
+        domains = yield manager.createDomains(template,
+                ['a', 'failing', 'noclone', 'b'],
+                lambda *args: created.append(args))
+
+        self.assertEquals(names, ['a', 'failing', 'noclone', 'b'])
+        self.assertEquals(template.find('name').text, 'testdomain')
+        self.assertEquals(created, [('a', 'a.local'), ('b', 'b.local')])
+
+        self.assertEquals(domains[0], {'nodeName': 'a', 'hostname': 'a.local'})
+        self.assertIn('error', domains[1])
+        self.assertIn('error', domains[2])
+        self.assertEquals(domains[3], {'nodeName': 'b', 'hostname': 'b.local'})
+
+        self.flushLoggedErrors(libvirt.LibvirtError)
+
+
+    @defer.inlineCallbacks
+    def test_destroyDomains(self):
+        manager = self.getManager()
+
+        def destroyDomain(nodeName):
+            if nodeName == 'failing':
+                raise libvirt.LibvirtError(0)
+            return task.deferLater(reactor, 0, lambda: None)
+
+        manager.destroyDomain = destroyDomain
+
+        domains = yield manager.destroyDomains(['a', 'failing', 'b'])
+
+        self.assertEquals(domains[0], {'nodeName': 'a'})
+        self.assertEquals(domains[1]['nodeName'], 'failing')
+        self.assertIn('error', domains[1])
+        self.assertEquals(domains[2], {'nodeName': 'b'})
+
+
+    @defer.inlineCallbacks
+    def test_bootFailure(self):
+        content = 'base image'
+        digest = hashlib.sha1(content).hexdigest()
+
+        cacheDir = filepath.FilePath(self.mktemp())
+        cacheDir.makedirs()
+        cacheDir.child(digest).setContent(content)
+        cloneDir = filepath.FilePath(self.mktemp())
+        cloneDir.makedirs()
+
+        self.config.set('vurmd-libvirt', 'imagedir', cacheDir.path)
+        self.config.set('vurmd-libvirt', 'clonedir', cloneDir.path)
+        self.config.set('vurmd-libvirt', 'clonebin', 'touch {destination}')
+        manager = self.getManager()
+
+        def failingExchange():
+            return defer.fail(error.DomainCreationFailed('No serial port'))
+        manager.exchangeAddressAndKey = failingExchange
+
+        config = libvirt.DomainDescription(DOMAIN_CONFIG)
+        config.document.find('name').text = 'inexistent'
+        config.setRootImagePath(cacheDir.child(digest))
+
+        yield self.failUnlessFailure(manager.bootDomain(config),
+                error.DomainCreationFailed)
+
+        # The base image is unpinned and the clone removed
+        self.assertEquals(dict(manager.imageCache.pins), {})
+        self.assertEquals(manager.baseImages, {})
+        self.assertEquals(cloneDir.children(), [])
+
+
+    @defer.inlineCallbacks
+    def test_fetchImage(self):
+        content = 'image content' * 10000
+        digest = hashlib.sha1(content).hexdigest()
+
+        # The source has the image in its cache
+        sourceDir = filepath.FilePath(self.mktemp())
+        sourceDir.makedirs()
+        sourceDir.child(digest).setContent(content)
+        self.config.set('vurmd-libvirt', 'imagedir', sourceDir.path)
+        source = self.getManager()
+        source.getImageCache()
+
+        factory = spread.InstanceProtocolFactory(
+                remote.DomainManagerProtocol, source)
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        endpoint = 'tcp:host=127.0.0.1:port={0}'.format(port.getHost().port)
+
+        self.config.set('vurmd-libvirt', 'imagedir', self.mktemp())
+        manager = self.getManager()
+
+        self.assertEquals(manager.hasImage(digest), {})
+        yield manager.fetchImage(digest, len(content), [endpoint])
+        self.assertEquals(manager.hasImage(digest), {'size': len(content)})
+
+        self.assertEquals(manager.getImageCache().getPath(digest).getContent(),
+                content)
+
+        yield self.failUnlessFailure(manager.fetchImage('0' * 40, 10,
+                [endpoint]), error.UnknownImage)
+
+
     @defer.inlineCallbacks
     def test_destroyDomain(self):
         tempDir = filepath.FilePath(self.mktemp())
         tempDir.makedirs()
         self.config.set('vurmd-libvirt', 'clonedir', tempDir.path)
-        manager = remote.DomainManager(reactor, self.config)
+        manager = self.getManager()
 
         # Inexistent
         yield manager.destroyDomain('inexistent')
@@ -177,6 +442,38 @@ class DomainManagerTestCase(unittest.TestCase):
         )
 
 
+    @defer.inlineCallbacks
+    def test_destroyPoolVolume(self):
+        self.config.set('vurmd-libvirt', 'clonebackend', 'pool')
+        self.config.set('vurmd-libvirt', 'clonepool', 'vurm')
+        manager = self.getManager()
+
+        # Volumes created in a storage pool are deleted through libvirt
+        volume = '/pools/vurm/existent.qcow2'
+        manager.images['existent'] = filepath.FilePath(volume)
+
+        yield manager.destroyDomain('existent')
+        self.assertIn(volume, libvirt.libvirt.Hypervisor.deletedVolumes)
+
+
+    def test_configCache(self):
+        self.config.set('vurmd-libvirt', 'configcache', '2')
+        manager = self.getManager()
+
+        digests = []
+
+        for config in ['a', 'b', 'c']:
+            digests.append(hashlib.sha1(config).hexdigest())
+            manager.pushConfig(digests[-1], config)
+
+        self.assertEquals(manager.getConfig(digests[2]), 'c')
+        self.assertRaises(error.UnknownConfiguration, manager.getConfig,
+                digests[0])
+
+        self.assertRaises(error.UnknownConfiguration, manager.pushConfig,
+                digests[0], 'b')
+
+
     @defer.inlineCallbacks
     def test_spawnDaemon(self):
         #import sys
@@ -189,8 +486,9 @@ class DomainManagerTestCase(unittest.TestCase):
         self.config.set('vurmd-libvirt', 'slurmconfig', '/path/to/slurmconf')
         self.config.set('vurmd-libvirt', 'slurmd', '/slurmd {nodeName}')
 
-        manager = remote.DomainManager(reactor, self.config)
+        manager = self.getManager()
         manager.addresses['testDomain'] = 'localhost'
+        manager.addresses['otherDomain'] = 'localhost'
 
         key = keys.Key.fromString(PRIVATE_KEY)
 
@@ -204,22 +502,84 @@ class DomainManagerTestCase(unittest.TestCase):
 
         yield manager.spawnDaemon('testDomain', 'slurmConfig')
 
+        manager.pushConfig(hashlib.sha1('slurmConfig').hexdigest(),
+                'slurmConfig')
+        yield manager.spawnDaemon('otherDomain',
+                digest=hashlib.sha1('slurmConfig').hexdigest())
+
+        # The SSH session is reused until the domain is destroyed
+        yield manager.sessions.close('localhost')
         sshServer.stopListening()
 
         # Check
         self.assertEquals(len(sshServer.users), 1)
         user = sshServer.users[0]
 
-        mkdir, start = user.executedCommands
+        mkdir, start, _, _ = user.executedCommands
         self.assertEquals(mkdir, 'mkdir -p /path/to')
         self.assertEquals(start, '/slurmd testDomain')
 
-        self.assertEquals(len(user.openedFiles), 1)
+        self.assertEquals(len(user.openedFiles), 2)
         config = user.openedFiles[0]
         self.assertEquals(config.name, '/path/to/slurmconf')
         self.assertEquals(config.value, 'slurmConfig')
 
 
+    @defer.inlineCallbacks
+    def test_warmPool(self):
+        self.config.set('vurmd-libvirt', 'warmpool', '2')
+        self.config.set('vurmd-libvirt', 'clonedir', self.mktemp())
+
+        manager = self.getManager()
+
+        booted = []
+        def fakeBootDomain(config):
+            booted.append(config.getName())
+            address = '10.0.0.{0}'.format(len(booted))
+            return task.deferLater(reactor, 0, lambda: address)
+        manager.bootDomain = fakeBootDomain
+
+        # The first request boots its own domain and fills the pool
+        hostname = yield manager.createDomain(etree.fromstring(DOMAIN_CONFIG))
+        self.assertEquals(len(booted), 3)
+        self.assertEquals(booted[2], 'testdomain')
+        self.assertEquals(hostname, '10.0.0.3')
+
+        # The second one gets a pre-booted domain
+        description = etree.fromstring(DOMAIN_CONFIG)
+        description.find('name').text = 'otherdomain'
+        hostname = yield manager.createDomain(description)
+        self.assertEquals(hostname, '10.0.0.1')
+        self.assertEquals(manager.addresses['otherdomain'], '10.0.0.1')
+        self.assertEquals(manager.domains['otherdomain'], booted[0])
+
+        # The pool is refilled in the background
+        self.assertEquals(len(booted), 4)
+        yield task.deferLater(reactor, 0, lambda: None)
+        self.assertEquals(len(manager.warmPool.idle.values()[0]), 2)
+
+        # A different template gets its own pool
+        description = etree.fromstring(DOMAIN_CONFIG.replace('vda', 'vdb'))
+        yield manager.createDomain(description)
+        self.assertEquals(len(booted), 7)
+        yield task.deferLater(reactor, 0, lambda: None)
+
+        # Destroying the node destroys the pre-booted domain
+        destroyed = []
+        self.patch(libvirt.libvirt.Hypervisor, 'destroyedDomains', destroyed)
+
+        yield manager.destroyDomain('otherdomain')
+        self.assertEquals(destroyed, [booted[0]])
+        self.assertNotIn('otherdomain', manager.domains)
+        self.assertNotIn('otherdomain', manager.addresses)
+
+        # Idle domains are destroyed on shutdown
+        yield manager.stop()
+        idle = [d for d in booted[1:] if d not in ('testdomain', 'otherdomain')]
+        self.assertEquals(len(idle), 4)
+        self.assertEquals(sorted(destroyed[1:]), sorted(idle))
+
+
     @defer.inlineCallbacks
     def test_cloneFail(self):
         cloneDir = filepath.FilePath(self.mktemp())
@@ -229,7 +589,7 @@ class DomainManagerTestCase(unittest.TestCase):
         cmd = 'python {0} fail'.format(self.cloneScript)
         self.config.set('vurmd-libvirt', 'clonebin', cmd)
 
-        manager = remote.DomainManager(reactor, self.config)
+        manager = self.getManager()
 
         description = etree.fromstring(DOMAIN_CONFIG)
         d = manager.createDomain(description)
@@ -237,3 +597,61 @@ class DomainManagerTestCase(unittest.TestCase):
         self.assertNotEquals(result, None)
     test_cloneFail.todo = 'Exception raising for failed disk image clones ' \
             'is not yet implemented'
+
+
+
+class LibvirtExecutorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = remote.LibvirtExecutor(reactor, 1, 5)
+        self.addCleanup(self.executor.stop)
+
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        result = yield self.executor.run(lambda a, b: a + b, 1, b=2)
+        self.assertEquals(result, 3)
+
+        def fail():
+            raise libvirt.LibvirtError(0)
+
+        yield self.failUnlessFailure(self.executor.run(fail),
+                libvirt.LibvirtError)
+
+
+    @defer.inlineCallbacks
+    def test_queueDepth(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        first = self.executor.run(block)
+        second = self.executor.run(block)
+
+        started.wait(5)
+        self.assertEquals(self.executor.running, 1)
+        self.assertEquals(self.executor.pending, 1)
+
+        release.set()
+        yield defer.gatherResults([first, second])
+
+        stats = self.executor.getStats()
+        self.assertEquals(stats['pending'], 0)
+        self.assertEquals(stats['running'], 0)
+        self.assertEquals(stats['completed'], 2)
+
+        # The second call waited for the first one to complete
+        self.assertTrue(stats['max'] > stats['average'] > 0)
+
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        release = threading.Event()
+        self.executor.timeout = 0.1
+
+        d = self.executor.run(release.wait, 5)
+        yield self.failUnlessFailure(d, error.OperationTimeout)
+
+        release.set()
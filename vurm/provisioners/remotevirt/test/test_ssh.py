@@ -64,8 +64,11 @@ class TestFile(object):
 
 
     def writeChunk(self, offset, chunk):
-        # TODO: Ignoring offset
-        self.value += chunk
+        if self.name.startswith('/readonly'):
+            raise IOError('Read-only file system')
+
+        self.value = self.value[:offset].ljust(offset, '\0') + chunk + \
+                self.value[offset + len(chunk):]
 
 
     def close(self):
@@ -272,8 +275,102 @@ class SSHClientTestCase(unittest.TestCase):
         self.assertEquals(remoteFile.value, fh.getvalue())
 
 
+    @defer.inlineCallbacks
+    def test_filetransferWindowed(self):
+        content = ''.join(chr(i % 251) for i in range(100000))
+        progress = []
+
+        yield self.client.transferFile(StringIO(content),
+                filepath.FilePath('/remote'), chunkSize=4096, window=8,
+                progress=progress.append)
+
+        remoteFile = self.server.users[0].openedFiles[0]
+        self.assertEquals(remoteFile.value, content)
+        self.assertTrue(remoteFile.closed)
+
+        self.assertEquals(len(progress), 25)
+        self.assertEquals(progress, sorted(progress))
+        self.assertEquals(progress[-1], len(content))
+
+
+    @defer.inlineCallbacks
+    def test_filetransferError(self):
+        fh = StringIO('x' * 10000)
+
+        yield self.failUnlessFailure(self.client.transferFile(fh,
+                filepath.FilePath('/readonly'), chunkSize=1000),
+                filetransfer.SFTPError)
+
+        remoteFile = self.server.users[0].openedFiles[0]
+        self.assertTrue(remoteFile.closed)
+
+        self.flushLoggedErrors(IOError)
+
+
     def test_executeCommandFail(self):
         return self.failUnlessFailure(
             self.client.executeCommand('retcode 1'),
             ssh.RemoteCommandFailed
         )
+
+
+
+class SessionCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        key = keys.Key.fromString(PRIVATE_KEY)
+
+        self.tmpKeys = filepath.FilePath(self.mktemp())
+
+        with self.tmpKeys.open('w') as fh:
+            fh.write(key.public().toString('OPENSSH'))
+
+        self.server = TestSSHServer(key, self.tmpKeys)
+        port = self.server.startListening()
+
+        self.cache = ssh.SessionCache(reactor, getpass.getuser(), key, port)
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.cache.closeAll()
+        self.server.stopListening()
+
+
+    @defer.inlineCallbacks
+    def test_reuse(self):
+        first, second = yield defer.gatherResults([
+            self.cache.getSession('localhost'),
+            self.cache.getSession('localhost'),
+        ])
+        self.assertIdentical(first, second)
+
+        yield first.executeCommand('echo 1')
+        yield second.executeCommand('echo 2')
+
+        self.assertEquals(len(self.server.users), 1)
+        self.assertEquals(self.server.users[0].executedCommands,
+                ['echo 1', 'echo 2'])
+
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        first = yield self.cache.getSession('localhost')
+        yield first.disconnect()
+
+        second = yield self.cache.getSession('localhost')
+        self.assertNotIdentical(first, second)
+
+        result = yield second.executeCommand('echo 1')
+        self.assertEquals(result, '1')
+
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        yield self.cache.close('localhost')
+
+        session = yield self.cache.getSession('localhost')
+        yield self.cache.close('localhost')
+
+        self.assertTrue(session.connectionAlreadyLost)
+        self.assertEquals(self.cache.sessions, {})
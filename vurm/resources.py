@@ -54,6 +54,29 @@ class IResourceProvisioner(Interface):  # pragma: no cover
         """
 
 
+    def getCapacity():
+        """
+        Returns a deferred which fires with the number of nodes this
+        provisioner is currently able to allocate, or with ``None`` if this
+        number is unknown or unlimited.
+
+        The vurm controller uses this value to split requests among multiple
+        provisioners; it is an estimate and does not reserve any resource.
+        """
+
+
+    def restoreNodes(states):
+        """
+        Optional. Receives the states (as returned by ``INode.getState``) of
+        all the nodes recorded in the state journal of the vurm controller
+        when it restarts, and returns a deferred firing with the list of the
+        nodes which belong to this provisioner and are still running.
+
+        Provisioners which do not implement this method lose their nodes
+        when the controller restarts.
+        """
+
+
 
 class INode(Interface):  # pragma: no cover
     """
@@ -78,6 +101,16 @@ class INode(Interface):  # pragma: no cover
         """
 
 
+    def getConfigAttributes():
+        """
+        Optional. Returns the list of ``(name, value)`` tuples of the
+        attributes of the configuration entry of this node, without the
+        ``NodeName`` one. Virtual clusters use them to describe similar nodes
+        with a single compact entry (see ``slurm.formatNodeEntries``); the
+        ``getConfigEntry`` method is used for nodes not implementing it.
+        """
+
+
     def spawn():
         """
         Does all what necessary to start the slurmd daemon for this node and
@@ -94,3 +127,13 @@ class INode(Interface):  # pragma: no cover
         Releases all resources currently allocated to this node. If necessary,
         this method causes the slurm daemon to terminate.
         """
+
+
+    def getState():
+        """
+        Optional. Returns a JSON serializable dictionary describing this
+        node, which is recorded in the state journal of the vurm controller
+        and passed back to ``IResourceProvisioner.restoreNodes`` to re-adopt
+        the node after a controller restart. It has to contain at least the
+        ``nodeName`` and ``hostname`` keys.
+        """
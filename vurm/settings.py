@@ -48,3 +48,23 @@ def loadConfig(path=None, defaults=None):
         config.readfp(path.open())
 
     return config
+
+
+
+def getOption(config, section, option, default=None, type=str):
+    """
+    Returns the value of ``option`` in ``section`` converted by calling
+    ``type`` on it, or ``default`` if the option (or the whole section) is not
+    defined.
+
+    Boolean options (``type=bool``) are parsed with the same rules as the
+    ``getboolean`` method of the configuration parser.
+    """
+
+    if not config.has_option(section, option):
+        return default
+
+    if type is bool:
+        return config.getboolean(section, option)
+
+    return type(config.get(section, option))
@@ -0,0 +1,954 @@
+"""
+Utilities to manage the configuration of the local SLURM controller daemon.
+"""
+
+
+
+import hashlib
+import itertools
+import os
+import pipes
+import re
+import shutil
+import tempfile
+
+from twisted.internet import defer, utils, threads
+from twisted.python import failure, filepath
+
+from vurm import logging, error, settings
+
+
+
+LIST_ATTRIBUTES = ('NodeHostname', 'NodeAddr')
+"""
+The node attributes which SLURM accepts as a comma separated list, with one
+value for each node of a ``NodeName`` hostlist expression.
+"""
+
+
+MAX_NODES_PER_LINE = 128
+"""
+The maximum number of nodes described by a single ``NodeName`` line, to keep
+the lines (and their hostname lists) of a reasonable length.
+"""
+
+
+
+def hostlistKey(name):
+    """
+    Splits a node name in a ``(prefix, width, index)`` tuple, where ``index``
+    is the numeric suffix of the name (or ``None`` if there is none) and
+    ``width`` its zero padded length (or 0 if it is not zero padded).
+
+    Sorting node names by this key gives the order in which SLURM expands the
+    hostlist expressions returned by ``compressHostlist``.
+    """
+
+    match = re.match(r'^(.*?)(\d+)$', name)
+
+    if match is None:
+        return (name, 0, None)
+
+    prefix, index = match.groups()
+    width = len(index) if len(index) > 1 and index[0] == '0' else 0
+
+    return (prefix, width, int(index))
+
+
+
+def compressHostlist(names):
+    """
+    Returns a SLURM hostlist expression matching all the given node names,
+    e.g. ``nd-abc-[0-3,5]`` for the names ``nd-abc-0`` to ``nd-abc-3`` and
+    ``nd-abc-5``.
+    """
+
+    keys = sorted(set(hostlistKey(name) for name in names))
+    expressions = []
+
+    for (prefix, width), group in itertools.groupby(keys, lambda k: k[:2]):
+        indexes = [index for _, _, index in group]
+
+        if indexes[0] is None:
+            expressions.append(prefix)
+            indexes = indexes[1:]
+
+            if not indexes:
+                continue
+
+        ranges = []
+
+        # Consecutive indexes have a constant difference with their position
+        for _, run in itertools.groupby(enumerate(indexes),
+                lambda item: item[1] - item[0]):
+            run = [index for _, index in run]
+            ranges.append('{0:0{2}d}-{1:0{2}d}'.format(run[0], run[-1], width)
+                    if len(run) > 1 else '{0:0{1}d}'.format(run[0], width))
+
+        if len(indexes) == 1:
+            expressions.append(prefix + ranges[0])
+        else:
+            expressions.append('{0}[{1}]'.format(prefix, ','.join(ranges)))
+
+    return ','.join(expressions)
+
+
+
+def expandHostlist(expression):
+    """
+    Returns the list of the node names matched by a SLURM hostlist
+    expression, in the order SLURM expands them. Only the forms generated by
+    ``compressHostlist`` are supported.
+    """
+
+    names = []
+
+    for prefix, ranges in re.findall(r'([^,\[]+)(?:\[([^\]]*)\])?',
+            expression):
+        if not ranges:
+            names.append(prefix)
+            continue
+
+        for interval in ranges.split(','):
+            start, _, end = interval.partition('-')
+
+            for index in range(int(start), int(end or start) + 1):
+                names.append('{0}{1:0{2}d}'.format(prefix, index, len(start)))
+
+    return names
+
+
+
+def parseEntries(content):
+    """
+    Parses the ``NodeName`` and ``PartitionName`` lines of the given SLURM
+    configuration content.
+
+    Returns a ``(nodes, partitions)`` tuple of dictionaries, mapping each
+    node name to the list of ``(name, value)`` tuples of its attributes (as
+    returned by ``INode.getConfigAttributes``) and each partition name to
+    the list of ``(name, value)`` tuples of its line.
+    """
+
+    nodes, partitions = {}, {}
+
+    for line in content.splitlines():
+        tokens = [t.partition('=')[::2] for t in line.split()]
+
+        if not tokens or line.lstrip().startswith('#'):
+            continue
+
+        key, value = tokens[0]
+
+        if key == 'PartitionName':
+            partitions[value] = tokens
+        elif key == 'NodeName':
+            names = expandHostlist(value)
+
+            for i, name in enumerate(names):
+                attributes = []
+
+                for attribute, attributeValue in tokens[1:]:
+                    values = attributeValue.split(',')
+
+                    if attribute in LIST_ATTRIBUTES and \
+                            len(values) == len(names):
+                        attributeValue = values[i]
+
+                    attributes.append((attribute, attributeValue))
+
+                nodes[name] = attributes
+
+    return nodes, partitions
+
+
+
+def formatNodeEntries(nodes, maxNodes=MAX_NODES_PER_LINE):
+    """
+    Returns the list of the ``NodeName`` lines describing the given list of
+    ``(nodeName, attributes)`` tuples, where ``attributes`` is a list of
+    ``(name, value)`` tuples.
+
+    Nodes with the same attributes, apart from the ones in
+    ``LIST_ATTRIBUTES``, are described together by a single line (of at most
+    ``maxNodes`` nodes) using a hostlist expression, e.g.
+    ``NodeName=nd-abc-[0-2] NodeHostname=10.0.0.1,10.0.0.3,10.0.0.2``.
+    """
+
+    groups = {}
+    order = []
+
+    for nodeName, attributes in sorted(nodes,
+            key=lambda node: hostlistKey(node[0])):
+        key = tuple((k, None if k in LIST_ATTRIBUTES else v)
+                for k, v in attributes)
+
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+
+        groups[key].append((nodeName, attributes))
+
+    lines = []
+
+    for key in order:
+        group = groups[key]
+
+        for start in range(0, len(group), maxNodes):
+            chunk = group[start:start + maxNodes]
+
+            values = ['NodeName={0}'.format(compressHostlist(
+                    [name for name, _ in chunk]))]
+
+            for i, (attribute, value) in enumerate(key):
+                if attribute in LIST_ATTRIBUTES:
+                    value = ','.join(str(a[i][1]) for _, a in chunk)
+                values.append('{0}={1}'.format(attribute, value))
+
+            lines.append(' '.join(values))
+
+    return lines
+
+
+
+def readConfig(path, files=None):
+    """
+    Reads the SLURM configuration file at ``path`` and returns its content
+    with all the ``Include`` directives recursively replaced by the content of
+    the included files.
+
+    Relative include paths are resolved against the directory of the file
+    containing the directive. If a ``files`` list is given, the path of each
+    read file is appended to it.
+    """
+
+    if files is not None:
+        files.append(path)
+
+    lines = []
+
+    with open(path) as fh:
+        for line in fh:
+            directive = line.strip().split(None, 1)
+
+            if len(directive) == 2 and directive[0].lower() == 'include':
+                included = os.path.join(os.path.dirname(path), directive[1])
+                lines.append(readConfig(included, files))
+            else:
+                lines.append(line)
+
+    return ''.join(lines)
+
+
+
+class ConfigReader(object):
+    """
+    Caches the expanded content of a SLURM configuration file along with its
+    SHA-1 digest, so that the content can be distributed once and referenced
+    by its digest afterwards.
+
+    The files are only read again if any of them (the main file or an
+    included one) was modified since the last read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = None
+        self.digest = None
+        self.content = None
+
+
+    def getStats(self, files):
+        stats = []
+
+        for path in files:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            stats.append((path, st.st_mtime, st.st_size))
+
+        return stats
+
+
+    def read(self):
+        """
+        Returns a ``(digest, content)`` tuple for the current content of the
+        configuration file.
+        """
+
+        if self.stats is None or \
+                self.getStats(f for f, _, _ in self.stats) != self.stats:
+            files = []
+            content = readConfig(self.path, files)
+
+            self.stats = self.getStats(files)
+            self.digest = hashlib.sha1(content).hexdigest()
+            self.content = content
+
+        return self.digest, self.content
+
+
+
+class AtomicFileWriter(object):
+    """
+    Writes files atomically by writing their content to a temporary file in
+    the same directory, syncing it to disk and renaming it over the original
+    one. Readers thus see either the old or the new content, never a partially
+    written file.
+
+    All the disk I/O is done in a thread pool, off the reactor thread.
+
+    Concurrent writes to the same path are grouped: while a write is in
+    progress, further requests only replace the content to write next and all
+    of them are fired once this content has been committed, sharing the same
+    ``fsync`` call.
+    """
+
+    def __init__(self, reactor, threadpool=None):
+        """
+        Creates a new writer running its blocking calls in the given thread
+        pool (defaults to the thread pool of the given reactor).
+        """
+
+        if threadpool is None:
+            threadpool = reactor.getThreadPool()
+
+        self.reactor = reactor
+        self.threadpool = threadpool
+
+        self.writing = set()
+        self.pending = {}
+
+
+    def deferToThread(self, func, *args, **kwargs):
+        """
+        Runs ``func`` in the thread pool of this writer and returns a deferred
+        which fires with its result.
+        """
+
+        return threads.deferToThreadPool(self.reactor, self.threadpool, func,
+                *args, **kwargs)
+
+
+    def write(self, path, content):
+        """
+        Replaces the content of the file at ``path`` with ``content``. Returns
+        a deferred which fires once the content has been committed to disk.
+        """
+
+        d = defer.Deferred()
+
+        _, waiters = self.pending.get(path, (None, []))
+        self.pending[path] = (content, waiters + [d])
+
+        if path not in self.writing:
+            self.startWrite(path)
+
+        return d
+
+
+    def startWrite(self, path):
+        """
+        Starts writing the pending content for ``path`` to disk.
+        """
+
+        content, waiters = self.pending.pop(path)
+        self.writing.add(path)
+
+        def written(result):
+            self.writing.remove(path)
+
+            if path in self.pending:
+                self.startWrite(path)
+
+            for d in waiters:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(None)
+
+        self.deferToThread(self.commit, path, content).addBoth(written)
+
+
+    def commit(self, path, content):
+        """
+        Atomically replaces the content of the file at ``path``. This method
+        blocks and is run in a separate thread.
+        """
+
+        directory, basename = os.path.split(os.path.abspath(path))
+
+        fd, temp = tempfile.mkstemp(prefix='.{0}.'.format(basename),
+                dir=directory)
+
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(content)
+                fh.flush()
+                os.fsync(fh.fileno())
+
+            if os.path.exists(path):
+                shutil.copymode(path, temp)
+            else:
+                os.chmod(temp, 0644)
+
+            os.rename(temp, path)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+        # Make the rename itself durable
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+    def read(self, path):
+        """
+        Reads the content of the file at ``path`` in the thread pool of this
+        writer and returns a deferred firing with it.
+        """
+
+        def read(path):
+            with open(path) as fh:
+                return fh.read()
+
+        return self.deferToThread(read, path)
+
+
+    def remove(self, path):
+        """
+        Removes the file at ``path`` in the thread pool of this writer and
+        returns a deferred firing once done.
+        """
+
+        return self.deferToThread(os.remove, path)
+
+
+
+class FileBackend(object):
+    """
+    Configuration backend which applies the edits directly to the SLURM
+    configuration file defined by the ``slurmconfig`` option.
+    """
+
+    def __init__(self, config, writer):
+        self.config = config
+        self.writer = writer
+
+
+    @defer.inlineCallbacks
+    def applyEdits(self, edits):
+        """
+        Applies the given list of ``(add, remove)`` tuples to the SLURM
+        configuration file by reading and writing it exactly once.
+        """
+
+        path = self.config.get('vurmctld', 'slurmconfig')
+
+        newConf = yield self.writer.read(path)
+
+        for add, remove in edits:
+            newConf = newConf.replace(remove, '')
+            newConf += add
+
+        yield self.writer.write(path, newConf)
+
+
+
+class FragmentsBackend(object):
+    """
+    Configuration backend which writes each added entry to its own fragment
+    file in the directory defined by the ``fragmentdir`` option.
+
+    The file defined by the ``fragmentindex`` option is regenerated after each
+    batch of edits and contains an ``Include`` directive for each fragment; it
+    has to be included by the main SLURM configuration file.
+
+    Only the fragments of the added or removed entries are written or
+    deleted, but the index is rewritten with one line per live fragment, so
+    each batch still costs file I/O proportional to the number of entries
+    (a short ``Include`` line each, instead of their whole content).
+    """
+
+    def __init__(self, config, writer):
+        self.config = config
+        self.writer = writer
+
+        self.directory = filepath.FilePath(config.get('vurmctld',
+                'fragmentdir'))
+        self.index = filepath.FilePath(config.get('vurmctld',
+                'fragmentindex'))
+
+        if not self.directory.exists():
+            self.directory.makedirs()
+
+        self.fragments = set(f.basename() for f in
+                self.directory.globChildren('*.conf'))
+
+
+    def getFragment(self, entry):
+        """
+        Returns the fragment file for the given entry. Fragments are named
+        after the digest of their content, so that the same entry can be
+        removed later on without knowing where it was stored.
+        """
+
+        return self.directory.child('{0}.conf'.format(
+                hashlib.sha1(entry).hexdigest()))
+
+
+    @defer.inlineCallbacks
+    def applyEdits(self, edits):
+        """
+        Writes (or deletes) the fragment for each of the given ``(add,
+        remove)`` tuples and regenerates the index file once.
+        """
+
+        writes, removes = {}, set()
+        existing = set(self.fragments)
+
+        for add, remove in edits:
+            if remove:
+                fragment = self.getFragment(remove).basename()
+                writes.pop(fragment, None)
+                self.fragments.discard(fragment)
+
+                if fragment in existing:
+                    removes.add(fragment)
+
+            if add:
+                fragment = self.getFragment(add).basename()
+                writes[fragment] = add
+                removes.discard(fragment)
+                self.fragments.add(fragment)
+
+        yield defer.gatherResults([
+            self.writer.write(self.directory.child(f).path, content)
+            for f, content in writes.iteritems()
+        ] + [
+            self.writer.remove(self.directory.child(f).path) for f in removes
+        ])
+
+        yield self.writer.write(self.index.path, ''.join(
+            'Include {0}\n'.format(self.directory.child(fragment).path)
+            for fragment in sorted(self.fragments)
+        ))
+
+
+
+CONFIG_BACKENDS = {
+    'file': FileBackend,
+    'fragments': FragmentsBackend,
+}
+"""
+Maps the values accepted by the ``configbackend`` option of the ``vurmctld``
+section to the respective configuration backend class.
+"""
+
+
+
+@defer.inlineCallbacks
+def runScript(script, worker=None, errexit=False):
+    """
+    Runs the shell ``script`` and returns a deferred firing with an
+    ``(output, status)`` tuple, the output including the standard error.
+
+    If a ``worker.ShellWorker`` instance is given, the script is run by its
+    long-lived shell; otherwise a new shell is spawned. If ``errexit`` is
+    ``True``, the script is aborted as soon as one of its commands fails.
+    """
+
+    if worker is None:
+        stdout, stderr, res = yield utils.getProcessOutputAndValue('sh',
+                ['-ec' if errexit else '-c', script], env=os.environ)
+        defer.returnValue((stdout + stderr, res))
+
+    try:
+        result = yield worker.run(script, errexit)
+    except Exception as e:
+        raise error.ReconfigurationError('Reconfiguration worker died: ' \
+                '{0}'.format(e))
+
+    defer.returnValue(result)
+
+
+
+class CommandReconfigurator(object):
+    """
+    Reconfigurator which makes the SLURM controller daemon reload its whole
+    configuration by invoking the shell command defined by the
+    ``reconfigure`` option (usually ``scontrol reconfigure``).
+    """
+
+    def __init__(self, config, worker=None):
+        self.config = config
+        self.worker = worker
+
+
+    @defer.inlineCallbacks
+    def reconfigure(self, edits):
+        cmd = self.config.get('vurmctld', 'reconfigure')
+
+        output, res = yield runScript(cmd, self.worker)
+
+        if res:
+            raise error.ReconfigurationError('Local slurm instance could' \
+                    ' not be reconfigured (return code: {0})'.format(res))
+
+
+
+class ScontrolReconfigurator(object):
+    """
+    Reconfigurator which applies the edits to the running SLURM controller
+    daemon with ``scontrol create``, ``update`` and ``delete`` commands for
+    the affected nodes and partitions only, instead of having it reload its
+    whole configuration. The configuration file is still written, so that it
+    is up to date when the daemon restarts.
+
+    The ``scontrol`` option defines the command to invoke (defaults to
+    ``scontrol``). The SLURM controller has to support dynamic nodes.
+
+    The commands of a failed batch which already succeeded are reverted, so
+    that the rollbacks of the controller, which are only written to the
+    configuration file, leave the daemon and the file consistent.
+    """
+
+    APPLIED_MARKER = 'vurm-scontrol-applied'
+
+
+    def __init__(self, config, worker=None):
+        self.config = config
+        self.worker = worker
+        self.log = logging.Logger(__name__, system='vurmctld')
+
+
+    def getChanges(self, edits):
+        """
+        Computes the net changes of the given list of ``(add, remove)``
+        tuples. Returns a ``(removed, added)`` tuple of ``(nodes,
+        partitions)`` tuples (see ``parseEntries``).
+        """
+
+        removedNodes, removedPartitions = {}, {}
+        addedNodes, addedPartitions = {}, {}
+
+        for add, remove in edits:
+            nodes, partitions = parseEntries(remove)
+
+            for removed, added, entries in [
+                    (removedNodes, addedNodes, nodes),
+                    (removedPartitions, addedPartitions, partitions)]:
+                for name, attributes in entries.iteritems():
+                    if name in added:
+                        del added[name]
+                    else:
+                        removed[name] = attributes
+
+            nodes, partitions = parseEntries(add)
+
+            for removed, added, entries in [
+                    (removedNodes, addedNodes, nodes),
+                    (removedPartitions, addedPartitions, partitions)]:
+                for name, attributes in entries.iteritems():
+                    if removed.get(name) == attributes:
+                        # Removed and added back unchanged
+                        del removed[name]
+                    else:
+                        added[name] = attributes
+
+        return ((removedNodes, removedPartitions),
+                (addedNodes, addedPartitions))
+
+
+    def getCommands(self, edits):
+        """
+        Returns the list of ``scontrol`` arguments lists to apply the given
+        edits, in the order in which they have to be run: nodes are created
+        before the partitions using them and deleted after them.
+        """
+
+        (removedNodes, removedPartitions), (addedNodes, addedPartitions) = \
+                self.getChanges(edits)
+
+        commands = []
+
+        for verb, names in [
+                ('update', [n for n in addedNodes if n in removedNodes]),
+                ('create', [n for n in addedNodes if n not in removedNodes])]:
+            for line in formatNodeEntries([(n, addedNodes[n])
+                    for n in names]):
+                commands.append([verb] + line.split())
+
+        for name in sorted(addedPartitions):
+            verb = 'update' if name in removedPartitions else 'create'
+            commands.append([verb] + ['{0}={1}'.format(*t)
+                    for t in addedPartitions[name]])
+
+        for name in sorted(removedPartitions):
+            if name not in addedPartitions:
+                commands.append(['delete', 'PartitionName={0}'.format(name)])
+
+        deleted = [n for n in removedNodes if n not in addedNodes]
+
+        if deleted:
+            commands.append(['delete', 'NodeName={0}'.format(
+                    compressHostlist(deleted))])
+
+        return commands
+
+
+    def getUndoCommands(self, commands, removed):
+        """
+        Returns the list of ``scontrol`` arguments lists reverting the given
+        (already applied) commands, in the order in which they have to be
+        run. ``removed`` is the ``(nodes, partitions)`` tuple describing the
+        state before the edits, as returned by ``getChanges``.
+        """
+
+        removedNodes, removedPartitions = removed
+        undo = []
+
+        for args in reversed(commands):
+            verb, (key, name) = args[0], args[1].partition('=')[::2]
+
+            if key == 'PartitionName':
+                if verb == 'create':
+                    undo.append(['delete', args[1]])
+                else:
+                    undo.append(['create' if verb == 'delete' else 'update'] +
+                            ['{0}={1}'.format(*t)
+                                    for t in removedPartitions[name]])
+            elif verb == 'create':
+                undo.append(['delete', args[1]])
+            else:
+                lines = formatNodeEntries([(n, removedNodes[n])
+                        for n in expandHostlist(name)])
+                undo.extend(['create' if verb == 'delete' else 'update'] +
+                        line.split() for line in lines)
+
+        return undo
+
+
+    def getScript(self, commands, marker=None):
+        scontrol = settings.getOption(self.config, 'vurmctld', 'scontrol',
+                'scontrol')
+
+        return ''.join('{0} {1}\n{2}'.format(scontrol, ' '.join(
+                pipes.quote(arg) for arg in args),
+                        'echo {0}\n'.format(marker) if marker else '')
+                for args in commands)
+
+
+    @defer.inlineCallbacks
+    def reconfigure(self, edits):
+        """
+        Applies the given edits with ``scontrol``. If one of the commands
+        fails, the ones which already succeeded are reverted, so that the
+        running daemon is left in the state it was before the edits, and an
+        ``error.ReconfigurationError`` is raised.
+        """
+
+        commands = self.getCommands(edits)
+
+        if not commands:
+            return
+
+        self.log.debug('Applying {0} scontrol commands', len(commands))
+
+        # Each successful command is followed by a marker line, which allows
+        # to know how many of them have to be reverted on failure
+        output, res = yield runScript(self.getScript(commands,
+                self.APPLIED_MARKER), self.worker, errexit=True)
+
+        lines = output.splitlines()
+        applied = lines.count(self.APPLIED_MARKER)
+        output = '\n'.join(l for l in lines if l != self.APPLIED_MARKER)
+
+        if not res:
+            return
+
+        if applied:
+            self.log.warning('Reverting {0} applied scontrol commands',
+                    applied)
+
+            removed, _ = self.getChanges(edits)
+            undo = self.getUndoCommands(commands[:applied], removed)
+            undoOutput, undoRes = yield runScript(self.getScript(undo),
+                    self.worker)
+
+            if undoRes:
+                self.log.error('Could not revert the applied scontrol ' \
+                        'commands (return code: {0}): {1}', undoRes,
+                        undoOutput.strip())
+
+        raise error.ReconfigurationError('Local slurm instance could' \
+                ' not be updated (return code: {0}): {1}'.format(res,
+                        output.strip()))
+
+
+
+RECONFIGURE_BACKENDS = {
+    'command': CommandReconfigurator,
+    'scontrol': ScontrolReconfigurator,
+}
+"""
+Maps the values accepted by the ``reconfigurebackend`` option of the
+``vurmctld`` section to the respective reconfigurator class. Reconfigurators
+are created with the configuration provider and an optional
+``worker.ShellWorker`` instance to run their commands.
+"""
+
+
+
+class ConfigurationScheduler(object):
+    """
+    Coalesces the edits to the SLURM configuration file requested in a given
+    time window and applies them all at once, with a single file write and
+    (at most) a single reconfiguration of the SLURM controller daemon.
+
+    Edits are applied in the same order they were requested; at most one batch
+    of edits is being applied at any given time.
+    """
+
+    def __init__(self, reactor, config, window=0, backend=None,
+            reconfigurator=None):
+        """
+        Creates a new scheduler which reads the reconfiguration command from
+        the ``vurmctld`` section of the given configuration provider.
+
+        The ``window`` parameter defines how many seconds to wait after the
+        first edit of a batch is requested before applying it.
+
+        The edits are written by the given ``backend``, which defaults to a
+        ``FileBackend`` instance writing through an ``AtomicFileWriter``, and
+        notified to the SLURM controller daemon by the given
+        ``reconfigurator``, which defaults to a ``CommandReconfigurator``.
+        """
+
+        if backend is None:
+            backend = FileBackend(config, AtomicFileWriter(reactor))
+
+        if reconfigurator is None:
+            reconfigurator = CommandReconfigurator(config)
+
+        self.reactor = reactor
+        self.config = config
+        self.window = window
+        self.backend = backend
+        self.reconfigurator = reconfigurator
+
+        self.pending = []
+        self.delayedCall = None
+        self.flushing = False
+
+        self.log = logging.Logger(__name__, system='vurmctld')
+
+
+    def schedule(self, add='', remove='', notify=True):
+        """
+        Queues an edit to the SLURM configuration which adds the ``add`` string
+        and removes the ``remove`` string to/from the configuration file.
+
+        If ``notify`` is ``True``, the SLURM controller daemon is reconfigured
+        once the batch containing this edit has been written.
+
+        Returns a deferred which fires with ``None`` once the batch containing
+        this edit has been applied. If the reconfiguration fails, all the
+        deferreds of the edits requesting a notification errback with an
+        ``error.ReconfigurationError`` exception.
+        """
+
+        if not add and not remove:
+            raise TypeError('Provide a value to add or one to remove')
+
+        d = defer.Deferred()
+        self.pending.append((add, remove, notify, d))
+        self.scheduleFlush()
+        return d
+
+
+    def scheduleFlush(self):
+        """
+        Schedules a flush of the pending edits after the configured window,
+        unless one is already scheduled or running.
+        """
+
+        if self.pending and not self.flushing and self.delayedCall is None:
+            self.delayedCall = self.reactor.callLater(self.window, self.flush)
+
+
+    def reconfigure(self, edits=()):
+        """
+        Notifies the given list of ``(add, remove)`` edits to the SLURM
+        controller daemon through the reconfigurator.
+
+        Raises an ``error.ReconfigurationError`` if the reconfiguration fails.
+        """
+
+        return defer.maybeDeferred(self.reconfigurator.reconfigure, edits)
+
+
+    @defer.inlineCallbacks
+    def flush(self):
+        """
+        Applies all pending edits and reconfigures the SLURM controller daemon
+        if at least one of them requested it, then fires the deferreds of all
+        the applied edits with the shared result.
+        """
+
+        self.delayedCall = None
+        self.flushing = True
+
+        batch, self.pending = self.pending, []
+
+        self.log.debug('Applying {0} coalesced SLURM configuration edits',
+                len(batch))
+
+        results = [None] * len(batch)
+
+        try:
+            try:
+                yield self.backend.applyEdits([(add, remove)
+                        for add, remove, _, _ in batch])
+            except Exception:
+                result = failure.Failure()
+                results = [result] * len(batch)
+                return
+
+            notified = [(add, remove) for add, remove, notify, _ in batch
+                    if notify]
+
+            if not notified:
+                return
+
+            try:
+                yield self.reconfigure(notified)
+            except error.ReconfigurationError:
+                reconfigureFailure = failure.Failure()
+            except Exception as e:
+                # Unexpected errors (e.g. the command being killed by a
+                # signal) must not wedge the scheduler
+                self.log.error('Unexpected reconfiguration failure: {0}',
+                        failure.Failure().getTraceback())
+                reconfigureFailure = failure.Failure(
+                        error.ReconfigurationError('Local slurm instance ' \
+                                'could not be reconfigured: {0!r}'.format(e)))
+            else:
+                return
+
+            results = [reconfigureFailure if notify else None
+                    for _, _, notify, _ in batch]
+        finally:
+            self.flushing = False
+            self.scheduleFlush()
+
+            for (_, _, _, d), result in zip(batch, results):
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
@@ -127,5 +127,9 @@ class ReconnectingConnectionsPool(object):
             self.reactor.connectTCP(client._host, client._port, factory)
 
 
+    def getConnection(self, endpoint):
+        return self.factories[endpoint].getConnection()
+
+
     def getNextConnection(self):
-        return self.factories[next(self.endpointsRoundRobin)].getConnection()
+        return self.getConnection(next(self.endpointsRoundRobin))
@@ -0,0 +1,84 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from vurm import admission, error
+
+
+
+class RequestSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = admission.RequestScheduler(1)
+        self.started = []
+        self.pending = {}
+
+
+    def request(self, name):
+        self.started.append(name)
+        d = self.pending[name] = defer.Deferred()
+        return d
+
+
+    def submit(self, user, priority, name):
+        return self.scheduler.submit(user, priority, self.request, name)
+
+
+    def test_concurrencyLimit(self):
+        results = []
+
+        self.submit(u'alice', 0, 'a1').addBoth(results.append)
+        self.submit(u'alice', 0, 'a2').addBoth(results.append)
+
+        self.assertEquals(self.started, ['a1'])
+
+        self.pending['a1'].callback('done')
+        self.assertEquals(self.started, ['a1', 'a2'])
+        self.assertEquals(results, ['done'])
+
+        # Failures release the slot as well
+        self.pending['a2'].errback(error.InsufficientResourcesException())
+        results[1].trap(error.InsufficientResourcesException)
+        self.assertEquals(self.scheduler.running, 0)
+
+
+    def test_fairness(self):
+        self.submit(u'alice', 0, 'running')
+
+        self.submit(u'alice', 0, 'a1')
+        self.submit(u'alice', 0, 'a2')
+        self.submit(u'alice', 0, 'a3')
+        self.submit(u'bob', 0, 'b1')
+        self.submit(u'bob', 0, 'b2')
+        self.submit(u'carol', 5, 'c1')
+
+        for name in ['running', 'c1', 'a1', 'b1', 'a2', 'b2']:
+            self.pending[name].callback(None)
+
+        self.assertEquals(self.started, ['running', 'c1', 'a1', 'b1', 'a2',
+                'b2', 'a3'])
+
+
+    def test_status(self):
+        self.submit(u'alice', 0, 'a1')
+        self.submit(u'alice', 0, 'a2')
+        self.submit(u'bob', 1, 'b1')
+        self.submit(u'alice', 1, 'a3')
+
+        self.assertEquals(self.scheduler.getStatus(), {
+            'running': 1,
+            'queued': 3,
+            'concurrency': 1,
+            'users': {u'alice': 2, u'bob': 1},
+        })
+
+
+    def test_maxQueued(self):
+        self.scheduler.maxQueued = 1
+
+        self.submit(u'alice', 0, 'a1')
+        self.submit(u'alice', 0, 'a2')
+
+        self.assertEquals(self.started, ['a1'])
+
+        return self.failUnlessFailure(self.submit(u'bob', 0, 'b1'),
+                error.RequestRejected)
@@ -49,3 +49,32 @@ class SettingsTestCase(unittest.TestCase):
 
         name = names.pop()
         self.assertEquals(name, cluster.VirtualCluster([]).name)
+
+
+    def test_configEntry(self):
+        class Node(object):
+            def __init__(self, index):
+                self.nodeName = 'nd-abc-{0}'.format(index)
+                self.hostname = '10.0.0.{0}'.format(index)
+
+            def getConfigAttributes(self):
+                return [('NodeHostname', self.hostname)]
+
+        class OpaqueNode(object):
+            nodeName = 'other'
+
+            def getConfigEntry(self):
+                return 'NodeName=other NodeHostname=localhost'
+
+        nodes = [Node(i) for i in range(1000) if i != 500] + [OpaqueNode()]
+        entry = cluster.VirtualCluster(nodes, 'vc-abc').getConfigEntry()
+        lines = entry.splitlines()
+
+        self.assertEquals(len(lines), 8 + 1 + 3)
+        self.assertEquals(lines[1], 'NodeName=nd-abc-[0-127] ' \
+                'NodeHostname={0}'.format(','.join('10.0.0.{0}'.format(i)
+                        for i in range(128))))
+        self.assertEquals(lines[-3], 'NodeName=other NodeHostname=localhost')
+        self.assertEquals(lines[-2], 'PartitionName=vc-abc ' \
+                'Nodes=nd-abc-[0-499,501-999],other Default=NO ' \
+                'MaxTime=INFINITE State=UP')
@@ -2,9 +2,9 @@
 import ConfigParser
 import os
 
-from vurm import controller, error, resources
+from vurm import controller, error, resources, slurm, commands
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 from twisted.python import filepath
 
@@ -16,7 +16,9 @@ class FakeNode(object):
 
     implements(resources.INode)
 
-    def __init__(self):
+    def __init__(self, nodeName=None):
+        self.nodeName = nodeName
+        self.hostname = 'localhost'
         self.spawned = False
         self.released = False
 
@@ -43,12 +45,16 @@ class FakeProvisioner(object):
         self.nodeCount = nodeCount
         self.nodes = []
 
-    def getNodes(self, count, _):
+    def getCapacity(self):
+        return defer.succeed(self.nodeCount)
+
+
+    def getNodes(self, count, names):
         if self.nodeCount is not None:
             count = min(self.nodeCount, count)
             self.nodeCount -= count
 
-        nodes = [FakeNode() for i in range(count)]
+        nodes = [FakeNode(next(names)) for i in range(count)]
         self.nodes += nodes
         return [defer.succeed(n) for n in nodes]
 
@@ -134,10 +140,12 @@ class ControllerClusterDestroyTestCase(ControllerTestCaseBse):
         protocol = controller.VurmControllerProtocol()
         protocol.instance = ctrl
 
-        yield ctrl.createVirtualCluster(5)
-        result = yield protocol.destroyVirtualCluster('all')
+        cluster = yield ctrl.createVirtualCluster(5)
+        result = yield protocol.destroyAllVirtualClusters()
 
-        self.assertEquals(result, {})
+        self.assertEquals(result, {'clusters': [
+            {'clusterName': cluster.name},
+        ]})
 
 
     @defer.inlineCallbacks
@@ -148,13 +156,43 @@ class ControllerClusterDestroyTestCase(ControllerTestCaseBse):
         yield ctrl.createVirtualCluster(5)
         yield ctrl.createVirtualCluster(5)
 
-        yield ctrl.destroyAllVirtualClusters()
+        reconfigured = []
+        reconfigure = ctrl.slurmConfig.reconfigure
+
+        def countReconfigure(edits):
+            reconfigured.append(True)
+            return reconfigure(edits)
+        ctrl.slurmConfig.reconfigure = countReconfigure
+
+        report = yield ctrl.destroyAllVirtualClusters()
 
         for n in provisioner.nodes:
             self.assertTrue(n.spawned)
             self.assertTrue(n.released)
 
         self.assertEquals(ctrl.clusters, {})
+        self.assertEquals(report.values(), [None, None])
+        self.assertEquals(reconfigured, [True])
+        self.assertEquals(self.tmpConfig.getContent(), '')
+
+
+    @defer.inlineCallbacks
+    def test_destroyAllReport(self):
+        provisioner = FakeProvisioner()
+
+        ctrl = controller.VurmController(self.config, [provisioner])
+        failing = yield ctrl.createVirtualCluster(2)
+        working = yield ctrl.createVirtualCluster(2)
+
+        failing.nodes[0].release = lambda: defer.fail(
+                RuntimeError('host unreachable'))
+
+        report = yield ctrl.destroyAllVirtualClusters()
+
+        self.assertEquals(report[working.name], None)
+        self.assertIn('host unreachable', report[failing.name])
+        self.assertTrue(failing.nodes[1].released)
+        self.assertEquals(ctrl.clusters, {})
 
 
     @defer.inlineCallbacks
@@ -207,6 +245,83 @@ class ControllerClusterCreationTestCase(ControllerTestCaseBse):
         self.assertIn('clusterName', result)
 
 
+    @defer.inlineCallbacks
+    def test_protocolQueueStatus(self):
+        protocol = controller.VurmControllerProtocol()
+        protocol.instance = self.controllerWithProvisioners(None)
+        protocol.instance.scheduler.concurrency = 0
+
+        d = protocol.createVirtualCluster(5, user=u'alice', priority=1)
+
+        status = protocol.getQueueStatus()
+        self.assertEquals(status['queued'], 1)
+        self.assertEquals(status['users'], [{'user': u'alice', 'queued': 1}])
+
+        protocol.instance.scheduler.concurrency = 1
+        protocol.instance.scheduler.startQueued()
+
+        result = yield d
+        self.assertIn('clusterName', result)
+
+
+    @defer.inlineCallbacks
+    def test_protocolQueueStatusAnonymous(self):
+        protocol = controller.VurmControllerProtocol()
+        protocol.instance = self.controllerWithProvisioners(None)
+        protocol.instance.scheduler.concurrency = 0
+
+        d = protocol.createVirtualCluster(5)
+
+        # The status of anonymous requests can be serialized
+        status = protocol.getQueueStatus()
+        self.assertEquals(status['users'], [{'user': u'', 'queued': 1}])
+        commands.GetQueueStatus.makeResponse(status, protocol)
+
+        protocol.instance.scheduler.concurrency = 1
+        protocol.instance.scheduler.startQueued()
+
+        result = yield d
+        self.assertIn('clusterName', result)
+
+
+    @defer.inlineCallbacks
+    def test_progressEvents(self):
+        events = []
+
+        def observer(clusterName, nodeName, state, hostname):
+            events.append((nodeName, state, hostname))
+
+        ctrl = self.controllerWithProvisioners(None)
+        virtualCluster = yield ctrl.createVirtualCluster(2, observer=observer)
+
+        names = [n.nodeName for n in virtualCluster.nodes]
+
+        for name in names:
+            nodeEvents = [e[1:] for e in events if e[0] == name]
+            self.assertEquals(nodeEvents, [
+                (controller.NODE_ALLOCATED, None),
+                (controller.NODE_BOOTED, 'localhost'),
+                (controller.NODE_SPAWNED, 'localhost'),
+            ])
+
+
+    @defer.inlineCallbacks
+    def test_protocolProgress(self):
+        sent = []
+
+        protocol = controller.VurmControllerProtocol()
+        protocol.instance = self.controllerWithProvisioners(None)
+        protocol.callRemote = lambda command, **kwargs: sent.append(kwargs)
+
+        result = yield protocol.createVirtualCluster(1, progress=True)
+
+        self.assertEquals([e['state'] for e in sent],
+                controller.NODE_STATES)
+        self.assertEquals(set(e['clusterName'] for e in sent),
+                set([result['clusterName']]))
+        self.assertNotIn('hostname', sent[0])
+
+
     def test_fixedCreation(self):
         ctrl = self.controllerWithProvisioners(None)
         return self.assertCreationSucceeds(ctrl, 5)
@@ -310,6 +425,388 @@ class ControllerClusterCreationTestCase(ControllerTestCaseBse):
 
 
 
+class NodesGathererTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.nodes = [FakeNode('node{0}'.format(i)) for i in range(4)]
+        self.deferreds = [defer.Deferred() for n in self.nodes]
+
+
+    def test_allReady(self):
+        gatherer = controller.NodesGatherer(self.clock, self.deferreds, 4, 10)
+
+        for node, d in zip(self.nodes, self.deferreds):
+            d.callback(node)
+
+        self.assertEquals(gatherer.deferred.result, self.nodes)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    def test_failuresTolerated(self):
+        gatherer = controller.NodesGatherer(self.clock, self.deferreds, 2)
+
+        self.deferreds[0].errback(RuntimeError('boot failed'))
+        self.deferreds[1].callback(self.nodes[1])
+        self.deferreds[2].callback(self.nodes[2])
+        self.assertFalse(gatherer.deferred.called)
+
+        self.deferreds[3].errback(RuntimeError('boot failed'))
+        self.assertEquals(gatherer.deferred.result, self.nodes[1:3])
+
+
+    def test_deadline(self):
+        gatherer = controller.NodesGatherer(self.clock, self.deferreds, 2, 10)
+
+        self.deferreds[0].callback(self.nodes[0])
+        self.deferreds[1].callback(self.nodes[1])
+
+        self.clock.advance(10)
+        self.assertEquals(gatherer.deferred.result, self.nodes[:2])
+
+        # Stragglers are released
+        self.deferreds[2].callback(self.nodes[2])
+        self.assertTrue(self.nodes[2].released)
+        self.assertFalse(self.nodes[1].released)
+
+
+    def test_grace(self):
+        gatherer = controller.NodesGatherer(self.clock, self.deferreds, 2, 60,
+                5)
+
+        self.deferreds[0].callback(self.nodes[0])
+        self.clock.advance(20)
+        self.deferreds[1].callback(self.nodes[1])
+        self.deferreds[2].callback(self.nodes[2])
+
+        # The grace period started when the second node came up
+        self.clock.advance(4)
+        self.assertFalse(gatherer.deferred.called)
+        self.clock.advance(1)
+        self.assertEquals(gatherer.deferred.result, self.nodes[:3])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+        self.deferreds[3].callback(self.nodes[3])
+        self.assertTrue(self.nodes[3].released)
+
+
+    def test_unreachableMinSize(self):
+        gatherer = controller.NodesGatherer(self.clock, self.deferreds, 4, 10)
+
+        self.deferreds[0].errback(RuntimeError('boot failed'))
+        self.assertEquals(gatherer.deferred.result, [])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+
+class ControllerDeadlineTestCase(ControllerTestCaseBse):
+
+    @defer.inlineCallbacks
+    def test_partialCluster(self):
+        self.config.set('vurmctld', 'boottimeout', '0.05')
+
+        provisioner = FakeProvisioner()
+        hung = defer.Deferred()
+
+        def getNodes(count, names):
+            nodes = FakeProvisioner.getNodes(provisioner, count - 1, names)
+            return nodes + [hung]
+        provisioner.getNodes = getNodes
+
+        ctrl = controller.VurmController(self.config, [provisioner])
+        virtualCluster = yield ctrl.createVirtualCluster(4, 2)
+
+        self.assertEquals(virtualCluster.nodes, provisioner.nodes)
+        self.assertIn('Nodes={0} '.format(slurm.compressHostlist([n.nodeName
+                for n in provisioner.nodes])), virtualCluster.getConfigEntry())
+
+        late = FakeNode('late')
+        hung.callback(late)
+        self.assertTrue(late.released)
+
+
+    @defer.inlineCallbacks
+    def test_tooFewNodesUp(self):
+        provisioner = FakeProvisioner()
+
+        def getNodes(count, names):
+            nodes = FakeProvisioner.getNodes(provisioner, count, names)
+            return nodes[:1] + [defer.fail(RuntimeError('boot failed'))
+                    for d in nodes[1:]]
+        provisioner.getNodes = getNodes
+
+        ctrl = controller.VurmController(self.config, [provisioner])
+
+        yield self.failUnlessFailure(ctrl.createVirtualCluster(3, 2),
+                error.InsufficientResourcesException)
+
+        self.assertTrue(provisioner.nodes[0].released)
+        self.flushLoggedErrors(RuntimeError)
+
+
+
+class ControllerResizeTestCase(ControllerTestCaseBse):
+
+    @defer.inlineCallbacks
+    def test_grow(self):
+        provisioner = FakeProvisioner()
+        ctrl = controller.VurmController(self.config, [provisioner])
+
+        virtualCluster = yield ctrl.createVirtualCluster(2)
+        oldEntry = virtualCluster.getConfigEntry()
+        first = list(virtualCluster.nodes)
+
+        yield ctrl.resizeVirtualCluster(virtualCluster.name, 4)
+
+        self.assertEquals(len(virtualCluster.nodes), 4)
+        self.assertEquals(virtualCluster.nodes[:2], first)
+
+        # The node names sequence continues
+        self.assertEquals([n.nodeName[-1] for n in virtualCluster.nodes],
+                ['0', '1', '2', '3'])
+
+        for node in virtualCluster.nodes:
+            self.assertTrue(node.spawned)
+            self.assertFalse(node.released)
+
+        conf = self.tmpConfig.getContent()
+        self.assertNotIn(oldEntry, conf)
+        self.assertIn(virtualCluster.getConfigEntry(), conf)
+
+
+    @defer.inlineCallbacks
+    def test_shrink(self):
+        ctrl = self.controllerWithProvisioners(None)
+
+        virtualCluster = yield ctrl.createVirtualCluster(4)
+        nodes = list(virtualCluster.nodes)
+
+        protocol = controller.VurmControllerProtocol()
+        protocol.instance = ctrl
+        result = yield protocol.resizeVirtualCluster(virtualCluster.name, 1)
+
+        self.assertEquals(result, {'size': 1})
+        self.assertEquals(virtualCluster.nodes, nodes[:1])
+        self.assertEquals([n.released for n in nodes],
+                [False, True, True, True])
+        self.assertEquals(self.tmpConfig.getContent(),
+                virtualCluster.getConfigEntry())
+
+
+    @defer.inlineCallbacks
+    def test_growFails(self):
+        ctrl = self.controllerWithProvisioners(2)
+        virtualCluster = yield ctrl.createVirtualCluster(2)
+
+        yield self.failUnlessFailure(ctrl.resizeVirtualCluster(
+                virtualCluster.name, 3), error.InsufficientResourcesException)
+        yield self.failUnlessFailure(ctrl.resizeVirtualCluster(
+                virtualCluster.name, 0), error.InvalidClusterSize)
+        yield self.failUnlessFailure(ctrl.resizeVirtualCluster(
+                'inexistent', 3), error.InvalidClusterName)
+
+        self.assertEquals(len(virtualCluster.nodes), 2)
+
+
+    @defer.inlineCallbacks
+    def test_reconfigurationRollback(self):
+        ctrl = self.controllerWithProvisioners(None)
+        virtualCluster = yield ctrl.createVirtualCluster(2)
+        entry = virtualCluster.getConfigEntry()
+        nodes = list(virtualCluster.nodes)
+
+        self.config.set('vurmctld', 'reconfigure',
+                'python {0} fail'.format(self.reconfigureScript))
+
+        yield self.failUnlessFailure(ctrl.resizeVirtualCluster(
+                virtualCluster.name, 1), error.ReconfigurationError)
+
+        self.assertEquals(virtualCluster.nodes, nodes)
+        self.assertFalse(nodes[1].released)
+        self.assertEquals(self.tmpConfig.getContent(), entry)
+
+
+
+class RestorableProvisioner(FakeProvisioner):
+
+    def __init__(self, lost=()):
+        FakeProvisioner.__init__(self)
+        self.lost = set(lost)
+
+
+    def restoreNodes(self, states):
+        nodes = []
+
+        for state in states:
+            if state['nodeName'] not in self.lost:
+                nodes.append(FakeNode(str(state['nodeName'])))
+
+        self.nodes += nodes
+        return defer.succeed(nodes)
+
+
+
+class ControllerRecoveryTestCase(ControllerTestCaseBse):
+
+    def setUp(self):
+        ControllerTestCaseBse.setUp(self)
+        self.config.set('vurmctld', 'statejournal', self.mktemp())
+
+
+    @defer.inlineCallbacks
+    def test_recover(self):
+        ctrl = controller.VurmController(self.config, [FakeProvisioner()])
+
+        kept = yield ctrl.createVirtualCluster(3)
+        shrunk = yield ctrl.createVirtualCluster(2)
+        lost = yield ctrl.createVirtualCluster(1)
+        destroyed = yield ctrl.createVirtualCluster(1)
+        yield ctrl.destroyVirtualCluster(destroyed.name)
+
+        yield ctrl.journal.close()
+
+        # Restart the controller
+        provisioner = RestorableProvisioner([shrunk.nodes[1].nodeName,
+                lost.nodes[0].nodeName])
+        restarted = controller.VurmController(self.config, [provisioner])
+        yield restarted.recover()
+
+        self.assertEquals(sorted(restarted.clusters),
+                sorted([kept.name, shrunk.name]))
+        self.assertEquals(
+                [n.nodeName for n in restarted.clusters[shrunk.name].nodes],
+                [shrunk.nodes[0].nodeName])
+
+        conf = self.tmpConfig.getContent()
+        self.assertIn(kept.getConfigEntry(), conf)
+        self.assertIn(restarted.clusters[shrunk.name].getConfigEntry(), conf)
+        self.assertNotIn(shrunk.getConfigEntry(), conf)
+        self.assertNotIn(lost.getConfigEntry(), conf)
+
+        # The recovered clusters can be resized and destroyed
+        yield restarted.resizeVirtualCluster(shrunk.name, 2)
+        self.assertEquals(
+                [n.nodeName for n in restarted.clusters[shrunk.name].nodes],
+                [shrunk.nodes[0].nodeName, shrunk.nodes[1].nodeName[:-1] + '2'])
+
+        yield restarted.destroyVirtualCluster(kept.name)
+        self.assertEquals(sorted(restarted.journal.replay()), [shrunk.name])
+        yield restarted.journal.close()
+
+
+    @defer.inlineCallbacks
+    def test_forgetAfterRemoval(self):
+        ctrl = controller.VurmController(self.config, [FakeProvisioner()])
+        virtualCluster = yield ctrl.createVirtualCluster(2)
+
+        # The cluster stays in the journal until its entry is removed, so
+        # that a restart can still clean it up
+        self.config.set('vurmctld', 'reconfigure', 'exit 1')
+        yield self.failUnlessFailure(
+                ctrl.destroyVirtualCluster(virtualCluster.name),
+                error.ReconfigurationError)
+
+        self.assertEquals(sorted(ctrl.journal.replay()),
+                [virtualCluster.name])
+        yield ctrl.journal.close()
+
+
+    @defer.inlineCallbacks
+    def test_forgetAllTogether(self):
+        ctrl = controller.VurmController(self.config, [FakeProvisioner(10)])
+
+        for _ in range(5):
+            yield ctrl.createVirtualCluster(2)
+
+        commits = []
+        commit = ctrl.journal.commit
+        def countingCommit(operations):
+            commits.append(len(operations))
+            return commit(operations)
+        ctrl.journal.commit = countingCommit
+
+        # The clusters are not forgotten one commit at a time
+        yield ctrl.destroyAllVirtualClusters()
+        self.assertEquals(sum(commits), 5)
+        self.assertTrue(len(commits) < 5)
+
+        self.assertEquals(ctrl.journal.replay(), {})
+        yield ctrl.journal.close()
+
+
+    def test_noJournal(self):
+        self.config.remove_option('vurmctld', 'statejournal')
+        ctrl = controller.VurmController(self.config, [FakeProvisioner()])
+        self.assertIdentical(ctrl.journal, None)
+        return ctrl.recover()
+
+
+
+class ControllerPlacementTestCase(ControllerTestCaseBse):
+
+    def setUp(self):
+        super(ControllerPlacementTestCase, self).setUp()
+
+        self.config.set('vurmctld', 'placement', 'proportional')
+
+
+    def test_splitRequest(self):
+        self.assertEquals(controller.splitRequest(10, [10, 10]), [5, 5])
+        self.assertEquals(controller.splitRequest(10, [30, 10]), [8, 2])
+        self.assertEquals(controller.splitRequest(10, [2, 3]), [2, 3])
+        self.assertEquals(controller.splitRequest(10, [0, None]), [0, 10])
+        self.assertEquals(controller.splitRequest(9, [None, None]), [5, 4])
+        self.assertEquals(controller.splitRequest(5, [0, 0]), [0, 0])
+        self.assertEquals(controller.splitRequest(7, []), [])
+
+
+    @defer.inlineCallbacks
+    def test_proportionalCreation(self):
+        provisioners = [FakeProvisioner(30), FakeProvisioner(10)]
+        ctrl = controller.VurmController(self.config, provisioners)
+
+        yield ctrl.createVirtualCluster(10)
+
+        self.assertEquals(len(provisioners[0].nodes), 8)
+        self.assertEquals(len(provisioners[1].nodes), 2)
+
+
+    @defer.inlineCallbacks
+    def test_proportionalFallback(self):
+        provisioners = [FakeProvisioner(3), FakeProvisioner(1)]
+        ctrl = controller.VurmController(self.config, provisioners)
+
+        # The capacity of the second provisioner changes after being queried
+        provisioners[1].getCapacity = lambda: defer.succeed(5)
+
+        yield ctrl.createVirtualCluster(4)
+
+        self.assertEquals(len(provisioners[0].nodes), 3)
+        self.assertEquals(len(provisioners[1].nodes), 1)
+
+
+    @defer.inlineCallbacks
+    def test_capacityError(self):
+        provisioners = [FakeProvisioner(5), FakeProvisioner(5)]
+        provisioners[0].getCapacity = lambda: defer.fail(RuntimeError())
+        ctrl = controller.VurmController(self.config, provisioners)
+
+        yield ctrl.createVirtualCluster(7)
+
+        self.assertEquals(len(provisioners[0].nodes), 2)
+        self.assertEquals(len(provisioners[1].nodes), 5)
+
+
+    def test_proportionalFail(self):
+        ctrl = self.controllerWithProvisioners(5, 5)
+
+        return self.failUnlessFailure(
+            ctrl.createVirtualCluster(11),
+            error.InsufficientResourcesException
+        )
+
+
+
 class ControllerReconfigureTestCase(ControllerTestCaseBse):
 
     def setUp(self):
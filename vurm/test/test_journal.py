@@ -0,0 +1,76 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from vurm import journal
+
+
+
+class StateJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        log = journal.StateJournal(self.path)
+        log.recordCluster('vc-a', 'entry-a', [{'nodeName': 'nd-a-0'}])
+        log.recordCluster('vc-b', 'entry-b', [{'nodeName': 'nd-b-0'}])
+        log.recordCluster('vc-a', 'entry-a2', [])
+        log.forgetCluster('vc-b')
+        yield log.close()
+
+        # Simulate a write interrupted by a crash
+        with open(self.path, 'a') as fh:
+            fh.write('{"event": "clus')
+
+        records = journal.StateJournal(self.path).replay()
+
+        self.assertEquals(records.keys(), ['vc-a'])
+        self.assertEquals(records['vc-a']['entry'], 'entry-a2')
+
+
+    @defer.inlineCallbacks
+    def test_compaction(self):
+        log = journal.StateJournal(self.path, compactAfter=3)
+        log.recordCluster('vc-a', 'entry-a', [])
+        yield log.recordCluster('vc-b', 'entry-b', [])
+
+        with open(self.path) as fh:
+            self.assertEquals(len(fh.readlines()), 2)
+
+        yield log.forgetCluster('vc-a')
+
+        with open(self.path) as fh:
+            self.assertEquals(len(fh.readlines()), 1)
+
+        # Appending goes on after the compaction
+        log.recordCluster('vc-c', 'entry-c', [])
+        yield log.close()
+
+        records = journal.StateJournal(self.path).replay()
+        self.assertEquals(sorted(records), ['vc-b', 'vc-c'])
+
+
+    @defer.inlineCallbacks
+    def test_groupCommit(self):
+        log = journal.StateJournal(self.path)
+        commits = []
+
+        commit = log.commit
+        def countingCommit(operations):
+            commits.append(len(operations))
+            return commit(operations)
+        log.commit = countingCommit
+
+        # The events appended while a write is in progress share a commit
+        yield defer.gatherResults([log.recordCluster('vc-{0}'.format(i),
+                'entry', []) for i in range(5)])
+        yield log.close()
+
+        self.assertEquals(commits, [1, 4, 1])
+        self.assertEquals(len(journal.StateJournal(self.path).replay()), 5)
+
+
+    def test_missing(self):
+        self.assertEquals(journal.StateJournal(self.path).replay(), {})
@@ -95,3 +95,16 @@ class SettingsTestCase(unittest.TestCase):
 
         self.assertIn('section3', conf.sections())
         self.assertTrue(conf.getboolean('section1', 'loaded'))
+
+
+    def test_getOption(self):
+        conf = settings.loadConfig(self.config1, defaults=[])
+
+        self.assertTrue(settings.getOption(conf, 'section1', 'loaded',
+                type=bool))
+        self.assertEquals(settings.getOption(conf, 'section1', 'loaded'),
+                'True')
+        self.assertEquals(settings.getOption(conf, 'section1', 'missing', 3),
+                3)
+        self.assertEquals(settings.getOption(conf, 'section9', 'loaded'),
+                None)
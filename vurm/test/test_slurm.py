@@ -0,0 +1,518 @@
+
+import ConfigParser
+import pipes
+
+from vurm import slurm, error, worker
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.python import filepath
+
+
+
+class ConfigurationSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Create configuration object
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section('vurmctld')
+
+        # Update configuration with temporary slurm config file
+        self.tmpConfig = filepath.FilePath(self.mktemp())
+        self.config.set('vurmctld', 'slurmconfig', self.tmpConfig.path)
+
+        # Count the reconfigurations by appending a line to a file
+        self.tmpCalls = filepath.FilePath(self.mktemp())
+        self.tmpCalls.touch()
+        cmd = 'echo called >> {0}'.format(self.tmpCalls.path)
+        self.config.set('vurmctld', 'reconfigure', cmd)
+
+        with self.tmpConfig.open('w') as fh:
+            fh.write('remove')
+
+
+    def getCalls(self):
+        with self.tmpCalls.open() as fh:
+            return len(fh.read().splitlines())
+
+
+    def getConfig(self):
+        with self.tmpConfig.open() as fh:
+            return fh.read()
+
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        scheduler = slurm.ConfigurationScheduler(reactor, self.config)
+
+        yield defer.gatherResults([
+            scheduler.schedule(add='a'),
+            scheduler.schedule(add='b', remove='remove'),
+            scheduler.schedule(add='c', notify=False),
+            scheduler.schedule(remove='b'),
+        ])
+
+        self.assertEquals(self.getConfig(), 'ac')
+        self.assertEquals(self.getCalls(), 1)
+
+
+    @defer.inlineCallbacks
+    def test_noNotification(self):
+        scheduler = slurm.ConfigurationScheduler(reactor, self.config)
+
+        yield scheduler.schedule(add='a', notify=False)
+
+        self.assertEquals(self.getConfig(), 'removea')
+        self.assertEquals(self.getCalls(), 0)
+
+
+    @defer.inlineCallbacks
+    def test_sequentialBatches(self):
+        scheduler = slurm.ConfigurationScheduler(reactor, self.config)
+
+        d1 = scheduler.schedule(add='a')
+        yield task.deferLater(reactor, 0, lambda: None)
+
+        # The first batch is being applied, this edit goes into a second one
+        self.assertTrue(scheduler.flushing)
+        d2 = scheduler.schedule(add='b')
+        self.assertEquals(scheduler.delayedCall, None)
+
+        yield defer.gatherResults([d1, d2])
+
+        self.assertEquals(self.getConfig(), 'removeab')
+        self.assertEquals(self.getCalls(), 2)
+
+
+    @defer.inlineCallbacks
+    def test_window(self):
+        clock = task.Clock()
+        backend = slurm.FileBackend(self.config,
+                slurm.AtomicFileWriter(reactor))
+        scheduler = slurm.ConfigurationScheduler(clock, self.config, 5,
+                backend)
+
+        d = scheduler.schedule(add='a', notify=False)
+        scheduler.schedule(add='b', notify=False)
+
+        clock.advance(4)
+        self.assertFalse(scheduler.flushing)
+        self.assertEquals(len(scheduler.pending), 2)
+
+        clock.advance(1)
+        self.assertTrue(scheduler.flushing)
+        self.assertEquals(len(scheduler.pending), 0)
+
+        yield d
+        self.assertEquals(self.getConfig(), 'removeab')
+
+
+    @defer.inlineCallbacks
+    def test_sharedFailure(self):
+        self.config.set('vurmctld', 'reconfigure', 'exit 1')
+        scheduler = slurm.ConfigurationScheduler(reactor, self.config)
+
+        d1 = scheduler.schedule(add='a')
+        d2 = scheduler.schedule(add='b')
+        d3 = scheduler.schedule(add='c', notify=False)
+
+        yield self.failUnlessFailure(d1, error.ReconfigurationError)
+        yield self.failUnlessFailure(d2, error.ReconfigurationError)
+        yield d3
+
+        self.assertEquals(self.getConfig(), 'removeabc')
+
+
+    @defer.inlineCallbacks
+    def test_unexpectedFailure(self):
+        class BrokenReconfigurator(object):
+            def reconfigure(self, edits):
+                raise ValueError('Unparsable entry')
+
+        scheduler = slurm.ConfigurationScheduler(reactor, self.config,
+                reconfigurator=BrokenReconfigurator())
+
+        yield self.failUnlessFailure(scheduler.schedule(add='a'),
+                error.ReconfigurationError)
+
+        # The scheduler is not wedged and applies the following batches
+        self.assertFalse(scheduler.flushing)
+        yield scheduler.schedule(add='b', notify=False)
+        self.assertEquals(self.getConfig(), 'removeab')
+
+
+    def test_invalidArgs(self):
+        scheduler = slurm.ConfigurationScheduler(reactor, self.config)
+
+        self.assertRaises(TypeError, scheduler.schedule)
+
+
+
+class FragmentsBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Create configuration object
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section('vurmctld')
+
+        self.tmpDir = filepath.FilePath(self.mktemp())
+        self.config.set('vurmctld', 'fragmentdir',
+                self.tmpDir.child('fragments').path)
+
+        self.tmpDir.makedirs()
+        self.tmpIndex = self.tmpDir.child('index.conf')
+        self.config.set('vurmctld', 'fragmentindex', self.tmpIndex.path)
+
+        self.tmpConfig = self.tmpDir.child('slurm.conf')
+        self.tmpConfig.setContent('Main\nInclude index.conf\n')
+
+
+    def getBackend(self):
+        return slurm.FragmentsBackend(self.config,
+                slurm.AtomicFileWriter(reactor))
+
+
+    @defer.inlineCallbacks
+    def test_addRemove(self):
+        backend = self.getBackend()
+
+        yield backend.applyEdits([('a\n', ''), ('b\n', '')])
+        self.assertEquals(len(backend.directory.children()), 2)
+        self.assertEquals(len(self.tmpIndex.getContent().splitlines()), 2)
+
+        yield backend.applyEdits([('', 'a\n'), ('', 'unknown\n')])
+        self.assertEquals(len(backend.directory.children()), 1)
+        self.assertEquals(slurm.readConfig(self.tmpConfig.path), 'Main\nb\n')
+
+
+    @defer.inlineCallbacks
+    def test_reload(self):
+        backend = self.getBackend()
+        yield backend.applyEdits([('a\n', ''), ('b\n', '')])
+
+        backend = self.getBackend()
+        yield backend.applyEdits([('', 'a\n')])
+
+        self.assertEquals(slurm.readConfig(self.tmpConfig.path), 'Main\nb\n')
+
+
+    def test_readConfig(self):
+        self.tmpDir.child('nested.conf').setContent('Nested\n')
+        self.tmpConfig.setContent('Main\n  include nested.conf\nEnd\n')
+
+        self.assertEquals(slurm.readConfig(self.tmpConfig.path),
+                'Main\nNested\nEnd\n')
+
+
+    @defer.inlineCallbacks
+    def test_addRemoveSameBatch(self):
+        backend = self.getBackend()
+
+        yield backend.applyEdits([('a\n', ''), ('', 'a\n'), ('b\n', '')])
+
+        self.assertEquals(len(backend.directory.children()), 1)
+        self.assertEquals(slurm.readConfig(self.tmpConfig.path), 'Main\nb\n')
+
+
+
+class ConfigReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = filepath.FilePath(self.mktemp())
+        self.tmpDir.makedirs()
+        self.tmpConfig = self.tmpDir.child('slurm.conf')
+
+
+    def test_read(self):
+        nested = self.tmpDir.child('nested.conf')
+        nested.setContent('Nested\n')
+        self.tmpConfig.setContent('Main\nInclude nested.conf\n')
+
+        reader = slurm.ConfigReader(self.tmpConfig.path)
+        digest, content = reader.read()
+        self.assertEquals(content, 'Main\nNested\n')
+
+        # Not read again if unchanged
+        reader.content = 'cached'
+        self.assertEquals(reader.read(), (digest, 'cached'))
+
+        # Changes to included files are detected as well
+        nested.setContent('Changed\n')
+        newDigest, content = reader.read()
+        self.assertEquals(content, 'Main\nChanged\n')
+        self.assertNotEquals(newDigest, digest)
+
+
+
+class AtomicFileWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = filepath.FilePath(self.mktemp())
+        self.tmpDir.makedirs()
+        self.tmpFile = self.tmpDir.child('slurm.conf')
+
+
+    @defer.inlineCallbacks
+    def test_write(self):
+        writer = slurm.AtomicFileWriter(reactor)
+
+        self.tmpFile.setContent('old')
+        self.tmpFile.chmod(0640)
+
+        yield writer.write(self.tmpFile.path, 'new')
+
+        self.assertEquals(self.tmpFile.getContent(), 'new')
+        self.assertEquals(self.tmpFile.getPermissions().shorthand(),
+                'rw-r-----')
+        self.assertEquals(self.tmpDir.listdir(), ['slurm.conf'])
+
+
+    @defer.inlineCallbacks
+    def test_groupCommit(self):
+        writer = slurm.AtomicFileWriter(reactor)
+        commits = []
+
+        commit = writer.commit
+        def countingCommit(path, content):
+            commits.append(content)
+            commit(path, content)
+        writer.commit = countingCommit
+
+        yield defer.gatherResults([
+            writer.write(self.tmpFile.path, str(i)) for i in range(5)
+        ])
+
+        self.assertEquals(commits, ['0', '4'])
+        self.assertEquals(self.tmpFile.getContent(), '4')
+
+
+    @defer.inlineCallbacks
+    def test_writeError(self):
+        writer = slurm.AtomicFileWriter(reactor)
+        path = self.tmpDir.child('missing').child('slurm.conf').path
+
+        yield self.failUnlessFailure(writer.write(path, 'content'), OSError)
+
+        self.assertEquals(writer.writing, set())
+
+
+
+class HostlistTestCase(unittest.TestCase):
+
+    def test_compressHostlist(self):
+        self.assertEquals(slurm.compressHostlist(['nd-a-3', 'nd-a-0',
+                'nd-a-1', 'nd-a-2', 'nd-a-5', 'nd-a-10']),
+                'nd-a-[0-3,5,10]')
+        self.assertEquals(slurm.compressHostlist(['nd-a-7']), 'nd-a-7')
+        self.assertEquals(slurm.compressHostlist(['n08', 'n09', 'n011',
+                'b2', 'master']), 'b2,master,n[08-09],n011')
+
+
+    def test_formatNodeEntries(self):
+        nodes = [
+            ('nd-a-{0}'.format(i), [('NodeHostname', '10.0.0.{0}'.format(i))])
+            for i in [2, 0, 1, 3]
+        ] + [
+            ('nd-a-4', [('NodeHostname', 'h'), ('Port', 1)]),
+            ('nd-a-5', [('NodeHostname', 'h'), ('Port', 2)]),
+        ]
+
+        self.assertEquals(slurm.formatNodeEntries(nodes, maxNodes=3), [
+            'NodeName=nd-a-[0-2] NodeHostname=10.0.0.0,10.0.0.1,10.0.0.2',
+            'NodeName=nd-a-3 NodeHostname=10.0.0.3',
+            'NodeName=nd-a-4 NodeHostname=h Port=1',
+            'NodeName=nd-a-5 NodeHostname=h Port=2',
+        ])
+
+
+
+class ScontrolReconfiguratorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section('vurmctld')
+        self.reconfigurator = slurm.ScontrolReconfigurator(self.config)
+
+
+    def getEntry(self, name, indexes):
+        return '\n'.join(['# [{0}]'.format(name)] + slurm.formatNodeEntries([
+            ('nd-{0}-{1}'.format(name, i),
+                    [('NodeHostname', '10.0.0.{0}'.format(i))])
+            for i in indexes
+        ]) + [
+            'PartitionName={0} Nodes={1} State=UP'.format(name,
+                    slurm.compressHostlist(['nd-{0}-{1}'.format(name, i)
+                            for i in indexes])),
+            '# [/{0}]'.format(name),
+        ]) + '\n'
+
+
+    def test_expandHostlist(self):
+        names = ['nd-a-0', 'nd-a-1', 'nd-a-2', 'nd-a-5', 'n08', 'n09',
+                'master']
+
+        self.assertEquals(slurm.expandHostlist(
+                slurm.compressHostlist(names)), sorted(names,
+                        key=slurm.hostlistKey))
+
+
+    def test_create(self):
+        commands = self.reconfigurator.getCommands([
+            (self.getEntry('a', range(3)), ''),
+        ])
+
+        self.assertEquals(commands, [
+            ['create', 'NodeName=nd-a-[0-2]',
+                    'NodeHostname=10.0.0.0,10.0.0.1,10.0.0.2'],
+            ['create', 'PartitionName=a', 'Nodes=nd-a-[0-2]', 'State=UP'],
+        ])
+
+
+    def test_resize(self):
+        # Only the added and removed nodes are touched
+        commands = self.reconfigurator.getCommands([
+            (self.getEntry('a', [0, 1, 3]), self.getEntry('a', range(3))),
+        ])
+
+        self.assertEquals(commands, [
+            ['create', 'NodeName=nd-a-3', 'NodeHostname=10.0.0.3'],
+            ['update', 'PartitionName=a', 'Nodes=nd-a-[0-1,3]', 'State=UP'],
+            ['delete', 'NodeName=nd-a-2'],
+        ])
+
+
+    def test_destroy(self):
+        commands = self.reconfigurator.getCommands([
+            ('', self.getEntry('a', range(3))),
+            ('', self.getEntry('b', range(2))),
+            # Created and destroyed in the same batch
+            (self.getEntry('c', range(2)), ''),
+            ('', self.getEntry('c', range(2))),
+        ])
+
+        self.assertEquals(commands, [
+            ['delete', 'PartitionName=a'],
+            ['delete', 'PartitionName=b'],
+            ['delete', 'NodeName=nd-a-[0-2],nd-b-[0-1]'],
+        ])
+
+
+    @defer.inlineCallbacks
+    def test_reconfigure(self):
+        calls = filepath.FilePath(self.mktemp())
+        self.config.set('vurmctld', 'scontrol', 'echo >> {0}'.format(
+                calls.path))
+
+        yield self.reconfigurator.reconfigure([('', self.getEntry('a', [0]))])
+
+        self.assertEquals(calls.getContent().splitlines(), [
+            'delete PartitionName=a',
+            'delete NodeName=nd-a-0',
+        ])
+
+        self.config.set('vurmctld', 'scontrol', 'false')
+
+        yield self.failUnlessFailure(self.reconfigurator.reconfigure([
+                (self.getEntry('a', [0]), '')]), error.ReconfigurationError)
+
+
+    def failOn(self, prefix):
+        """
+        Makes the fake ``scontrol`` command log its arguments and fail for the
+        commands starting with the given prefix.
+        """
+
+        calls = filepath.FilePath(self.mktemp())
+        scontrol = filepath.FilePath(self.mktemp())
+        scontrol.setContent('prefix=$1; shift; echo "$*" >> {0}\n'
+                'case "$*" in "$prefix"*) exit 1;; esac\n'.format(calls.path))
+        self.config.set('vurmctld', 'scontrol', 'sh {0} {1}'.format(
+                scontrol.path, pipes.quote(prefix)))
+        return calls
+
+
+    @defer.inlineCallbacks
+    def test_revertFailure(self):
+        calls = self.failOn('create PartitionName')
+
+        # The nodes are created but the partition can't be
+        d = self.reconfigurator.reconfigure([
+            (self.getEntry('a', range(2)), ''),
+        ])
+        yield self.failUnlessFailure(d, error.ReconfigurationError)
+
+        self.assertEquals(calls.getContent().splitlines(), [
+            'create NodeName=nd-a-[0-1] NodeHostname=10.0.0.0,10.0.0.1',
+            'create PartitionName=a Nodes=nd-a-[0-1] State=UP',
+            'delete NodeName=nd-a-[0-1]',
+        ])
+
+
+    @defer.inlineCallbacks
+    def test_revertUpdates(self):
+        calls = self.failOn('delete NodeName')
+
+        # Updated and deleted entries are restored as they were
+        old = self.getEntry('a', range(2)) + self.getEntry('b', [0])
+        new = self.getEntry('a', [0, 2]).replace('10.0.0.0', '10.0.1.0')
+
+        d = self.reconfigurator.reconfigure([(new, old)])
+        yield self.failUnlessFailure(d, error.ReconfigurationError)
+
+        self.assertEquals(calls.getContent().splitlines(), [
+            'update NodeName=nd-a-0 NodeHostname=10.0.1.0',
+            'create NodeName=nd-a-2 NodeHostname=10.0.0.2',
+            'update PartitionName=a Nodes=nd-a-[0,2] State=UP',
+            'delete PartitionName=b',
+            'delete NodeName=nd-a-1,nd-b-0',
+            'create PartitionName=b Nodes=nd-b-0 State=UP',
+            'update PartitionName=a Nodes=nd-a-[0-1] State=UP',
+            'delete NodeName=nd-a-2',
+            'update NodeName=nd-a-0 NodeHostname=10.0.0.0',
+        ])
+
+
+    @defer.inlineCallbacks
+    def test_scheduler(self):
+        slurmConfig = filepath.FilePath(self.mktemp())
+        slurmConfig.touch()
+        self.config.set('vurmctld', 'slurmconfig', slurmConfig.path)
+        calls = filepath.FilePath(self.mktemp())
+        self.config.set('vurmctld', 'scontrol', 'echo >> {0}'.format(
+                calls.path))
+
+        scheduler = slurm.ConfigurationScheduler(reactor, self.config,
+                reconfigurator=self.reconfigurator)
+
+        yield defer.gatherResults([
+            scheduler.schedule(add=self.getEntry('a', [0])),
+            scheduler.schedule(add=self.getEntry('b', [0]), notify=False),
+        ])
+
+        # Edits without notification are only written to the file
+        self.assertEquals(len(calls.getContent().splitlines()), 2)
+        self.assertIn(self.getEntry('b', [0]), slurmConfig.getContent())
+
+
+    @defer.inlineCallbacks
+    def test_worker(self):
+        shell = worker.ShellWorker(reactor)
+        self.addCleanup(shell.stop)
+
+        reconfigurator = slurm.ScontrolReconfigurator(self.config, shell)
+
+        calls = filepath.FilePath(self.mktemp())
+        self.config.set('vurmctld', 'scontrol', 'echo >> {0}'.format(
+                calls.path))
+
+        yield reconfigurator.reconfigure([('', self.getEntry('a', [0]))])
+        yield reconfigurator.reconfigure([('', self.getEntry('b', [0]))])
+
+        self.assertEquals(len(calls.getContent().splitlines()), 4)
+        self.assertEquals(shell.getStats()['completed'], 2)
+
+        self.config.set('vurmctld', 'scontrol', 'echo failed; false')
+
+        d = reconfigurator.reconfigure([(self.getEntry('a', [0]), '')])
+        e = yield self.failUnlessFailure(d, error.ReconfigurationError)
+        self.assertIn('failed', str(e))
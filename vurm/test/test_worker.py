@@ -0,0 +1,134 @@
+import os
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.python import filepath
+
+from vurm import worker, error
+
+
+
+def isRunning(pid):
+    """
+    Returns ``True`` if the process ``pid`` exists and is not a zombie waiting
+    to be reaped.
+    """
+
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+
+    stat = filepath.FilePath('/proc/{0}/stat'.format(pid))
+
+    if not stat.exists():
+        return True
+
+    return stat.getContent().rsplit(')', 1)[1].split()[0] != 'Z'
+
+
+
+class ShellWorkerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = worker.ShellWorker(reactor)
+        self.addCleanup(self.worker.stop)
+
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        results = yield defer.gatherResults([
+            self.worker.run('echo first'),
+            self.worker.run('echo second >&2; exit 3'),
+            self.worker.run('printf third'),
+        ])
+
+        self.assertEquals(results, [
+            ('first\n', 0),
+            ('second\n', 3),
+            ('third', 0),
+        ])
+
+        # All the requests were served by the same shell
+        stats = self.worker.getStats()
+        self.assertEquals(stats['completed'], 3)
+        self.assertEquals(stats['queued'], 0)
+        self.assertTrue(stats['max'] >= stats['average'] >= 0)
+
+
+    @defer.inlineCallbacks
+    def test_errexit(self):
+        output, status = yield self.worker.run('false\necho unreachable',
+                errexit=True)
+        self.assertEquals((output, status), ('', 1))
+
+        output, status = yield self.worker.run('false\necho reached')
+        self.assertEquals((output, status), ('reached\n', 0))
+
+
+    @defer.inlineCallbacks
+    def test_state(self):
+        # Each script runs in its own subshell
+        yield self.worker.run('cd /; FOO=bar')
+
+        output, status = yield self.worker.run('echo "$FOO"')
+        self.assertEquals(output, '\n')
+
+
+    @defer.inlineCallbacks
+    def test_respawn(self):
+        pending = self.worker.run('kill -9 $$')
+        queued = self.worker.run('echo alive')
+
+        yield self.failUnlessFailure(pending, Exception)
+
+        output, status = yield queued
+        self.assertEquals((output, status), ('alive\n', 0))
+
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        results = []
+        self.worker.run('sleep 0.1; echo done').addCallback(results.append)
+
+        yield self.worker.stop()
+
+        self.assertEquals(results, [('done\n', 0)])
+        self.assertIdentical(self.worker.protocol, None)
+
+        # The worker can still be used after having been stopped
+        output, status = yield self.worker.run('echo again')
+        self.assertEquals((output, status), ('again\n', 0))
+
+
+    @defer.inlineCallbacks
+    def test_runWhileStopping(self):
+        yield self.worker.run('true')
+
+        stopped = self.worker.stop()
+        d = self.worker.run('echo late')
+
+        yield stopped
+        yield self.failUnlessFailure(d, Exception)
+
+        output, status = yield self.worker.run('echo respawned')
+        self.assertEquals((output, status), ('respawned\n', 0))
+
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        self.worker.timeout = 0.5
+        pidFile = filepath.FilePath(self.mktemp())
+
+        hung = self.worker.run('sleep 30 & echo $! > {0}; wait'.format(
+                pidFile.path))
+        queued = self.worker.run('echo next')
+
+        yield self.failUnlessFailure(hung, error.OperationTimeout)
+
+        # The shell was respawned for the queued scripts
+        output, status = yield queued
+        self.assertEquals((output, status), ('next\n', 0))
+
+        # The processes started by the killed shell were killed as well
+        self.assertFalse(isRunning(int(pidFile.getContent())))
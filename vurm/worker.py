@@ -0,0 +1,288 @@
+"""
+Long-lived shell process to run commands without spawning a new shell for
+each of them.
+"""
+
+
+
+import collections
+import os
+import signal
+import uuid
+
+from twisted.internet import defer, protocol
+from twisted.python import procutils
+
+from vurm import logging, error
+
+
+
+class ShellWorkerProtocol(protocol.ProcessProtocol):
+    """
+    Splits the output of the worker shell at the sentinel lines reporting
+    the exit status of each command.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.buffer = ''
+        self.ended = defer.Deferred()
+
+
+    def outReceived(self, data):
+        # Output of a shell which was given up on (e.g. after a timeout)
+        if self.worker.protocol is not self:
+            return
+
+        self.buffer += data
+        sentinel = self.worker.sentinel + ' '
+
+        while True:
+            start = self.buffer.find(sentinel)
+
+            if start < 0:
+                break
+
+            end = self.buffer.find('\n', start)
+
+            if end < 0:
+                break
+
+            output = self.buffer[:start]
+            status = int(self.buffer[start + len(sentinel):end])
+            self.buffer = self.buffer[end + 1:]
+
+            self.worker.commandCompleted(output, status)
+
+
+    def processEnded(self, reason):
+        self.worker.processEnded(self, reason)
+        self.ended.callback(None)
+
+
+
+class ShellWorker(object):
+    """
+    Runs shell scripts one after the other in a single long-lived ``shell``
+    process, which is spawned on the first request and respawned if it
+    dies. Each script runs in a subshell, with its standard input closed and
+    its standard error merged into its output; its exit status is reported
+    on a sentinel line which can't be confused with the output.
+
+    If ``timeout`` is given, scripts running for longer than ``timeout``
+    seconds fail with an ``error.OperationTimeout`` exception; the shell is
+    then killed, together with the processes it started if the ``setsid``
+    command is available to run it in its own process group, and respawned
+    for the next scripts.
+
+    The number of completed requests and their latency (including the time
+    spent waiting in the queue) are tracked, see ``getStats``.
+    """
+
+    def __init__(self, reactor, shell='sh', timeout=None):
+        self.reactor = reactor
+        self.shell = shell
+        self.timeout = timeout
+        self.sentinel = 'vurm-worker-{0}'.format(uuid.uuid4().hex)
+
+        self.protocol = None
+        self.queue = collections.deque()
+        self.current = None
+        self.timeoutCall = None
+        self.stopping = False
+        self.shutdownTrigger = None
+
+        self.completed = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+        self.log = logging.Logger(__name__, system='worker')
+
+
+    def run(self, script, errexit=False):
+        """
+        Queues the execution of ``script``. If ``errexit`` is ``True``, the
+        script is aborted as soon as one of its commands fails.
+
+        Returns a deferred firing with an ``(output, status)`` tuple, or
+        failing if the worker died or was stopped before running the script
+        to completion.
+        """
+
+        d = defer.Deferred()
+        self.queue.append((script, errexit, d, self.reactor.seconds()))
+        self.runNext()
+        return d
+
+
+    def start(self):
+        self.log.debug('Spawning a new worker shell')
+
+        args = [self.shell]
+        setsid = procutils.which('setsid')
+
+        if setsid:
+            args = [setsid[0]] + args
+
+        self.protocol = ShellWorkerProtocol(self)
+        self.reactor.spawnProcess(self.protocol, args[0], args,
+                env=os.environ)
+
+        if self.shutdownTrigger is None:
+            self.shutdownTrigger = self.reactor.addSystemEventTrigger(
+                    'before', 'shutdown', self.stop)
+
+
+    def runNext(self):
+        if self.current is not None or not self.queue or self.stopping:
+            return
+
+        if self.protocol is None:
+            self.start()
+
+        self.current = self.queue.popleft()
+        script, errexit, _, _ = self.current
+
+        if errexit:
+            script = 'set -e\n' + script
+
+        if self.timeout is not None:
+            self.timeoutCall = self.reactor.callLater(self.timeout,
+                    self.expired)
+
+        self.protocol.transport.write('(\n{0}\n) </dev/null 2>&1; ' \
+                'echo "{1} $?"\n'.format(script, self.sentinel))
+
+
+    def cancelTimeout(self):
+        if self.timeoutCall is not None:
+            self.timeoutCall.cancel()
+            self.timeoutCall = None
+
+
+    def commandCompleted(self, output, status):
+        self.cancelTimeout()
+
+        _, _, d, queued = self.current
+        self.current = None
+
+        latency = self.reactor.seconds() - queued
+        self.completed += 1
+        self.totalLatency += latency
+        self.maxLatency = max(self.maxLatency, latency)
+
+        self.log.debug('Command completed with status {0} in {1:.3f}s ' \
+                '({2} queued)', status, latency, len(self.queue))
+
+        d.callback((output, status))
+        self.runNext()
+
+
+    def expired(self):
+        self.timeoutCall = None
+
+        self.log.error('Command did not complete in {0}s, killing the ' \
+                'worker shell', self.timeout)
+
+        # Give up on this shell right away: the processes it started may
+        # keep its output open for a while
+        protocol, self.protocol = self.protocol, None
+        self.kill(protocol)
+
+        _, _, d, _ = self.current
+        self.current = None
+
+        d.errback(error.OperationTimeout('Command did not complete in ' \
+                '{0}s'.format(self.timeout)))
+        self.runNext()
+
+
+    def kill(self, protocol):
+        pid = protocol.transport.pid
+
+        if pid is None:
+            return
+
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            # Not a process group leader (setsid is not available)
+            protocol.transport.signalProcess('KILL')
+
+
+    def processEnded(self, protocol, reason):
+        if protocol is not self.protocol:
+            return
+
+        self.protocol = None
+        self.cancelTimeout()
+
+        if self.current is not None:
+            _, _, d, _ = self.current
+            self.current = None
+
+            self.log.error('Worker shell died while running a command: {0}',
+                    reason.getErrorMessage())
+            d.errback(reason)
+
+        if self.stopping:
+            # Fail the requests received while stopping, the next ones will
+            # spawn a new shell
+            self.stopping = False
+
+            while self.queue:
+                _, _, d, _ = self.queue.popleft()
+                d.errback(reason)
+        else:
+            self.runNext()
+
+
+    def getStats(self):
+        """
+        Returns a dictionary with the number of ``completed`` and ``queued``
+        requests and the ``average`` and ``max`` latency in seconds.
+        """
+
+        return {
+            'completed': self.completed,
+            'queued': len(self.queue) + (self.current is not None),
+            'average': self.totalLatency / self.completed
+                    if self.completed else 0.0,
+            'max': self.maxLatency,
+        }
+
+
+    def stop(self):
+        """
+        Terminates the worker shell once the queued scripts completed.
+        Returns a deferred firing when the shell exited.
+        """
+
+        if self.shutdownTrigger is not None:
+            self.reactor.removeSystemEventTrigger(self.shutdownTrigger)
+            self.shutdownTrigger = None
+
+        if self.protocol is None:
+            return defer.succeed(None)
+
+        # The shell exits once it has read all the queued scripts
+        protocol = self.protocol
+        ended = protocol.ended
+
+        def flushed():
+            # The shell may have been respawned in the meantime
+            if self.protocol is not None:
+                self.stopping = True
+                self.protocol.transport.closeStdin()
+
+        if self.queue or self.current is not None:
+            waiting = [d for _, _, d, _ in self.queue]
+
+            if self.current is not None:
+                waiting.append(self.current[2])
+
+            defer.DeferredList(waiting).addCallback(lambda _: flushed())
+        else:
+            flushed()
+
+        return ended